@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+USAGE = """\
+usage: bench_apply_patch.py [n_patches [n_files]]
+
+Compare stdeb.patch.apply_patches() with running /usr/bin/patch once per
+patch, on a series of patches (20 by default) made with "diff -ruN"
+between successive versions of a generated tree (of 200 files by
+default). The versions change, add and delete files, including files
+with spaces in their names and files without a final newline.
+
+Both are run with -p1 on that series and on the same series with new
+files written as dpkg-source writes them (an "@@ -0,0" hunk, without
+timestamps), and with -p1 --posix on a series which only changes
+files (patch --posix does not take the timestamps of "diff -N" to
+mean that a file is created or deleted). The trees they leave must be
+identical; the exit status is 1 if they are not.
+"""
+
+import sys, os, re, time, shutil, random, tempfile, subprocess, logging
+from stdeb import log
+from stdeb.patch import apply_patches
+from stdeb.tree import TreeManifest, hash_file
+
+def write_file(fname, data):
+    dirname = os.path.dirname(fname)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    fd = open(fname, mode='w')
+    try:
+        fd.write(data)
+    finally:
+        fd.close()
+
+def make_tree(top, n_files):
+    rng = random.Random(0)
+    for i in range(n_files):
+        lines = ['line %d of module %d\n'%(j, i)
+                 for j in range(rng.randint(20, 300))]
+        write_file(os.path.join(top, 'pkg%d'%(i%10), 'mod%d.py'%i),
+                   ''.join(lines))
+    write_file(os.path.join(top, 'with space.txt'), 'a\nb\n')
+    write_file(os.path.join(top, 'no-newline.txt'), 'a\nb')
+
+def change_tree(top, rng, version, add_remove):
+    files = sorted([entry.path for entry in TreeManifest.scan(top).files()])
+    for path in rng.sample(files, min(10, len(files))):
+        fname = os.path.join(top, path)
+        lines = open(fname).readlines()
+        for j in rng.sample(range(len(lines)), min(3, len(lines))):
+            lines[j] = 'v%d '%version + lines[j]
+        if lines:
+            del lines[rng.randrange(len(lines))]
+        lines.insert(rng.randint(0, len(lines)), 'inserted in v%d\n'%version)
+        data = ''.join(lines)
+        if path == 'no-newline.txt':
+            data = data.rstrip('\n')
+        write_file(fname, data)
+    if add_remove:
+        write_file(os.path.join(top, 'new', 'v%d.txt'%version),
+                   'v%d\n'%version)
+        removable = [path for path in files if path.startswith('pkg')]
+        os.unlink(os.path.join(top, rng.choice(removable)))
+
+# the header of a file which "diff -N" found missing
+_new_file_re = re.compile(r'^(--- [^\t\n]*)\t1970-01-01[^\n]*\n'
+                          r'(\+\+\+ [^\t\n]*)\t[^\n]*\n', re.M)
+
+def strip_new_file_timestamps(patch):
+    """write the new files of patch as dpkg-source does"""
+    data = open(patch).read()
+    write_file(patch, _new_file_re.sub(r'\1\n\2\n', data))
+
+def make_patches(work_dir, n_patches, n_files, add_remove, dpkg_style):
+    """return the patch files, made in work_dir, and the base tree"""
+    rng = random.Random(1)
+    base = os.path.join(work_dir, 'base')
+    if os.path.exists(base):
+        shutil.rmtree(base)
+    make_tree(base, n_files)
+    old = os.path.join(work_dir, 'a')
+    new = os.path.join(work_dir, 'b')
+    if os.path.exists(new):
+        shutil.rmtree(new)
+    shutil.copytree(base, new)
+    patches = []
+    for version in range(n_patches):
+        if os.path.exists(old):
+            shutil.rmtree(old)
+        shutil.copytree(new, old)
+        change_tree(new, rng, version, add_remove)
+        patch = os.path.join(work_dir, '%03d.patch'%version)
+        fd = open(patch, mode='w')
+        try:
+            # diff exits with 1 when the trees differ
+            subprocess.call(['diff','-ruN','a','b'], cwd=work_dir, stdout=fd)
+        finally:
+            fd.close()
+        if dpkg_style:
+            strip_new_file_timestamps(patch)
+        patches.append(patch)
+    return patches, base
+
+def describe(top):
+    result = {}
+    for entry in TreeManifest.scan(top).entries:
+        result[entry.path] = (entry.type, entry.mode,
+                              entry.type == 'f' and
+                              hash_file(os.path.join(top, entry.path)))
+    return result
+
+def run_patch(patches, top, posix):
+    args = ['/usr/bin/patch','-p1','--quiet']
+    if posix:
+        args.append('--posix')
+    for patch in patches:
+        fd = open(patch)
+        try:
+            subprocess.check_call(args, cwd=top, stdin=fd)
+        finally:
+            fd.close()
+
+def run_apply_patches(patches, top, posix):
+    apply_patches(patches, cwd=top, level=1, posix=posix)
+
+def main():
+    if len(sys.argv) > 3:
+        print USAGE
+        return 1
+    n_patches = 20
+    n_files = 200
+    if len(sys.argv) > 1:
+        n_patches = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n_files = int(sys.argv[2])
+    log.setLevel(logging.ERROR)
+    work_dir = tempfile.mkdtemp()
+    failed = 0
+    try:
+        print '%d patches of %d files'%(n_patches, n_files)
+        print '%-16s %-8s %9s'%('method','series','time (s)')
+        for series, posix, dpkg_style in [('diff -N', False, False),
+                                          ('dpkg', False, True),
+                                          ('posix', True, False)]:
+            patches, base = make_patches(work_dir, n_patches, n_files,
+                                         add_remove=not posix,
+                                         dpkg_style=dpkg_style)
+            trees = []
+            for label, func in [('/usr/bin/patch', run_patch),
+                                ('apply_patches', run_apply_patches)]:
+                top = os.path.join(work_dir, 'run')
+                if os.path.exists(top):
+                    shutil.rmtree(top)
+                shutil.copytree(base, top)
+                start = time.time()
+                func(patches, top, posix)
+                print '%-16s %-8s %9.3f'%(label, series, time.time()-start)
+                trees.append(describe(top))
+            if trees[0] != trees[1]:
+                print 'FAILED: the trees differ (%s)'%series
+                failed = 1
+    finally:
+        shutil.rmtree(work_dir)
+    if not failed:
+        print 'the trees are identical'
+    return failed
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+USAGE = """\
+usage: bench_apt_file_parse.py [n_lines]
+
+Compare parsing synthetic "apt-file search" output (1M lines by
+default) the old way (readlines() then two regular expressions per
+line) with stdeb.util.parse_apt_file_output().
+"""
+
+import sys, re, time, tempfile, os
+from stdeb.util import parse_apt_file_output
+
+NAMES = ['foo','bar','baz','setuptools','simplejson','twisted']
+
+def make_output(fname, n_lines):
+    fd = open(fname,mode='w')
+    try:
+        for i in xrange(n_lines):
+            name = NAMES[i % len(NAMES)]
+            fd.write('python-%s%d: /usr/share/pyshared/%s-%d.%d-py2.6.egg-info'
+                     '/PKG-INFO\n' % (name, i % 997, name, i % 13, i % 7))
+    finally:
+        fd.close()
+
+def parse_old(fd, egginfore):
+    # the algorithm used by stdeb 0.4.2
+    inlines = fd.readlines()
+    E=re.compile(egginfore, re.I)
+    D=re.compile("^([^:]*):", re.I)
+    eggsndebs = set()
+    for l in inlines:
+        if l:
+            emo = E.search(l)
+            assert emo, l
+            dmo = D.search(l)
+            assert dmo, l
+            eggsndebs.add((emo.group(1), dmo.group(1)))
+    return eggsndebs
+
+def parse_new(fd, egginfore):
+    E=re.compile(egginfore, re.I)
+    return set(parse_apt_file_output(fd, E))
+
+def main():
+    if len(sys.argv) > 2:
+        print USAGE
+        return 1
+    if len(sys.argv) == 2:
+        n_lines = int(sys.argv[1])
+    else:
+        n_lines = 1000000
+    egginfore=("(/(%s)(?:-[^/]+)?(?:-py[0-9]\.[0-9.]+)?\.egg-info)"
+               % '|'.join(NAMES))
+    fd, fname = tempfile.mkstemp(suffix='.txt')
+    os.close(fd)
+    try:
+        make_output(fname, n_lines)
+        results = {}
+        for name, func in [('readlines+2 regexps',parse_old),
+                           ('streaming',parse_new)]:
+            fd = open(fname,mode='r')
+            try:
+                start = time.time()
+                results[name] = func(fd, egginfore)
+                stop = time.time()
+            finally:
+                fd.close()
+            print '%-20s %8.3f sec (%d lines, %d results)'%(
+                name, stop-start, n_lines, len(results[name]))
+        assert results['readlines+2 regexps'] == results['streaming']
+    finally:
+        os.unlink(fname)
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+USAGE = """\
+usage: bench_config.py [n_sections [n_packages]]
+
+Compare the cost of reading the configuration of n_packages packages
+(100 by default) from an extra .cfg file with n_sections sections (500
+by default): once with a new SafeConfigParser per package, as stdeb
+used to, and once with stdeb.config, which parses the file once.
+
+Each package looks up the options DebianInfo looks up. The values
+must be the same both ways; the exit status is 1 if they are not.
+"""
+
+import sys, os, time, tempfile, ConfigParser
+from stdeb.util import parse_vals
+from stdeb.config import Config
+
+OPTIONS = ['Source','Package','Forced-Upstream-Version',
+           'Upstream-Version-Prefix','Upstream-Version-Suffix','Epoch',
+           'Debian-Version','Distribution','Maintainer','Uploaders',
+           'XS-Python-Version','Copyright-File','MIME-File',
+           'Shared-MIME-File','MIME-Desktop-Files','Depends',
+           'Build-Depends','Suggests','Recommends','Build-Conflicts',
+           'Stdeb-Patch-File','Stdeb-Patch-Level','dpkg-shlibdeps-params',
+           'Conflicts','Provides','Replaces','Setup-Env-Vars','Udev-Rules']
+
+def write_cfg(fname, n_sections):
+    fd = open(fname, mode='w')
+    try:
+        fd.write('[DEFAULT]\nDistribution: unstable\n\n')
+        for i in range(n_sections):
+            fd.write('[package%d]\n'%i)
+            fd.write('Depends: python-dep%d, python-common # shared\n'%i)
+            fd.write('Build-Depends: python-all-dev, python-dep%d\n'%i)
+            fd.write('Suggests: python-package%d-doc\n'%i)
+            fd.write('Conflicts: python-old%d\n\n'%i)
+    finally:
+        fd.close()
+
+def get_defaults(module_name):
+    defaults = dict([(option, '') for option in OPTIONS])
+    defaults['Source'] = module_name
+    defaults['Package'] = 'python-%s'%module_name
+    defaults['Maintainer'] = 'A B <a@b.c>'
+    return defaults
+
+def read_with_configparser(cfg_files, module_name):
+    cfg = ConfigParser.SafeConfigParser(get_defaults(module_name))
+    cfg.read(cfg_files)
+    return [parse_vals(cfg, module_name, option) for option in OPTIONS]
+
+def read_with_config(cfg_files, module_name):
+    cfg = Config(cfg_files, get_defaults(module_name))
+    return [parse_vals(cfg, module_name, option) for option in OPTIONS]
+
+def main():
+    if len(sys.argv) > 3:
+        print USAGE
+        return 1
+    n_sections = 500
+    n_packages = 100
+    if len(sys.argv) > 1:
+        n_sections = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n_packages = int(sys.argv[2])
+    fd, fname = tempfile.mkstemp(suffix='.cfg')
+    os.close(fd)
+    try:
+        write_cfg(fname, n_sections)
+        module_names = ['package%d'%(i*7 % n_sections)
+                        for i in range(n_packages)]
+        print '%d sections, %d packages'%(n_sections, n_packages)
+        print '%-20s %9s %17s'%('method','time (s)','per package (ms)')
+        results = []
+        for label, func in [('SafeConfigParser', read_with_configparser),
+                            ('stdeb.config', read_with_config)]:
+            start = time.time()
+            values = [func([fname], name) for name in module_names]
+            duration = time.time()-start
+            print '%-20s %9.3f %17.3f'%(label, duration,
+                                        duration*1000/n_packages)
+            results.append(values)
+    finally:
+        os.unlink(fname)
+    if results[0] != results[1]:
+        print 'FAILED: the values differ'
+        return 1
+    print 'the values are the same'
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
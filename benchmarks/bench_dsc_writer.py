@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+USAGE = """\
+usage: bench_dsc_writer.py [n_files [n_changed [n_runs]]]
+
+Compare stdeb.dsc.write_source_package() with "dpkg-source -b" on a
+generated upstream tree (1000 files by default) and its debianized
+copy (with 50 upstream files changed, plus files with spaces in their
+names, without final newlines, new, empty, executable and deleted).
+
+The decompressed .diff.gz files must be identical, and so must the
+.dsc files except for the checksums of the .diff.gz (the two are not
+gzipped alike). The exit status is 1 if they differ.
+"""
+
+import sys, os, time, shutil, random, tarfile, tempfile, subprocess, gzip
+import logging
+from stdeb import log
+from stdeb.dsc import write_source_package
+
+SOURCE = 'benchpkg'
+VERSION = '1.0'
+DIRNAME = '%s-%s'%(SOURCE, VERSION)
+ORIG_TARBALL = '%s_%s.orig.tar.gz'%(SOURCE, VERSION)
+DIFF_NAME = '%s_%s-1.diff.gz'%(SOURCE, VERSION)
+DSC_NAME = '%s_%s-1.dsc'%(SOURCE, VERSION)
+
+# as stdeb writes them
+CONTROL = """\
+Source: %(source)s
+Maintainer: A B <a@b.c>
+Uploaders: C D <c@d.e>, E F <e@f.g>
+Section: python
+Priority: optional
+Build-Depends: python-setuptools (>= 0.6b3), debhelper (>= 7), python-support (>= 0.8.4)
+Standards-Version: 3.7.2
+XS-Python-Version: >= 2.5
+
+Package: python-%(source)s
+Architecture: all
+Depends: ${python:Depends}
+Recommends:
+Suggests:
+XB-Python-Version: ${python:Versions}
+Description: generated package
+ generated for bench_dsc_writer.py
+"""
+
+CHANGELOG = """\
+%(source)s (%(version)s-1) unstable; urgency=low
+
+  * source package automatically created by stdeb
+
+ -- A B <a@b.c>  Thu, 01 Jan 2009 00:00:00 +0000
+"""
+
+def write_file(fname, data, mode=None):
+    dirname = os.path.dirname(fname)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    fd = open(fname, mode='w')
+    try:
+        fd.write(data)
+    finally:
+        fd.close()
+    if mode is not None:
+        os.chmod(fname, mode)
+
+def make_upstream(top, n_files):
+    rng = random.Random(0)
+    for i in range(n_files):
+        lines = ['line %d of module %d\n'%(j, i)
+                 for j in range(rng.randint(20, 400))]
+        write_file(os.path.join(top, 'pkg%d'%(i%20), 'mod%d.py'%i),
+                   ''.join(lines))
+    write_file(os.path.join(top, 'with space.txt'), 'a\nb\n')
+    write_file(os.path.join(top, 'no-newline.txt'), 'a\nb')
+    write_file(os.path.join(top, 'deleted.txt'), 'gone\n')
+
+def debianize(top, n_files, n_changed):
+    rng = random.Random(1)
+    for i in rng.sample(range(n_files), min(n_changed, n_files)):
+        fname = os.path.join(top, 'pkg%d'%(i%20), 'mod%d.py'%i)
+        lines = open(fname).readlines()
+        for j in rng.sample(range(len(lines)), min(3, len(lines))):
+            lines[j] = 'changed ' + lines[j]
+        lines.insert(rng.randint(0, len(lines)), 'inserted\n')
+        write_file(fname, ''.join(lines))
+    write_file(os.path.join(top, 'with space.txt'), 'a\nc\n')
+    write_file(os.path.join(top, 'no-newline.txt'), 'a\nc')
+    write_file(os.path.join(top, 'new.txt'), 'new\nfile')
+    write_file(os.path.join(top, 'empty.txt'), '')
+    write_file(os.path.join(top, 'script.sh'), '#!/bin/sh\n', 0755)
+    os.unlink(os.path.join(top, 'deleted.txt'))
+    values = {'source':SOURCE, 'version':VERSION}
+    write_file(os.path.join(top, 'debian', 'control'), CONTROL%values)
+    write_file(os.path.join(top, 'debian', 'changelog'), CHANGELOG%values)
+    write_file(os.path.join(top, 'debian', 'compat'), '7\n')
+    write_file(os.path.join(top, 'debian', 'rules'),
+               '#!/usr/bin/make -f\n%:\n\tdh $@\n', 0755)
+
+def make_dist_dir(work_dir, n_files, n_changed):
+    dist_dir = os.path.join(work_dir, 'template')
+    os.mkdir(dist_dir)
+    make_upstream(os.path.join(dist_dir, DIRNAME), n_files)
+    tar = tarfile.open(os.path.join(dist_dir, ORIG_TARBALL), 'w:gz')
+    try:
+        tar.add(os.path.join(dist_dir, DIRNAME), DIRNAME)
+    finally:
+        tar.close()
+    debianize(os.path.join(dist_dir, DIRNAME), n_files, n_changed)
+    return dist_dir
+
+def build_native(dist_dir):
+    write_source_package(dist_dir, DIRNAME, ORIG_TARBALL)
+
+def build_dpkg_source(dist_dir):
+    devnull = open(os.devnull, 'w')
+    try:
+        subprocess.check_call(['dpkg-source','-b',DIRNAME,ORIG_TARBALL],
+                              cwd=dist_dir, stdout=devnull, stderr=devnull)
+    finally:
+        devnull.close()
+
+def read_outputs(dist_dir):
+    """return the decompressed diff and the .dsc without diff checksums"""
+    fd = gzip.open(os.path.join(dist_dir, DIFF_NAME))
+    try:
+        diff = fd.read()
+    finally:
+        fd.close()
+    dsc = [line for line in open(os.path.join(dist_dir, DSC_NAME))
+           if not line.rstrip().endswith(' '+DIFF_NAME)]
+    return diff, ''.join(dsc)
+
+def main():
+    if len(sys.argv) > 4:
+        print USAGE
+        return 1
+    n_files = 1000
+    n_changed = 50
+    n_runs = 3
+    if len(sys.argv) > 1:
+        n_files = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n_changed = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        n_runs = int(sys.argv[3])
+    log.setLevel(logging.ERROR)
+    work_dir = tempfile.mkdtemp()
+    try:
+        template = make_dist_dir(work_dir, n_files, n_changed)
+        outputs = {}
+        print '%d files, %d changed'%(n_files, n_changed)
+        print '%-22s %9s %9s'%('writer','min (s)','med (s)')
+        for label, func in [('dpkg-source -b', build_dpkg_source),
+                            ('write_source_package', build_native)]:
+            times = []
+            for i in range(n_runs):
+                dist_dir = os.path.join(work_dir, 'run')
+                shutil.copytree(template, dist_dir, symlinks=True)
+                start = time.time()
+                func(dist_dir)
+                times.append(time.time()-start)
+                outputs[label] = read_outputs(dist_dir)
+                shutil.rmtree(dist_dir)
+            times.sort()
+            print '%-22s %9.3f %9.3f'%(label, times[0], times[len(times)//2])
+    finally:
+        shutil.rmtree(work_dir)
+
+    failed = 0
+    expected, got = outputs['dpkg-source -b'], outputs['write_source_package']
+    for name, index in [('decompressed .diff.gz', 0), ('.dsc', 1)]:
+        if expected[index] == got[index]:
+            print '%s: identical'%name
+        else:
+            print 'FAILED: %s differs'%name
+            failed = 1
+    return failed
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+USAGE = """\
+usage: bench_end_to_end.py [options]
+
+Time py2dsc and "setup.py sdist_dsc" from start to finish on generated
+source distributions, without a network connection and without the
+Debian tools: fast fakes of date, dpkg-query, dpkg-source and apt-file
+are put first on $PATH. (dpkg-query is only run when there is no dpkg
+database, and dpkg-source only with --use-dpkg-source or when stdeb
+cannot write a source package itself.)
+
+The sdists are made in each of the --sizes (tiny: a few files, 10k:
+10000 small files, 500mb: 500 files of 1 MiB) and --formats (tar.gz,
+tar.bz2, zip), with and without install_requires. Every run starts
+with an empty stdeb cache. The time spent in each stage (expanding
+and repacking the sdist, DebianInfo, copying the tree, build_dsc and
+what it calls) is measured too; a stage includes the stages it calls.
+
+The minimum and median of the runs are printed, and written as JSON
+with --json so that results of two versions can be compared with
+--compare. The exit status is 1 if a build fails.
+"""
+
+import sys, os, time, shutil, random, tarfile, zipfile, tempfile, \
+       subprocess, optparse
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, TOP)
+import stdeb
+
+# name: (number of files, bytes per file)
+SIZES = {'tiny':(3, 200),
+         '10k':(10000, 1000),
+         '500mb':(500, 1024*1024),
+         }
+FORMATS = ['tar.gz','tar.bz2','zip']
+
+# the requirements of the sdists made with install_requires, and the
+# packages the fake apt-file finds for them (the last one is not found)
+REQUIREMENTS = ['benchdep0>=0.5','benchdep1','benchdep2','benchdep3',
+                'benchmissing']
+APT_FILE_FOUND = ['benchdep0','benchdep1','benchdep2','benchdep3']
+# unrelated lines of the fake apt-file's output
+APT_FILE_OTHERS = 2000
+
+FAKE_DATE = """\
+#!/bin/sh
+echo 'Thu, 01 Jan 2009 00:00:00 +0000'
+"""
+
+FAKE_DPKG_QUERY = """\
+#!/bin/sh
+# dpkg-query --show --showformat=${Version} package
+for pkg; do :; done
+case "$pkg" in
+debhelper) printf 7.4.20 ;;
+python-support) printf 1.0.3 ;;
+esac
+"""
+
+FAKE_APT_FILE = """\
+#!%(python)s
+# apt-file search --ignore-case --regexp regexp
+import sys, re
+regexp = re.compile(sys.argv[-1], re.I)
+for line in open(%(listing)r):
+    if regexp.search(line.split(': ', 1)[1]):
+        sys.stdout.write(line)
+"""
+
+FAKE_DPKG_SOURCE = """\
+#!%(python)s
+# dpkg-source -b dirname orig_tarball | dpkg-source -x dsc_file
+import sys, os, gzip, tarfile, tempfile, shutil
+sys.path.insert(0, %(top)r)
+from stdeb.dsc import write_source_package
+from stdeb.patch import apply_patches
+
+def extract(dsc_name):
+    fields = {}
+    files = []
+    key = None
+    for line in open(dsc_name):
+        if line[:1] in ' \\t':
+            if key == 'Files':
+                files.append(line.split()[2])
+            continue
+        key, value = line.split(':', 1)
+        fields[key] = value.strip()
+    version = fields['Version'].split(':')[-1].rsplit('-', 1)[0]
+    dirname = '%%s-%%s'%%(fields['Source'], version)
+    tmp_dir = tempfile.mkdtemp(dir=os.curdir)
+    try:
+        for fname in files:
+            if fname.endswith('.orig.tar.gz'):
+                tarfile.open(fname).extractall(tmp_dir)
+                top, = os.listdir(tmp_dir)
+                os.rename(os.path.join(tmp_dir, top), dirname)
+        for fname in files:
+            if fname.endswith('.diff.gz'):
+                diff = os.path.join(tmp_dir, 'diff')
+                open(diff, 'wb').write(gzip.open(fname).read())
+                apply_patches([diff], cwd=dirname, level=1)
+        os.chmod(os.path.join(dirname, 'debian', 'rules'), 0755)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if sys.argv[1] == '-b':
+    write_source_package(os.getcwd(), sys.argv[2], sys.argv[3])
+else:
+    extract(sys.argv[2])
+"""
+
+# Runs py2dsc or sdist_dsc (the first argument) with the functions of
+# STAGES timed. Each process (setup.py runs in a fork of py2dsc)
+# appends "stage<TAB>seconds" lines to a file of its own.
+DRIVER = """\
+import sys, os, time
+timings_dir = os.environ['STDEB_BENCH_TIMINGS']
+def timed(label, func):
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            fd = open(os.path.join(timings_dir, '%%d.txt'%%os.getpid()), 'a')
+            try:
+                fd.write('%%s\\t%%f\\n'%%(label, time.time()-start))
+            finally:
+                fd.close()
+    return wrapper
+import stdeb.tree, stdeb.util
+for module_name, name, label in %(stages)r:
+    module = sys.modules[module_name]
+    setattr(module, name, timed(label, getattr(module, name)))
+stdeb.tree.TreeManifest.scan = classmethod(
+    timed('scan', stdeb.tree.TreeManifest.scan.im_func))
+command, args = sys.argv[1], sys.argv[2:]
+if command == 'py2dsc':
+    from stdeb.py2dsc import runit
+    sys.argv = ['py2dsc']+args
+    sys.exit(runit())
+else:
+    from stdeb.stdeb_run_setup import run_setup
+    sys.exit(run_setup(['sdist_dsc']+args))
+"""
+
+# (module, function, stage), patched before py2dsc or sdist_dsc
+# import them
+STAGES = [
+    ('stdeb.util','expand_sdist_file','expand'),
+    ('stdeb.util','repack_tarball_with_debianized_dirname','repack'),
+    ('stdeb.util','DebianInfo','debian_info'),
+    ('stdeb.util','get_deb_depends_from_setuptools_requires','requires'),
+    ('stdeb.tree','clone_tree','clone_tree'),
+    ('stdeb.util','build_dsc','build_dsc'),
+    ('stdeb.util','write_source_package','write_dsc'),
+    ('stdeb.util','get_source_dir_differences','check_source_dir'),
+    ('stdeb.util','dpkg_source','dpkg_source'),
+    ]
+
+def write_file(fname, data, mode=0644):
+    fd = open(fname, mode='wb')
+    try:
+        fd.write(data)
+    finally:
+        fd.close()
+    os.chmod(fname, mode)
+
+def write_fake_tools(bin_dir):
+    """write the fake Debian tools into bin_dir"""
+    os.mkdir(bin_dir)
+    rng = random.Random(0)
+    lines = []
+    for name in APT_FILE_FOUND:
+        lines.append('python-%s: /usr/share/pyshared/%s-1.0.egg-info\n'%(
+            name, name))
+    for i in range(APT_FILE_OTHERS):
+        name = 'other%d'%rng.randrange(APT_FILE_OTHERS)
+        lines.append('python-%s: /usr/lib/python2.7/dist-packages/'
+                     '%s-0.%d-py2.7.egg-info/PKG-INFO\n'%(name, name, i))
+    listing = os.path.join(bin_dir, 'apt-file.txt')
+    write_file(listing, ''.join(lines))
+    for name, script in [('date', FAKE_DATE),
+                         ('dpkg-query', FAKE_DPKG_QUERY),
+                         ('apt-file', FAKE_APT_FILE%{
+                             'python':sys.executable, 'listing':listing}),
+                         ('dpkg-source', FAKE_DPKG_SOURCE%{
+                             'python':sys.executable, 'top':TOP}),
+                         ]:
+        write_file(os.path.join(bin_dir, name), script, 0755)
+
+SETUP_PY = """\
+from setuptools import setup
+setup(name=%(name)r,
+      version='1.0',
+      description='generated by bench_end_to_end.py',
+      author='Bench Mark',
+      author_email='bench@example.com',
+      packages=%(packages)r,
+      install_requires=%(install_requires)r,
+      )
+"""
+
+PKG_INFO = """\
+Metadata-Version: 1.0
+Name: %(name)s
+Version: 1.0
+Summary: generated by bench_end_to_end.py
+Author: Bench Mark
+Author-email: bench@example.com
+License: UNKNOWN
+Description: UNKNOWN
+Platform: UNKNOWN
+"""
+
+def make_tree(top, name, n_files, file_size, requires):
+    """write a source tree of n_files files of about file_size bytes"""
+    n_packages = max(1, n_files//100)
+    packages = ['%s%d'%(name, i) for i in range(n_packages)]
+    os.makedirs(top)
+    write_file(os.path.join(top, 'setup.py'), SETUP_PY%{
+        'name':name, 'packages':packages,
+        'install_requires':requires and REQUIREMENTS or []})
+    write_file(os.path.join(top, 'PKG-INFO'), PKG_INFO%{'name':name})
+    for package in packages:
+        os.mkdir(os.path.join(top, package))
+        write_file(os.path.join(top, package, '__init__.py'), '')
+    if file_size >= 64*1024:
+        # as incompressible as real data, without generating all of it
+        block = os.urandom(file_size)
+    for i in range(n_files):
+        if file_size >= 64*1024:
+            fname = os.path.join(top, packages[i%n_packages], 'data%d.bin'%i)
+            write_file(fname, '%d\n'%i + block)
+        else:
+            line = 'def func%d_%%d(): return %%d\n'%i
+            lines = [line%(j, j) for j in range(file_size//30+1)]
+            fname = os.path.join(top, packages[i%n_packages], 'mod%d.py'%i)
+            write_file(fname, ''.join(lines))
+
+def make_sdist(work_dir, size, format, requires):
+    """return the sdist for this case, making it if it does not exist"""
+    name = 'bench%s%s'%(size, requires and 'req' or '')
+    sdist = os.path.join(work_dir, '%s-1.0.%s'%(name, format))
+    if os.path.exists(sdist):
+        return sdist
+    src_dir = os.path.join(work_dir, 'src')
+    if os.path.exists(src_dir):
+        shutil.rmtree(src_dir)
+    n_files, file_size = SIZES[size]
+    top = os.path.join(src_dir, '%s-1.0'%name)
+    make_tree(top, name, n_files, file_size, requires)
+    tmp_sdist = sdist+'.tmp'
+    if format == 'zip':
+        zf = zipfile.ZipFile(tmp_sdist, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            for dirpath, dirnames, filenames in os.walk(top):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    fname = os.path.join(dirpath, filename)
+                    zf.write(fname, os.path.relpath(fname, src_dir))
+        finally:
+            zf.close()
+    else:
+        tf = tarfile.open(tmp_sdist, 'w:'+format.split('.')[1])
+        try:
+            tf.add(top, os.path.basename(top))
+        finally:
+            tf.close()
+    os.rename(tmp_sdist, sdist)
+    shutil.rmtree(src_dir)
+    return sdist
+
+def expand(sdist, dest_dir):
+    """expand sdist into dest_dir, return the top directory"""
+    if sdist.endswith('.zip'):
+        zf = zipfile.ZipFile(sdist)
+        try:
+            zf.extractall(dest_dir)
+        finally:
+            zf.close()
+    else:
+        tf = tarfile.open(sdist)
+        try:
+            tf.extractall(dest_dir)
+        finally:
+            tf.close()
+    top, = os.listdir(dest_dir)
+    return os.path.join(dest_dir, top)
+
+def get_env(bin_dir, cache_dir, timings_dir):
+    env = dict(os.environ)
+    env['PATH'] = os.pathsep.join([bin_dir, env.get('PATH', os.defpath)])
+    env['PYTHONPATH'] = os.pathsep.join(
+        [TOP] + [p for p in [env.get('PYTHONPATH')] if p])
+    env['STDEB_CACHE_DIR'] = cache_dir
+    env['STDEB_BENCH_TIMINGS'] = timings_dir
+    # fail rather than download anything (py2dsc looks each package up
+    # on PyPI)
+    for var in ['http_proxy','https_proxy','ftp_proxy']:
+        env[var] = 'http://127.0.0.1:9/'
+    return env
+
+def read_timings(timings_dir):
+    """return {stage: total seconds} of the files of all processes"""
+    result = {}
+    for fname in os.listdir(timings_dir):
+        for line in open(os.path.join(timings_dir, fname)):
+            label, seconds = line.split('\t')
+            result[label] = result.get(label, 0.0) + float(seconds)
+    return result
+
+def read_commands(report):
+    """return {program: wall seconds} of a --report-subprocesses file"""
+    fd = open(report)
+    try:
+        totals = json.load(fd)['totals']
+    finally:
+        fd.close()
+    return dict([(str(name), tot['wall_time'])
+                 for name, tot in totals.iteritems()])
+
+def run_once(command, sdist, run_dir, bin_dir, extra_args):
+    """run py2dsc or sdist_dsc on sdist, return its measurements"""
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.mkdir(run_dir)
+    cache_dir = os.path.join(run_dir, 'cache')
+    timings_dir = os.path.join(run_dir, 'timings')
+    os.mkdir(timings_dir)
+    dist_dir = os.path.join(run_dir, 'deb_dist')
+    report = os.path.join(run_dir, 'subprocesses.json')
+    args = [sys.executable, '-c', DRIVER%{'stages':STAGES}, command]
+    if command == 'py2dsc':
+        cwd = run_dir
+        args += ['--dist-dir=%s'%dist_dir]
+    else:
+        cwd = expand(sdist, os.path.join(run_dir, 'src'))
+        args += ['--dist-dir=%s'%dist_dir,
+                 '--use-premade-distfile=%s'%sdist]
+    args += ['--report-subprocesses=%s'%report] + extra_args
+    if command == 'py2dsc':
+        args.append(sdist)
+    log_name = os.path.join(run_dir, 'log')
+    log_fd = open(log_name, mode='w')
+    try:
+        start = time.time()
+        returncode = subprocess.call(
+            args, cwd=cwd, stdout=log_fd, stderr=subprocess.STDOUT,
+            env=get_env(bin_dir, cache_dir, timings_dir))
+        total = time.time()-start
+    finally:
+        log_fd.close()
+    made = [f for f in os.listdir(dist_dir) if f.endswith('.dsc')] \
+           if os.path.isdir(dist_dir) else []
+    if returncode or not made:
+        sys.stdout.write(open(log_name).read())
+        raise RuntimeError('%s failed on %s'%(command, sdist))
+    result = {'total':total,
+              'stages':read_timings(timings_dir),
+              'commands':{}}
+    if os.path.exists(report):
+        result['commands'] = read_commands(report)
+    return result
+
+def summarize(times):
+    times = sorted(times)
+    return {'min':round(times[0], 4),
+            'median':round(times[len(times)//2], 4),
+            'runs':[round(t, 4) for t in times],
+            }
+
+def bench_case(sdist, command, work_dir, bin_dir, n_runs, extra_args):
+    runs = [run_once(command, sdist, os.path.join(work_dir, 'run'),
+                     bin_dir, extra_args)
+            for i in range(n_runs)]
+    result = {'total':summarize([r['total'] for r in runs])}
+    for key in ['stages','commands']:
+        names = set()
+        for r in runs:
+            names.update(r[key].keys())
+        result[key] = dict([(name, summarize([r[key].get(name, 0.0)
+                                              for r in runs]))
+                            for name in names])
+    return result
+
+def get_revision():
+    try:
+        pipe = subprocess.Popen(['git','rev-parse','HEAD'], cwd=TOP,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out = pipe.communicate()[0]
+    except OSError:
+        return None
+    if pipe.returncode:
+        return None
+    return out.strip()
+
+def print_case(name, command, result):
+    print '%-26s %-9s %9.3f %9.3f'%(name, command,
+                                     result['total']['min'],
+                                     result['total']['median'])
+    for key in ['stages','commands']:
+        items = result[key].items()
+        items.sort(key=lambda item: -item[1]['median'])
+        for stage, times in items:
+            print '  %-33s %9.3f %9.3f'%('%s %s'%(key[:-1], stage),
+                                         times['min'], times['median'])
+
+def compare(old, new):
+    """print the medians of the results old and new side by side"""
+    print
+    print 'compared with %s (stdeb %s)'%(old.get('revision'),
+                                          old.get('stdeb_version'))
+    print '%-44s %9s %9s %7s'%('median (s)','old','new','new/old')
+    old_cases = dict([(c['name'], c) for c in old['cases']])
+    for case in new['cases']:
+        old_case = old_cases.get(case['name'])
+        if old_case is None:
+            continue
+        for command in ['py2dsc','sdist_dsc']:
+            if command not in case or command not in old_case:
+                continue
+            rows = [('', case[command]['total'],
+                     old_case[command]['total'])]
+            for stage in sorted(case[command]['stages']):
+                if stage in old_case[command]['stages']:
+                    rows.append(('  '+stage,
+                                 case[command]['stages'][stage],
+                                 old_case[command]['stages'][stage]))
+            for label, new_times, old_times in rows:
+                ratio = old_times['median'] and \
+                        new_times['median']/old_times['median'] or 0.0
+                print '%-44s %9.3f %9.3f %7.2f'%(
+                    label or '%s %s'%(case['name'], command),
+                    old_times['median'], new_times['median'], ratio)
+
+def main():
+    parser = optparse.OptionParser(usage=USAGE)
+    parser.add_option('--sizes', default='tiny,10k',
+                      help='comma separated sizes, of %s [%%default]'%(
+                          ','.join(sorted(SIZES))))
+    parser.add_option('--formats', default=','.join(FORMATS),
+                      help='comma separated formats [%default]')
+    parser.add_option('--commands', default='py2dsc,sdist_dsc',
+                      help='what to run [%default]')
+    parser.add_option('--runs', type='int', default=3,
+                      help='runs of each case [%default]')
+    parser.add_option('--use-dpkg-source', action='store_true',
+                      help='build with the (fake) dpkg-source')
+    parser.add_option('--json', metavar='FILE',
+                      help='write the results to FILE')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare with the results in FILE')
+    parser.add_option('--work-dir', metavar='DIR',
+                      help='keep (and reuse) the sdists in DIR')
+    options, args = parser.parse_args()
+    if args:
+        parser.print_usage()
+        return 1
+    sizes = options.sizes.split(',')
+    formats = options.formats.split(',')
+    commands = options.commands.split(',')
+    for value, allowed in [(sizes, SIZES), (formats, FORMATS),
+                           (commands, ['py2dsc','sdist_dsc'])]:
+        for v in value:
+            if v not in allowed:
+                parser.error('unknown value %r'%v)
+    extra_args = []
+    if options.use_dpkg_source:
+        extra_args.append('--use-dpkg-source')
+
+    if options.work_dir is not None:
+        work_dir = os.path.abspath(options.work_dir)
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+    else:
+        work_dir = tempfile.mkdtemp()
+    bin_dir = tempfile.mkdtemp()
+    os.rmdir(bin_dir)
+    results = {'stdeb_version':stdeb.__version__,
+               'revision':get_revision(),
+               'python':sys.version.split()[0],
+               'use_dpkg_source':bool(options.use_dpkg_source),
+               'runs':options.runs,
+               'cases':[]}
+    failed = 0
+    try:
+        write_fake_tools(bin_dir)
+        print '%-26s %-9s %9s %9s'%('case','command','min (s)','median (s)')
+        for size in sizes:
+            for format in formats:
+                for requires in [False, True]:
+                    start = time.time()
+                    sdist = make_sdist(work_dir, size, format, requires)
+                    case = {'name':'%s-%s%s'%(size, format,
+                                              requires and '-requires' or ''),
+                            'size':size,
+                            'format':format,
+                            'requires':requires,
+                            'sdist_bytes':os.path.getsize(sdist),
+                            'generate':round(time.time()-start, 4)}
+                    for command in commands:
+                        try:
+                            case[command] = bench_case(
+                                sdist, command, work_dir, bin_dir,
+                                options.runs, extra_args)
+                        except RuntimeError, err:
+                            print 'FAILED: %s'%err
+                            failed = 1
+                            continue
+                        print_case(case['name'], command, case[command])
+                    results['cases'].append(case)
+    finally:
+        shutil.rmtree(bin_dir)
+        if options.work_dir is None:
+            shutil.rmtree(work_dir)
+        elif os.path.exists(os.path.join(work_dir, 'run')):
+            shutil.rmtree(os.path.join(work_dir, 'run'))
+    if options.json is not None:
+        fd = open(options.json, mode='w')
+        try:
+            json.dump(results, fd, indent=2, sort_keys=True)
+            fd.write('\n')
+        finally:
+            fd.close()
+    if options.compare is not None:
+        fd = open(options.compare)
+        try:
+            compare(json.load(fd), results)
+        finally:
+            fd.close()
+    return failed
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+USAGE = """\
+usage: bench_make_tarball.py [total_MiB [n_files]]
+
+Compare the throughput of "/bin/tar czf" with stdeb.archive.make_tarball()
+at several compression levels and thread counts on a generated source
+tree (200 MiB in 2000 files by default).
+"""
+
+import sys, os, time, shutil, random, tempfile, subprocess
+from stdeb.archive import make_tarball
+from stdeb.process import get_cpu_count
+
+def make_tree(top, total_bytes, n_files):
+    rng = random.Random(0)
+    # compressible, source-like content
+    words = ['def','return','self','import','class','if','else','for',
+             'in','None','True','(',')',':','=','\n    ','\n']
+    chunk = ' '.join([rng.choice(words) for i in range(200000)])
+    per_file = total_bytes // n_files
+    for i in range(n_files):
+        dirname = os.path.join(top, 'pkg%d'%(i%50))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        fd = open(os.path.join(dirname,'mod%d.py'%i),mode='w')
+        try:
+            written = 0
+            while written < per_file:
+                start = rng.randint(0, len(chunk)//2)
+                data = chunk[start:start+per_file-written]
+                fd.write(data)
+                written += len(data)
+        finally:
+            fd.close()
+
+def tree_size(top):
+    total = 0
+    for root, dirs, files in os.walk(top):
+        for name in files:
+            total += os.path.getsize(os.path.join(root,name))
+    return total
+
+def main():
+    if len(sys.argv) > 3:
+        print USAGE
+        return 1
+    total_mb = 200
+    n_files = 2000
+    if len(sys.argv) > 1:
+        total_mb = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        n_files = int(sys.argv[2])
+    work_dir = tempfile.mkdtemp()
+    try:
+        make_tree(os.path.join(work_dir,'tree'), total_mb*1024*1024, n_files)
+        nbytes = tree_size(os.path.join(work_dir,'tree'))
+        cpus = get_cpu_count()
+
+        cases = [('/bin/tar czf', None, None)]
+        for level in [1, 6, 9]:
+            for threads in sorted(set([1, cpus])):
+                cases.append(('make_tarball', level, threads))
+
+        print '%d MiB in %d files, %d CPU(s)'%(nbytes//(1024*1024),
+                                                n_files, cpus)
+        print '%-14s %5s %7s %9s %10s %10s'%('method','level','threads',
+                                             'time (s)','MiB/s','size (MiB)')
+        for method, level, threads in cases:
+            out = os.path.join(work_dir,'out.tar.gz')
+            if os.path.exists(out):
+                os.unlink(out)
+            start = time.time()
+            if level is None:
+                subprocess.check_call(['/bin/tar','czf',out,'tree'],
+                                      cwd=work_dir)
+            else:
+                make_tarball(out,'tree',cwd=work_dir,
+                             compresslevel=level,threads=threads)
+            dur = time.time()-start
+            print '%-14s %5s %7s %9.3f %10.1f %10.1f'%(
+                method, level or '-', threads or '-', dur,
+                nbytes/dur/(1024*1024), os.path.getsize(out)/(1024.0*1024))
+    finally:
+        shutil.rmtree(work_dir)
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+USAGE = """\
+usage: bench_startup.py [n_runs [max_help_ms]]
+
+Measure the startup cost of stdeb's entry points: cold imports of the
+stdeb modules and the latency of "py2dsc --help" and "stdeb-daemon
+--help", each in a new Python interpreter (7 runs by default, the
+minimum and median are reported).
+
+Also checks that these entry points do not load setuptools or
+pkg_resources, which take longer to import than the rest of py2dsc's
+startup, and that "py2dsc --help" takes at most max_help_ms if
+given. The exit status is 1 if any check fails.
+"""
+
+import sys, os, time, subprocess
+
+HEAVY_MODULES = ['setuptools','pkg_resources']
+
+# (label, code run in the new interpreter, must not load HEAVY_MODULES)
+CASES = [
+    ('python', 'pass', True),
+    ('import setuptools', 'import setuptools', False),
+    ('import stdeb', 'import stdeb', True),
+    ('import stdeb.util', 'import stdeb.util', True),
+    ('import stdeb.py2dsc', 'import stdeb.py2dsc', True),
+    ('import stdeb.daemon', 'import stdeb.daemon', True),
+    ('import sdist_dsc', 'import stdeb.command.sdist_dsc', False),
+    ('py2dsc --help',
+     "import sys; sys.argv = ['py2dsc','--help']\n"
+     "from stdeb.py2dsc import runit; runit()", True),
+    ('stdeb-daemon --help',
+     "import sys; sys.argv = ['stdeb-daemon','--help']\n"
+     "from stdeb.daemon import main\n"
+     "try:\n    main()\nexcept SystemExit:\n    pass", True),
+    ]
+
+MARKER = '--- loaded:'
+
+def get_env():
+    env = dict(os.environ)
+    top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [top] + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+def time_code(code, n_runs, env):
+    """return the wall times of running code in n_runs new interpreters"""
+    devnull = open(os.devnull, 'w')
+    try:
+        times = []
+        for i in range(n_runs):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', code], env=env,
+                                  stdout=devnull, stderr=devnull)
+            times.append(time.time()-start)
+    finally:
+        devnull.close()
+    times.sort()
+    return times
+
+def get_heavy_modules(code, env):
+    """return which of HEAVY_MODULES running code loads"""
+    check = code + ("\nimport sys\nprint %r, ' '.join([name for name in %r "
+                    "if name in sys.modules])"%(MARKER, HEAVY_MODULES))
+    proc = subprocess.Popen([sys.executable, '-c', check], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out = proc.communicate()[0]
+    for line in out.splitlines():
+        if line.startswith(MARKER):
+            return line[len(MARKER):].split()
+    raise RuntimeError('no report from %r'%code)
+
+def main():
+    if len(sys.argv) > 3:
+        print USAGE
+        return 1
+    n_runs = 7
+    max_help_ms = None
+    if len(sys.argv) > 1:
+        n_runs = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        max_help_ms = float(sys.argv[2])
+    env = get_env()
+
+    failed = []
+    print '%-22s %9s %9s  %s'%('case','min (ms)','med (ms)','loads')
+    for label, code, must_be_light in CASES:
+        times = time_code(code, n_runs, env)
+        heavy = get_heavy_modules(code, env)
+        print '%-22s %9.1f %9.1f  %s'%(label, times[0]*1000,
+                                       times[len(times)//2]*1000,
+                                       ' '.join(heavy) or '-')
+        if must_be_light and heavy:
+            failed.append('%s loads %s'%(label, ', '.join(heavy)))
+        if (label == 'py2dsc --help' and max_help_ms is not None and
+            times[len(times)//2]*1000 > max_help_ms):
+            failed.append('%s takes %.1f ms (at most %.1f ms expected)'%(
+                label, times[len(times)//2]*1000, max_help_ms))
+    for msg in failed:
+        print 'FAILED: %s'%msg
+    if failed:
+        return 1
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
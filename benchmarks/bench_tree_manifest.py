@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+USAGE = """\
+usage: bench_tree_manifest.py [n_files]
+
+Stage a generated source tree (100000 small files by default) the way
+sdist_dsc used to (copytree, a walk to remove .pyc files and .svn
+directories, a walk to check for .pyc files and a walk to write the
+tarball) and the way it does now (one TreeManifest scan consumed by
+every stage), and report the time, directory listings and stat calls
+of each stage.
+"""
+
+import sys, os, time, shutil, tempfile, tarfile
+from stdeb.tree import TreeManifest, clone_tree, DIRECTORY
+from stdeb.archive import make_tarball
+
+class SyscallCounter:
+    """count calls of os.listdir, os.lstat and os.stat"""
+    names = ['listdir','lstat','stat']
+
+    def __init__(self):
+        self.counts = dict([(name, 0) for name in self.names])
+        self.saved = {}
+
+    def install(self):
+        for name in self.names:
+            orig = getattr(os, name)
+            self.saved[name] = orig
+            setattr(os, name, self._wrap(name, orig))
+        # scandir would bypass os.listdir, count what it replaces
+        import stdeb.tree
+        self.saved_scandir = stdeb.tree.scandir
+        stdeb.tree.scandir = None
+
+    def uninstall(self):
+        for name, orig in self.saved.items():
+            setattr(os, name, orig)
+        import stdeb.tree
+        stdeb.tree.scandir = self.saved_scandir
+
+    def _wrap(self, name, orig):
+        counts = self.counts
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return orig(*args, **kwargs)
+        return wrapper
+
+def make_tree(top, n_files):
+    files_per_dir = 100
+    for i in range(n_files):
+        dirname = os.path.join(top, 'pkg%d'%(i//(files_per_dir*10)),
+                               'sub%d'%(i//files_per_dir))
+        if i % files_per_dir == 0:
+            os.makedirs(dirname)
+            if i % (files_per_dir*50) == 0:
+                os.makedirs(os.path.join(dirname,'.svn'))
+        if i % 10 == 9:
+            fname = 'mod%d.pyc'%i
+        else:
+            fname = 'mod%d.py'%i
+        fd = open(os.path.join(dirname, fname),mode='w')
+        try:
+            fd.write('# module %d\nVALUE = %d\n'%(i, i))
+        finally:
+            fd.close()
+
+def _old_add_tree(tar, path, arcname):
+    tar.add(path, arcname, recursive=False)
+    if os.path.isdir(path) and not os.path.islink(path):
+        names = os.listdir(path)
+        names.sort()
+        for name in names:
+            _old_add_tree(tar, os.path.join(path, name), arcname+'/'+name)
+
+def old_stages(src, work_dir):
+    staged = os.path.join(work_dir, 'old', 'pkg-1.0')
+    def copy():
+        shutil.copytree(src, staged, symlinks=True)
+    def remove_excluded():
+        for root, dirs, files in os.walk(staged):
+            for name in files:
+                if name.endswith('.pyc'):
+                    os.unlink(os.path.join(root,name))
+            for name in dirs:
+                if name == '.svn':
+                    shutil.rmtree(os.path.join(root,name))
+    def check_pyc():
+        for root, dirs, files in os.walk(staged):
+            for name in files:
+                if name.endswith('.pyc'):
+                    raise RuntimeError('unexpected .pyc file')
+    def write_tarball():
+        tar = tarfile.open(os.path.join(work_dir,'old.tar.gz'), 'w:gz',
+                           compresslevel=1)
+        try:
+            _old_add_tree(tar, staged, 'pkg-1.0')
+        finally:
+            tar.close()
+    return [('copy', copy), ('exclude', remove_excluded),
+            ('check .pyc', check_pyc), ('tarball', write_tarball)]
+
+def new_stages(src, work_dir):
+    staged = os.path.join(work_dir, 'new', 'pkg-1.0')
+    state = {}
+    def exclude(path, type):
+        name = path.split('/')[-1]
+        if type == DIRECTORY:
+            return name == '.svn'
+        return name.endswith('.pyc')
+    def scan():
+        state['manifest'] = TreeManifest.scan(src, exclude=exclude)
+    def copy():
+        clone_tree(src, staged, manifest=state['manifest'])
+    def check_pyc():
+        for entry in state['manifest'].files():
+            if entry.path.endswith('.pyc'):
+                raise RuntimeError('unexpected .pyc file')
+    def write_tarball():
+        make_tarball('new.tar.gz', os.path.join('new','pkg-1.0'),
+                     cwd=work_dir, compresslevel=1,
+                     manifest=state['manifest'])
+    return [('scan', scan), ('copy', copy), ('check .pyc', check_pyc),
+            ('tarball', write_tarball)]
+
+# both tarballs use compression level 1, to keep the comparison about
+# traversal rather than compression
+
+def run_stages(label, stages):
+    print '%-6s %-12s %9s %9s %9s %9s'%(label,'stage','time (s)',
+                                        'listdir','lstat','stat')
+    totals = [0.0, 0, 0, 0]
+    for name, func in stages:
+        counter = SyscallCounter()
+        counter.install()
+        try:
+            start = time.time()
+            func()
+            dur = time.time()-start
+        finally:
+            counter.uninstall()
+        counts = counter.counts
+        print '%-6s %-12s %9.3f %9d %9d %9d'%('', name, dur, counts['listdir'],
+                                              counts['lstat'], counts['stat'])
+        totals[0] += dur
+        totals[1] += counts['listdir']
+        totals[2] += counts['lstat']
+        totals[3] += counts['stat']
+    print '%-6s %-12s %9.3f %9d %9d %9d'%(('', 'total')+tuple(totals))
+
+def main():
+    if len(sys.argv) > 2:
+        print USAGE
+        return 1
+    n_files = 100000
+    if len(sys.argv) > 1:
+        n_files = int(sys.argv[1])
+    work_dir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(work_dir, 'src')
+        make_tree(src, n_files)
+        print '%d files'%n_files
+        run_stages('old', old_stages(src, work_dir))
+        run_stages('new', new_stages(src, work_dir))
+    finally:
+        shutil.rmtree(work_dir)
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
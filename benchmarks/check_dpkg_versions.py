@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+USAGE = """\
+usage: check_dpkg_versions.py [n_pairs [seed]]
+
+Cross-check stdeb.dpkg.compare_versions() against
+"dpkg --compare-versions" on randomly generated pairs of Debian
+versions (2000 pairs by default), then time both.
+"""
+
+import sys, random, subprocess, time
+from stdeb.dpkg import compare_versions
+
+DPKG = '/usr/bin/dpkg'
+OPS = ['lt','le','eq','ne','ge','gt']
+
+def random_part(rng, alphabet):
+    n = rng.randint(1,4)
+    chunks = []
+    for i in range(n):
+        if rng.random() < 0.6:
+            chunks.append(str(rng.choice([0,0,1,2,9,10,100,'00','01'])))
+        else:
+            chunks.append(rng.choice(alphabet))
+    return ''.join(chunks)
+
+def random_version(rng):
+    upstream = '%d%s'%(rng.randint(0,3),
+                       random_part(rng, ['.','.','~','+','a','b','rc','~rc',
+                                         'dev','-']))
+    version = upstream
+    if '-' in upstream or rng.random() < 0.5:
+        version += '-' + random_part(rng, ['.','~','+','ubuntu','a'])
+    if rng.random() < 0.2:
+        version = '%d:%s'%(rng.randint(0,2), version)
+    return version
+
+def dpkg_says(v1, op, v2):
+    return subprocess.call([DPKG,'--compare-versions',v1,op,v2]) == 0
+
+def main():
+    if len(sys.argv) > 3:
+        print USAGE
+        return 1
+    n_pairs = 2000
+    seed = 0
+    if len(sys.argv) > 1:
+        n_pairs = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        seed = int(sys.argv[2])
+    rng = random.Random(seed)
+    pairs = []
+    for i in range(n_pairs):
+        v1 = random_version(rng)
+        if rng.random() < 0.1:
+            v2 = v1
+        else:
+            v2 = random_version(rng)
+        pairs.append((v1, rng.choice(OPS), v2))
+
+    failures = 0
+    start = time.time()
+    expected = [dpkg_says(v1,op,v2) for (v1,op,v2) in pairs]
+    dpkg_dur = time.time()-start
+
+    start = time.time()
+    actual = [compare_versions(v1,op,v2) for (v1,op,v2) in pairs]
+    stdeb_dur = time.time()-start
+
+    for (v1,op,v2), e, a in zip(pairs, expected, actual):
+        if e != a:
+            failures += 1
+            print 'MISMATCH: %s %s %s: dpkg says %s, stdeb says %s'%(
+                v1, op, v2, e, a)
+    print '%d pairs, %d mismatches'%(n_pairs, failures)
+    print 'dpkg --compare-versions: %8.3f sec'%dpkg_dur
+    print 'stdeb.dpkg:              %8.3f sec'%stdeb_dur
+    if failures:
+        return 1
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
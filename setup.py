@@ -22,6 +22,7 @@ of the resulting package can be customized via a configuration file.""",
                               'bdist_deb = stdeb.command.bdist_deb:bdist_deb',
                               ],
         'console_scripts':['py2dsc = stdeb.py2dsc:main',
-                           'stdeb_run_setup = stdeb.stdeb_run_setup:main']
+                           'stdeb_run_setup = stdeb.stdeb_run_setup:main',
+                           'stdeb-daemon = stdeb.daemon:main']
       },
 )
@@ -1,6 +1,8 @@
-# setuptools is required for distutils.commands plugin we use
+# setuptools is required for the distutils.commands plugin we use. It
+# takes longer to import than everything else py2dsc does to start,
+# so it is not imported here: whatever runs a setup.py that may not
+# use setuptools itself imports it first (see stdeb_run_setup).
 import logging
-import setuptools
 __version__ = '0.4.2'
 
 log = logging.getLogger('stdeb')
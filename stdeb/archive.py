@@ -0,0 +1,780 @@
+#
+# In-process creation and extraction of source archives.
+#
+# This uses the tarfile and zipfile modules instead of running tar and
+# unzip. Archives are read in a single pass (tar headers are read as
+# the members are extracted, the zip central directory is read once)
+# and every member is checked to stay inside the destination
+# directory.
+#
+import os, stat, time, shutil, tempfile, tarfile, zipfile, zlib, struct
+import collections, fcntl
+from multiprocessing.pool import ThreadPool
+import cPickle as pickle
+from stdeb.process import get_cpu_count
+from stdeb.tree import clone_tree, hash_file, TreeManifest, FILE
+
+__all__ = ['expand_tarball','expand_zip','make_tarball','get_top_dirname',
+           'get_archive_names','get_archive_top_dirname','ParallelGzipFile',
+           'repack_as_tar_gz','expand_archive','ExtractionCache',
+           'ArchiveError']
+
+class ArchiveError(RuntimeError): pass
+
+COPY_BUFSIZE = 1024*1024
+
+# gzip compression level used for generated tarballs (the default of
+# gzip and "tar czf")
+DEFAULT_COMPRESSLEVEL = 6
+
+def _compress_block(data, compresslevel, last):
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                  -zlib.MAX_WBITS)
+    if last:
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH)
+    # end on a byte boundary so that the next block can be appended
+    return compressor.compress(data) + compressor.flush(zlib.Z_FULL_FLUSH)
+
+class ParallelGzipFile:
+    """write-only file object producing a gzip stream using several threads
+
+    Like pigz, the data is cut into fixed-size blocks which are
+    deflated independently (zlib releases the GIL while compressing)
+    and concatenated into a single standard gzip member. The output
+    depends only on the data, the compression level and the block
+    size, not on the number of threads. At most 2*threads blocks are
+    in memory at any time.
+    """
+    def __init__(self, fname, compresslevel=DEFAULT_COMPRESSLEVEL,
+                 threads=None, blocksize=COPY_BUFSIZE):
+        if threads is None:
+            threads = get_cpu_count()
+        self.fileobj = open(fname,mode='wb')
+        self.compresslevel = compresslevel
+        self.blocksize = blocksize
+        self.threads = threads
+        if threads > 1:
+            self.pool = ThreadPool(threads)
+        else:
+            self.pool = None
+        self.pending = collections.deque()
+        self.buf = []
+        self.buflen = 0
+        self.crc = zlib.crc32('')
+        self.size = 0
+        self.closed = False
+        self._write_header()
+
+    def _write_header(self):
+        if self.compresslevel == 9:
+            xfl = 2 # maximum compression
+        elif self.compresslevel == 1:
+            xfl = 4 # fastest compression
+        else:
+            xfl = 0
+        # magic, deflate, no flags, mtime 0 (reproducible), xfl, Unix
+        self.fileobj.write(struct.pack('<BBBBIBB',0x1f,0x8b,8,0,0,xfl,3))
+
+    def tell(self):
+        return self.size
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed file')
+        if not data:
+            return
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.buf.append(data)
+        self.buflen += len(data)
+        if self.buflen >= self.blocksize:
+            data = ''.join(self.buf)
+            n_blocks = len(data)//self.blocksize
+            for i in range(n_blocks):
+                self._submit(data[i*self.blocksize:(i+1)*self.blocksize],
+                             False)
+            rest = data[n_blocks*self.blocksize:]
+            self.buf = [rest]
+            self.buflen = len(rest)
+
+    def _submit(self, block, last):
+        if self.pool is None:
+            self.fileobj.write(_compress_block(block,self.compresslevel,last))
+            return
+        self.pending.append(self.pool.apply_async(
+            _compress_block, (block, self.compresslevel, last)))
+        while len(self.pending) > 2*self.threads:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(''.join(self.buf), True)
+            self.buf = []
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().get())
+            self.fileobj.write(struct.pack('<II', self.crc & 0xffffffffL,
+                                           self.size & 0xffffffffL))
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+            self.fileobj.close()
+
+class _CompressedTarFile(tarfile.TarFile):
+    """TarFile which also closes the compressing file object it writes to"""
+    def close(self):
+        try:
+            tarfile.TarFile.close(self)
+        finally:
+            self.fileobj.close()
+
+def open_output_tarball(fname, compresslevel=DEFAULT_COMPRESSLEVEL,
+                        threads=None):
+    """open tarball fname for writing, compressing according to its name
+
+    .gz files are compressed with ParallelGzipFile, .bz2 files with
+    tarfile's own bz2 support.
+    """
+    if fname.endswith('.gz'):
+        fileobj = ParallelGzipFile(fname, compresslevel=compresslevel,
+                                   threads=threads)
+        try:
+            return _CompressedTarFile(fileobj=fileobj, mode='w')
+        except:
+            fileobj.close()
+            raise
+    elif fname.endswith('.bz2'):
+        return tarfile.open(fname, 'w:bz2', compresslevel=compresslevel)
+    else:
+        return tarfile.open(fname, 'w')
+
+def _open_xz(fname):
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise ArchiveError('cannot open %s: the lzma module (backports.lzma '
+                               'on Python 2) is required for .xz files'%fname)
+    return lzma.LZMAFile(fname,mode='rb')
+
+def open_tarball(tarball_fname, stream=True):
+    """open a (possibly gz, bz2 or xz compressed) tarball for reading
+
+    With stream=True, the tarball is read strictly sequentially, so
+    each member must be processed as it is iterated over.
+    """
+    if stream:
+        mode = 'r|*'
+    else:
+        mode = 'r:*'
+    lower = tarball_fname.lower()
+    if lower.endswith('.xz') or lower.endswith('.txz'):
+        return tarfile.open(fileobj=_open_xz(tarball_fname), mode=mode[:2])
+    return tarfile.open(tarball_fname, mode=mode)
+
+def _check_path(dest, name):
+    """return the path of member name in dest, refusing to leave dest"""
+    if os.path.isabs(name):
+        raise ArchiveError('refusing to extract absolute path %r'%name)
+    parts = name.replace('\\','/').split('/')
+    if '..' in parts:
+        raise ArchiveError('refusing to extract path with ".." %r'%name)
+    path = os.path.join(dest, name)
+    # also refuse to write through symlinks created by earlier members
+    real_dest = os.path.realpath(dest)
+    real_parent = os.path.realpath(os.path.dirname(os.path.normpath(path)))
+    if (real_parent != real_dest and
+        not real_parent.startswith(real_dest+os.sep)):
+        raise ArchiveError('refusing to extract %r outside of %s'%(name,dest))
+    return path
+
+def _check_link(dest, path, target):
+    """refuse a symlink at path to target which leaves dest"""
+    real_dest = os.path.realpath(dest)
+    real_target = os.path.realpath(os.path.join(os.path.dirname(path),
+                                                target))
+    if (real_target != real_dest and
+        not real_target.startswith(real_dest+os.sep)):
+        raise ArchiveError('refusing to extract symlink %s to %r outside '
+                           'of %s'%(path, target, dest))
+
+def _normalize_name(name):
+    """return member name without leading "./" ("" for the "." entry)"""
+    while name.startswith('./'):
+        name = name[2:]
+    if name == '.':
+        return ''
+    return name
+
+def get_top_dirname(names):
+    """return the single top-level directory of names, or None"""
+    tops = set()
+    for name in names:
+        name = _normalize_name(name)
+        if not name:
+            continue
+        top, sep, rest = name.partition('/')
+        if not sep:
+            # a file (or an entry without trailing slash) at top level
+            return None
+        tops.add(top)
+        if len(tops) > 1:
+            return None
+    if len(tops) == 1:
+        return tops.pop()
+    return None
+
+def _checked_tar_members(tar, dest):
+    for member in tar:
+        path = _check_path(dest, member.name)
+        if member.islnk():
+            _check_path(dest, member.linkname)
+        elif member.issym():
+            _check_link(dest, path, member.linkname)
+        elif not (member.isfile() or member.isdir()):
+            # devices, fifos etc. have no place in a source archive
+            continue
+        if os.path.islink(path):
+            if member.isdir():
+                # its mode and mtime would be set through the symlink
+                raise ArchiveError('refusing to extract directory %r over '
+                                   'a symlink'%member.name)
+            # tarfile would write through the symlink an earlier
+            # member made
+            os.unlink(path)
+        yield member
+
+def expand_tarball(tarball_fname,cwd=None):
+    "expand a tarball"
+    if cwd is None:
+        cwd = os.curdir
+    tar = open_tarball(tarball_fname)
+    try:
+        tar.extractall(cwd, members=_checked_tar_members(tar, cwd))
+    finally:
+        tar.close()
+
+def _zip_member_mode(info):
+    if info.create_system != 3:
+        # not made on Unix, so there are no permissions to restore
+        return 0
+    return info.external_attr >> 16
+
+def expand_zip(zip_fname,cwd=None):
+    "expand a zip"
+    if cwd is None:
+        cwd = os.curdir
+    zf = zipfile.ZipFile(zip_fname)
+    try:
+        infos = zf.infolist()
+        if get_top_dirname([info.filename for info in infos]) is None:
+            # no top dir, make one (like unzip -d)
+            base = os.path.basename(zip_fname)
+            if base.lower().endswith('.zip'):
+                base = base[:-4]
+            dest = os.path.join(cwd, base)
+            if not os.path.exists(dest):
+                os.makedirs(dest)
+        else:
+            dest = cwd
+        directories = []
+        for info in infos:
+            path = _check_path(dest, info.filename)
+            mode = _zip_member_mode(info)
+            if info.filename.endswith('/') or stat.S_ISDIR(mode):
+                if os.path.islink(path):
+                    raise ArchiveError('refusing to extract directory %r '
+                                       'over a symlink'%info.filename)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+                directories.append((path, info))
+                continue
+            parent = os.path.dirname(path)
+            if parent and not os.path.isdir(parent):
+                os.makedirs(parent)
+            if os.path.lexists(path):
+                os.unlink(path)
+            if stat.S_ISLNK(mode):
+                target = zf.read(info.filename)
+                _check_link(dest, path, target)
+                os.symlink(target, path)
+                continue
+            src = zf.open(info)
+            try:
+                dst = open(path,mode='wb')
+                try:
+                    shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+                finally:
+                    dst.close()
+            finally:
+                src.close()
+            _set_zip_attrs(path, info)
+        # as with tar, set directory attributes after their contents
+        directories.reverse()
+        for path, info in directories:
+            _set_zip_attrs(path, info)
+    finally:
+        zf.close()
+
+def _set_zip_attrs(path, info):
+    mode = stat.S_IMODE(_zip_member_mode(info))
+    if mode:
+        os.chmod(path, mode)
+    mtime = time.mktime(info.date_time + (0, 0, -1))
+    os.utime(path, (mtime, mtime))
+
+def make_tarball(tarball_fname,directory,cwd=None,
+                 compresslevel=DEFAULT_COMPRESSLEVEL,threads=None,
+                 manifest=None):
+    """create a tarball from a directory
+
+    manifest is a TreeManifest of the directory, if one was already
+    built. Members are added in the manifest's (sorted) order, for
+    reproducible tarballs.
+    """
+    if cwd is None:
+        cwd = os.curdir
+    path = os.path.join(cwd, directory)
+    if manifest is None:
+        manifest = TreeManifest.scan(path)
+    tar = open_output_tarball(os.path.join(cwd, tarball_fname),
+                              compresslevel=compresslevel, threads=threads)
+    try:
+        tar.add(path, directory, recursive=False)
+        for entry in manifest:
+            _add_entry(tar, os.path.join(path, entry.path),
+                       directory+'/'+entry.path, entry)
+    finally:
+        tar.close()
+
+_owner_names = {}
+
+def _get_owner_names(uid, gid):
+    try:
+        return _owner_names[uid, gid]
+    except KeyError:
+        pass
+    uname = gname = ''
+    try:
+        import pwd
+        uname = pwd.getpwuid(uid)[0]
+    except (ImportError, KeyError):
+        pass
+    try:
+        import grp
+        gname = grp.getgrgid(gid)[0]
+    except (ImportError, KeyError):
+        pass
+    _owner_names[uid, gid] = uname, gname
+    return uname, gname
+
+def _add_entry(tar, path, arcname, entry):
+    """like TarFile.add(path, arcname, recursive=False) without the lstat()"""
+    st = entry.st
+    tarinfo = tar.tarinfo()
+    tarinfo.tarfile = tar
+    tarinfo.name = arcname
+    tarinfo.mode = st.st_mode
+    tarinfo.uid = st.st_uid
+    tarinfo.gid = st.st_gid
+    tarinfo.uname, tarinfo.gname = _get_owner_names(st.st_uid, st.st_gid)
+    tarinfo.mtime = st.st_mtime
+    tarinfo.size = 0
+    inode = (st.st_ino, st.st_dev)
+    if entry.type == FILE:
+        if (st.st_nlink > 1 and inode in tar.inodes and
+            arcname != tar.inodes[inode]):
+            # a hardlink to a file already in the archive
+            tarinfo.type = tarfile.LNKTYPE
+            tarinfo.linkname = tar.inodes[inode]
+        else:
+            tarinfo.type = tarfile.REGTYPE
+            tarinfo.size = st.st_size
+            tar.inodes[inode] = arcname
+    elif stat.S_ISDIR(st.st_mode):
+        tarinfo.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(st.st_mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = entry.linkname
+    else:
+        # devices, fifos etc. are handled by tarfile itself
+        tar.add(path, arcname, recursive=False)
+        return
+    if tarinfo.type == tarfile.REGTYPE:
+        fd = open(path,mode='rb')
+        try:
+            tar.addfile(tarinfo, fd)
+        finally:
+            fd.close()
+    else:
+        tar.addfile(tarinfo)
+
+def _check_name(name):
+    """refuse member names which would escape the extraction directory"""
+    if os.path.isabs(name) or '..' in name.replace('\\','/').split('/'):
+        raise ArchiveError('refusing to repack unsafe path %r'%name)
+
+def _rename_top(name, old_top, new_top):
+    """return name with its top-level directory old_top replaced by new_top
+
+    name must be normalized and not empty. If old_top is None, the
+    archive has no top-level directory and new_top is prepended instead.
+    """
+    if old_top is None:
+        return new_top+'/'+name
+    top, sep, rest = name.partition('/')
+    if top != old_top:
+        raise ArchiveError('%r is not in the top-level directory %r'%(
+            name, old_top))
+    if not rest:
+        return new_top
+    return new_top+'/'+rest
+
+def get_archive_names(fname):
+    """return the member names of archive fname, without extracting it
+
+    The names of directories end with a slash, as in zip files.
+    """
+    if fname.lower().endswith('.zip'):
+        zf = zipfile.ZipFile(fname)
+        try:
+            return [info.filename for info in zf.infolist()]
+        finally:
+            zf.close()
+    tar = open_tarball(fname)
+    try:
+        # directory members have no trailing slash in tarballs
+        return [member.name.rstrip('/')+'/' if member.isdir() else member.name
+                for member in tar]
+    finally:
+        tar.close()
+
+def get_archive_top_dirname(fname):
+    """return the single top-level directory of archive fname, or None"""
+    return get_top_dirname(get_archive_names(fname))
+
+def _iter_tar_members(tar, old_top, new_top):
+    """yield (TarInfo, fileobj or None) with old_top renamed to new_top"""
+    for member in tar:
+        _check_name(member.name)
+        name = _normalize_name(member.name.rstrip('/'))
+        if not name:
+            continue # the "." entry
+        member.name = _rename_top(name, old_top, new_top)
+        if member.islnk():
+            _check_name(member.linkname)
+            member.linkname = _rename_top(_normalize_name(member.linkname),
+                                          old_top, new_top)
+        if member.isfile():
+            yield member, tar.extractfile(member)
+        elif member.isdir() or member.issym() or member.islnk():
+            yield member, None
+
+def _get_zip_mtime(info):
+    return time.mktime(info.date_time + (0, 0, -1))
+
+def _iter_zip_members(zf, old_top, new_top):
+    """yield (TarInfo, fileobj or None) for each zip member"""
+    infos = zf.infolist()
+    names = set([_normalize_name(info.filename.rstrip('/'))
+                 for info in infos])
+    if old_top is None or old_top not in names:
+        # the zip has no entry for the top directory, make one (with
+        # the newest mtime of its contents, so that repacking the same
+        # zip twice gives the same tarball)
+        tarinfo = tarfile.TarInfo(new_top)
+        tarinfo.type = tarfile.DIRTYPE
+        tarinfo.mode = 0755
+        tarinfo.mtime = max([_get_zip_mtime(info) for info in infos] or [0])
+        yield tarinfo, None
+    for info in infos:
+        _check_name(info.filename)
+        name = _normalize_name(info.filename.rstrip('/'))
+        if not name:
+            continue # the "." entry
+        mode = _zip_member_mode(info)
+        tarinfo = tarfile.TarInfo(_rename_top(name, old_top, new_top))
+        tarinfo.mtime = _get_zip_mtime(info)
+        if info.filename.endswith('/') or stat.S_ISDIR(mode):
+            tarinfo.type = tarfile.DIRTYPE
+            tarinfo.mode = stat.S_IMODE(mode) or 0755
+            yield tarinfo, None
+        elif stat.S_ISLNK(mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.mode = 0777
+            tarinfo.linkname = zf.read(info.filename)
+            yield tarinfo, None
+        else:
+            tarinfo.mode = stat.S_IMODE(mode) or 0644
+            tarinfo.size = info.file_size
+            fileobj = zf.open(info)
+            try:
+                yield tarinfo, fileobj
+            finally:
+                fileobj.close()
+
+def repack_as_tar_gz(src_fname, dest_fname, top_dirname,
+                     src_top_dirname=None,
+                     compresslevel=DEFAULT_COMPRESSLEVEL):
+    """copy archive src_fname to the gzipped tarball dest_fname
+
+    The top-level directory of every member is renamed to top_dirname
+    on the fly (or added, if the archive has none). Members are
+    streamed from one archive into the other, so nothing is extracted
+    to disk and memory use does not depend on the archive size. Modes,
+    mtimes and symlinks are preserved.
+
+    If src_top_dirname is given, it is the top-level directory of
+    src_fname, and ArchiveError is raised for members outside it.
+    Otherwise the top-level directory of a tarball is found by reading
+    it once more beforehand.
+    """
+    is_zip = src_fname.lower().endswith('.zip')
+    out = open_output_tarball(dest_fname, compresslevel=compresslevel)
+    try:
+        if is_zip:
+            zf = zipfile.ZipFile(src_fname)
+            try:
+                old_top = get_top_dirname([info.filename
+                                           for info in zf.infolist()])
+                if (src_top_dirname is not None and
+                    old_top != src_top_dirname):
+                    raise ArchiveError('%s has no top-level directory %r'%(
+                        src_fname, src_top_dirname))
+                for tarinfo, fileobj in _iter_zip_members(zf, old_top,
+                                                          top_dirname):
+                    out.addfile(tarinfo, fileobj)
+            finally:
+                zf.close()
+        else:
+            old_top = src_top_dirname
+            if old_top is None:
+                old_top = get_archive_top_dirname(src_fname)
+            tar = open_tarball(src_fname)
+            try:
+                for tarinfo, fileobj in _iter_tar_members(tar, old_top,
+                                                          top_dirname):
+                    out.addfile(tarinfo, fileobj)
+            finally:
+                tar.close()
+    finally:
+        out.close()
+
+def expand_archive(fname,cwd=None):
+    "expand a .zip, .tar.gz, .tgz, .tar.bz2 or .tar.xz file"
+    lower_fname = fname.lower()
+    if lower_fname.endswith('.zip'):
+        expand_zip(fname,cwd=cwd)
+    elif (lower_fname.endswith('.tar.gz') or
+          lower_fname.endswith('.tgz') or
+          lower_fname.endswith('.tar.bz2') or
+          lower_fname.endswith('.tar.xz')):
+        expand_tarball(fname,cwd=cwd)
+    else:
+        raise RuntimeError('could not guess format of original sdist file')
+
+class ExtractionCache:
+    """extracted archives, keyed by the hash of the archive's contents
+
+    Each archive is extracted once into the cache directory.
+    checkout() then gives every caller its own copy of the cached tree
+    (cloned with reflinks where the filesystem supports them), so that
+    setup.py can modify it freely. A tree is re-extracted if any of its
+    files was changed anyway (detected by comparing sizes, mtimes and
+    modes with those recorded at extraction time).
+
+    The least recently used trees are evicted when the total size
+    exceeds max_size bytes. A checkout holds a shared lock on the
+    entry it copies, and entries locked this way are not evicted.
+    """
+    def __init__(self, cache_dir, max_size, extract_func=expand_archive):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.extract_func = extract_func
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _read_size(self, entry_dir):
+        """return the size recorded for a cache entry, or None"""
+        # the size is pickled before the manifest so that it can be
+        # read without loading the manifest
+        try:
+            fd = open(os.path.join(entry_dir,'manifest.pickle'),mode='rb')
+            try:
+                size = pickle.load(fd)
+            finally:
+                fd.close()
+        except (EnvironmentError, ValueError, pickle.PickleError, EOFError):
+            return None
+        if not isinstance(size, (int, long)):
+            return None
+        return size
+
+    def _load_entry(self, entry_dir):
+        """return the TreeManifest of a valid cache entry, or None"""
+        manifest_fname = os.path.join(entry_dir,'manifest.pickle')
+        try:
+            fd = open(manifest_fname,mode='rb')
+            try:
+                size = pickle.load(fd)
+                manifest = pickle.load(fd)
+            finally:
+                fd.close()
+        except (EnvironmentError, ValueError, pickle.PickleError, EOFError,
+                AttributeError, ImportError):
+            return None
+        if not isinstance(manifest, TreeManifest):
+            return None
+        manifest.top = os.path.join(entry_dir,'tree')
+        if not manifest.is_unchanged():
+            return None
+        return manifest
+
+    def _lock_entry(self, entry_dir, exclusive):
+        """return an open file holding a lock on entry_dir, or None
+
+        A shared lock waits for an exclusive one; an exclusive lock is
+        not waited for. None is returned if entry_dir does not exist,
+        was removed meanwhile or (exclusive) is in use.
+        """
+        lock_fname = os.path.join(entry_dir,'lock')
+        try:
+            fd = open(lock_fname,mode='a')
+        except IOError:
+            return None
+        try:
+            if exclusive:
+                fcntl.flock(fd.fileno(), fcntl.LOCK_EX|fcntl.LOCK_NB)
+            else:
+                fcntl.flock(fd.fileno(), fcntl.LOCK_SH)
+            # the entry may have been removed (and made again) while
+            # waiting for the lock
+            if os.fstat(fd.fileno()).st_ino != os.stat(lock_fname).st_ino:
+                fd.close()
+                return None
+        except EnvironmentError:
+            fd.close()
+            return None
+        return fd
+
+    def _open_entry(self, key):
+        """return (TreeManifest, lock) of a valid entry, or (None, None)
+
+        The entry cannot be evicted until the lock is closed.
+        """
+        entry_dir = self._entry_dir(key)
+        lock = self._lock_entry(entry_dir, exclusive=False)
+        if lock is None:
+            return None, None
+        manifest = self._load_entry(entry_dir)
+        if manifest is None:
+            lock.close()
+            return None, None
+        os.utime(entry_dir, None) # mark as recently used
+        return manifest, lock
+
+    def _remove_entry(self, key):
+        """remove an entry nobody is using, return whether it was removed"""
+        entry_dir = self._entry_dir(key)
+        lock = self._lock_entry(entry_dir, exclusive=True)
+        if lock is None:
+            return False
+        try:
+            # move it out of the way before the (slow) removal, so that
+            # nobody finds it half removed
+            trash_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='tmp-')
+            try:
+                os.rename(entry_dir, os.path.join(trash_dir,key))
+            except OSError:
+                os.rmdir(trash_dir)
+                return False
+        finally:
+            lock.close()
+        shutil.rmtree(trash_dir, ignore_errors=True)
+        return True
+
+    def _extract(self, fname, key):
+        """extract fname into a new entry for key"""
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='tmp-')
+        try:
+            tree = os.path.join(tmp_dir,'tree')
+            os.mkdir(tree)
+            self.extract_func(os.path.abspath(fname), cwd=tree)
+            manifest = TreeManifest.scan(tree)
+            fd = open(os.path.join(tmp_dir,'manifest.pickle'),mode='wb')
+            try:
+                pickle.dump(manifest.get_total_size(), fd,
+                            pickle.HIGHEST_PROTOCOL)
+                pickle.dump(manifest, fd, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fd.close()
+            open(os.path.join(tmp_dir,'lock'),mode='a').close()
+            try:
+                os.rename(tmp_dir, self._entry_dir(key))
+            except OSError:
+                pass # another process extracted the same archive meanwhile
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def checkout(self, fname, cwd):
+        """expand archive fname into cwd, using the cached extraction
+
+        If the cache cannot be used (an invalid entry is still in use,
+        or the new one was evicted at once), fname is extracted into
+        cwd directly.
+        """
+        key = hash_file(fname)
+        manifest, lock = self._open_entry(key)
+        if manifest is None:
+            if (not os.path.exists(self._entry_dir(key)) or
+                self._remove_entry(key)):
+                self._extract(fname, key)
+                self.evict(keep=key)
+                manifest, lock = self._open_entry(key)
+        if manifest is None:
+            self.extract_func(os.path.abspath(fname), cwd=cwd)
+            return
+        try:
+            clone_tree(manifest.top, cwd, manifest=manifest)
+        finally:
+            lock.close()
+
+    def evict(self, keep=None):
+        """remove the least recently used entries over the size budget
+
+        Entries in use are skipped.
+        """
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            if key.startswith('tmp-'):
+                continue
+            entry_dir = self._entry_dir(key)
+            size = self._read_size(entry_dir)
+            if size is None:
+                # unreadable, or written by an older version of stdeb
+                self._remove_entry(key)
+                continue
+            try:
+                last_used = os.stat(entry_dir).st_mtime
+            except OSError:
+                continue
+            entries.append((last_used, key, size))
+            total += size
+        entries.sort()
+        for last_used, key, size in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            if self._remove_entry(key):
+                total -= size
@@ -1,33 +1,173 @@
-import os
+import os, time, traceback
 import stdeb.util as util
+from stdeb import log, process
 from stdeb.command.sdist_dsc import sdist_dsc
+from stdeb.depgraph import DependencyGraph, run_in_order
 
 __all__ = ['bdist_deb']
 
+BUILD_COMMAND = ['dpkg-buildpackage','-rfakeroot','-uc','-b']
+
+def get_source_dirs(dist_dir):
+    """return the expanded Debian source directories in dist_dir"""
+    result = []
+    for entry in sorted(os.listdir(dist_dir)):
+        fulldir = os.path.join(dist_dir,entry)
+        if os.path.isdir(os.path.join(fulldir,'debian')):
+            result.append(fulldir)
+    return result
+
+def get_build_env(parallel, env=None):
+    """return a copy of env (default os.environ) for dpkg-buildpackage
+
+    parallel=N is added to DEB_BUILD_OPTIONS unless it is already set
+    there.
+    """
+    if env is None:
+        env = os.environ
+    env = dict(env)
+    options = env.get('DEB_BUILD_OPTIONS','').split()
+    for option in options:
+        if option.startswith('parallel='):
+            break
+    else:
+        options.append('parallel=%d'%parallel)
+    env['DEB_BUILD_OPTIONS'] = ' '.join(options)
+    return env
+
+# set in the parent before the worker processes are forked
+_build_env = None
+
+def _build(source_dir):
+    """build the binary packages of source_dir, return a result dict"""
+    n_records = len(process.accounting.records)
+    start = time.time()
+    result = {'error':None}
+    try:
+        returncode = process.call(BUILD_COMMAND, cwd=source_dir,
+                                  env=_build_env)
+    except Exception, err:
+        log.error('ERROR building %s:\n%s', source_dir,
+                  traceback.format_exc())
+        returncode = 1
+        result['error'] = '%s: %s'%(err.__class__.__name__, err)
+    if returncode:
+        log.error('ERROR running: %s', ' '.join(BUILD_COMMAND))
+        log.error('ERROR in %s', source_dir)
+    result['returncode'] = returncode
+    result['duration'] = time.time()-start
+    # the accounting of this build, for the parent to merge
+    result['commands'] = [rec.as_dict() for rec in
+                          process.accounting.records[n_records:]]
+    return result
+
+def format_summary(results):
+    """format [(source_dir, result dict)] as a table"""
+    lines = ['%-40s %-8s %10s'%('source directory','result','time (s)')]
+    n_failed = 0
+    for source_dir, result in results:
+        if result['returncode']:
+            status = 'FAILED'
+            n_failed += 1
+        else:
+            status = 'ok'
+        lines.append('%-40s %-8s %10.1f'%(os.path.basename(source_dir),
+                                          status, result['duration']))
+        if result['error'] is not None:
+            lines.append('    %s'%result['error'])
+    lines.append('%d built, %d failed'%(len(results)-n_failed, n_failed))
+    return '\n'.join(lines)
+
+def build_binary_packages(source_dirs, jobs=1, parallel=None):
+    """run dpkg-buildpackage in every source dir, jobs of them at once
+
+    Each build is told to use parallel cores through DEB_BUILD_OPTIONS
+    (by default, the number of CPUs shared between the jobs). Returns
+    {source_dir: result dict}.
+    """
+    global _build_env
+    jobs = max(1, min(jobs, len(source_dirs)))
+    if parallel is None:
+        parallel = max(1, process.get_cpu_count() // jobs)
+    graph = DependencyGraph()
+    for source_dir in source_dirs:
+        graph.add_node(source_dir)
+    log.info('building %d binary package(s), %d at a time, '
+             'each with parallel=%d', len(source_dirs), jobs, parallel)
+    _build_env = get_build_env(parallel)
+    try:
+        results = run_in_order(graph, _build, jobs=jobs)
+    finally:
+        _build_env = None
+    if jobs > 1:
+        for result in results.itervalues():
+            for rec in result['commands']:
+                process.accounting.add(process.CommandRecord.from_dict(rec))
+    return results
+
 class bdist_deb(sdist_dsc):
     description = 'distutils command to create debian binary package'
 
+    user_options = sdist_dsc.user_options + [
+        ('jobs=', 'j',
+         'number of binary packages to build at once (default=1)'),
+        ('parallel=', None,
+         'number of jobs each dpkg-buildpackage may run, passed in '
+         'DEB_BUILD_OPTIONS (default: the number of CPUs divided by jobs)'),
+        ('all-source-dirs', None,
+         'build every expanded source directory in dist-dir, not only '
+         'the one just made'),
+        ]
+
+    boolean_options = sdist_dsc.boolean_options + ['all-source-dirs']
+
+    def initialize_options(self):
+        sdist_dsc.initialize_options(self)
+        self.jobs = None
+        self.parallel = None
+        self.all_source_dirs = 0
+
+    def finalize_options(self):
+        sdist_dsc.finalize_options(self)
+        if self.jobs is None:
+            self.jobs = 1
+        else:
+            self.jobs = int(self.jobs)
+        if self.parallel is not None:
+            self.parallel = int(self.parallel)
+        if self.jobs < 1 or (self.parallel is not None and self.parallel < 1):
+            raise ValueError('jobs and parallel must be at least 1')
+
     # extend the run method
     def run(self):
+        # report on the external commands once everything is done,
+        # not at the end of sdist_dsc.run()
+        report_subprocesses = self.report_subprocesses
+        self.report_subprocesses = None
+
         # call parent run() method to generate .dsc source pkg
-	sdist_dsc.run(self)
-
-        # execute system command and read output (execute and read output of find cmd)
-        dsc_tree = 'deb_dist'
-        target_dir = None
-        for entry in os.listdir(dsc_tree):
-            fulldir = os.path.join(dsc_tree,entry)
-            if os.path.isdir(fulldir):
-                if target_dir is not None:
-                    raise ValueError('more than one directory in deb_dist. '
-                                     'Unsure which is source directory')
-                else:
-                    target_dir = fulldir
-        if target_dir is None:
+        sdist_dsc.run(self)
+
+        if self.all_source_dirs:
+            source_dirs = get_source_dirs(self.dist_dir)
+        elif self.source_dir is not None:
+            source_dirs = [self.source_dir]
+        else:
+            source_dirs = []
+        if not source_dirs:
             raise ValueError('could not find debian source directory')
 
-        # define system command to execute (gen .deb binary pkg)
-        syscmd = ['dpkg-buildpackage','-rfakeroot','-uc','-b']
+        start = time.time()
+        results = build_binary_packages(source_dirs, jobs=self.jobs,
+                                        parallel=self.parallel)
+        log.info('%s\nfinished in %.1f s', format_summary(
+            [(source_dir, results[source_dir])
+             for source_dir in source_dirs]), time.time()-start)
 
-        util.process_command(syscmd,cwd=target_dir)
+        if report_subprocesses is not None:
+            process.accounting.write_report(report_subprocesses)
 
+        failed = [source_dir for source_dir in source_dirs
+                  if results[source_dir]['returncode']]
+        if failed:
+            raise RuntimeError('could not build %s'%', '.join(failed))
@@ -3,10 +3,18 @@ from setuptools import Command
 import pkg_resources
 pkg_resources.require('setuptools>=0.6b2')
 
-from stdeb import log
-from stdeb.util import expand_sdist_file, recursive_hardlink
+from stdeb import log, process
+from stdeb.util import recursive_hardlink
+from stdeb.tree import clone_tree, TreeManifest, DIRECTORY
 from stdeb.util import DebianInfo, build_dsc, stdeb_cmdline_opts, stdeb_cmd_bool_opts
+from stdeb.util import parse_val
+from stdeb.config import Config
 from stdeb.util import repack_tarball_with_debianized_dirname
+from stdeb.archive import DEFAULT_COMPRESSLEVEL, get_archive_names, \
+     get_top_dirname
+from stdeb.fingerprint import InputFingerprint, get_fingerprint_path, \
+     is_up_to_date, write_fingerprint, remove_fingerprint, read_fingerprint, \
+     get_hash_cache_path, read_hash_cache, write_hash_cache
 
 __all__ = ['sdist_dsc']
 
@@ -38,6 +46,13 @@ class sdist_dsc(Command):
         self.workaround_548392 = None
         self.no_backwards_compatibility = None
         self.xs_python_version = None
+        self.report_subprocesses = None
+        self.compression_level = None
+        self.command_timeout = None
+        self.force_rebuild = 0
+        self.extract_source_dir = 0
+        self.use_dpkg_source = 0
+        self.source_dir = None # the expanded source directory made by run()
 
     def finalize_options(self):
         def str_to_bool(mystr):
@@ -53,6 +68,15 @@ class sdist_dsc(Command):
             self.default_distribution = 'unstable'
         if self.patch_level is not None:
             self.patch_level = int(self.patch_level)
+        if self.compression_level is None:
+            self.compression_level = DEFAULT_COMPRESSLEVEL
+        else:
+            self.compression_level = int(self.compression_level)
+            if not 1 <= self.compression_level <= 9:
+                raise ValueError('compression level must be between 1 and 9')
+        if self.command_timeout is not None:
+            self.command_timeout = float(self.command_timeout)
+            process.default_timeout = self.command_timeout
 
         if self.pycentral_backwards_compatibility is not None:
             print '='*50,repr(self.pycentral_backwards_compatibility)
@@ -80,6 +104,47 @@ class sdist_dsc(Command):
             self.pycentral_backwards_compatibility=True
              # emit future change warnging?
 
+    def get_input_fingerprint(self, manifest, cfg_files, module_name):
+        """return the hex digest of everything the build depends on
+
+        This is called before egg_info is run, so only what is known
+        by then goes into it.
+        """
+        fingerprint = InputFingerprint()
+        hash_cache_path = get_hash_cache_path(self.dist_dir, module_name)
+        known_hashes = read_hash_cache(hash_cache_path,
+                                       fingerprint.algorithm)
+        fingerprint.add_tree('tree', manifest, known_hashes=known_hashes)
+        # forget the files which are gone
+        paths = set([entry.path for entry in manifest.files()])
+        for path in known_hashes.keys():
+            if path not in paths:
+                del known_hashes[path]
+        if not os.path.exists(self.dist_dir):
+            os.makedirs(self.dist_dir)
+        write_hash_cache(hash_cache_path, known_hashes, fingerprint.algorithm)
+        fingerprint.add_file('premade distfile', self.use_premade_distfile)
+        fingerprint.add_config('cfg', cfg_files)
+        # the patch DebianInfo will use
+        patch_file = self.patch_file
+        if patch_file is None:
+            cfg = Config(cfg_files, {'Stdeb-Patch-File':''})
+            patch_file = parse_val(cfg, module_name, 'Stdeb-Patch-File')
+        if patch_file and os.path.exists(patch_file):
+            fingerprint.add_file('patch', patch_file)
+        else:
+            fingerprint.add('patch', patch_file)
+        options = {}
+        for long, short, help in self.user_options:
+            attr = long.rstrip('=').replace('-','_')
+            if attr in ('dist_dir','report_subprocesses','force_rebuild',
+                        'use_premade_distfile','extra_cfg_file',
+                        'patch_file','command_timeout'):
+                continue # not an input, or hashed above
+            options[attr] = getattr(self, attr)
+        fingerprint.add('options', options)
+        return fingerprint.hexdigest()
+
     def run(self):
         ###############################################
         # 1. setup initial variables
@@ -103,8 +168,7 @@ class sdist_dsc(Command):
         #    B. find config files (if any)
         #         find .egg-info directory
         ei_cmd = self.distribution.get_command_obj('egg_info')
-
-        self.run_command('egg_info')
+        ei_cmd.ensure_finalized()
         egg_info_dirname = ei_cmd.egg_info
         config_fname = os.path.join(egg_info_dirname,'stdeb.cfg')
 
@@ -117,6 +181,49 @@ class sdist_dsc(Command):
         if self.extra_cfg_file is not None:
             cfg_files.append(self.extra_cfg_file)
 
+        exclude_dirs = ['.svn']
+        # the source tree is copied leaving out .pyc files, which
+        # dpkg-source cannot package
+        toplevel_excludes = exclude_dirs+[self.dist_dir,'build','dist']
+        def exclude(path, type):
+            if '/' not in path and path in toplevel_excludes:
+                return True
+            name = path.split('/')[-1]
+            if type == DIRECTORY:
+                return name in exclude_dirs
+            return name.endswith('.pyc')
+        orig_dir = os.path.abspath(os.curdir)
+
+        #    C. nothing to do if the inputs are those of the last build.
+        #       This is checked before running egg_info and looking up
+        #       the Debian dependencies, which take longer than building
+        #       the fingerprint. egg_info remakes the .egg-info
+        #       directory from the rest of the tree, so it is left out.
+        egg_info_path = os.path.relpath(os.path.abspath(egg_info_dirname),
+                                        orig_dir).replace(os.sep,'/')
+        def exclude_input(path, type):
+            return path == egg_info_path or exclude(path, type)
+        input_manifest = TreeManifest.scan(orig_dir, exclude=exclude_input,
+                                           follow_toplevel_symlinks=True)
+        fingerprint = self.get_input_fingerprint(input_manifest, cfg_files,
+                                                 module_name)
+        fingerprint_path = get_fingerprint_path(
+            self.dist_dir, module_name, self.distribution.get_version())
+        if not self.force_rebuild and is_up_to_date(fingerprint_path,
+                                                    fingerprint):
+            built = read_fingerprint(fingerprint_path)
+            log.info('%s is up to date (use --force-rebuild to build it '
+                     'again)', os.path.join(self.dist_dir, built['dsc']))
+            if not self.remove_expanded_source_dir:
+                self.source_dir = os.path.join(self.dist_dir,
+                                               built['source_dir'])
+            if self.report_subprocesses is not None:
+                process.accounting.write_report(self.report_subprocesses)
+            return
+        remove_fingerprint(fingerprint_path)
+
+        self.run_command('egg_info')
+
         install_requires = ()
         try:
             if not self.ignore_install_requires:
@@ -174,53 +281,42 @@ class sdist_dsc(Command):
         source_tarball = None
         cleanup_dirs = []
 
-        exclude_dirs = ['.svn']
-        # copy source tree
+        # copy the tree as egg_info left it; the orig tarball is made
+        # from the copy (when there is no premade one), by scanning it
+        manifest = TreeManifest.scan(orig_dir, exclude=exclude,
+                                     follow_toplevel_symlinks=True)
+        dsc_name = debinfo.source + '_' + debinfo.dsc_version + '.dsc'
+
         if os.path.exists(fullpath_repackaged_dirname):
             shutil.rmtree(fullpath_repackaged_dirname)
         os.makedirs(fullpath_repackaged_dirname)
-        orig_dir = os.path.abspath(os.curdir)
-        for src in os.listdir(orig_dir):
-            if src not in exclude_dirs+[self.dist_dir,'build','dist']:
-                dst = os.path.join(fullpath_repackaged_dirname,src)
-                if os.path.isdir(src):
-                    shutil.copytree(src, dst, symlinks=True)
-                else:
-                    shutil.copy2(src, dst )
-        # remove .pyc files which dpkg-source cannot package
-        for root, dirs, files in os.walk(fullpath_repackaged_dirname):
-            for name in files:
-                if name.endswith('.pyc'):
-                    fullpath = os.path.join(root,name)
-                    os.unlink(fullpath)
-            for name in dirs:
-                if name in exclude_dirs:
-                    fullpath = os.path.join(root,name)
-                    shutil.rmtree(fullpath)
+        clone_tree(orig_dir, fullpath_repackaged_dirname, manifest=manifest)
 
         if self.use_premade_distfile is not None:
         # ensure premade sdist can actually be used
             self.use_premade_distfile = os.path.abspath(self.use_premade_distfile)
-            expand_dir = os.path.join(self.dist_dir,'tmp_sdist_dsc')
-            cleanup_dirs.append(expand_dir)
-            if os.path.exists(expand_dir):
-                shutil.rmtree(expand_dir)
             if not os.path.exists(self.dist_dir):
                 os.mkdir(self.dist_dir)
-            os.mkdir(expand_dir)
-
-            expand_sdist_file(self.use_premade_distfile,cwd=expand_dir)
 
             is_tgz=False
             if self.use_premade_distfile.lower().endswith('.tar.gz'):
                 is_tgz=True
 
-            # now the sdist package is expanded in expand_dir
-            expanded_root_files = os.listdir(expand_dir)
-            assert len(expanded_root_files)==1
-            distname_in_premade_distfile = expanded_root_files[0]
+            # only the member names are needed, so they are read
+            # rather than expanding the sdist
+            names = get_archive_names(self.use_premade_distfile)
+            original_dirname = get_top_dirname(names)
+            if original_dirname is None:
+                raise RuntimeError('%s does not have a single top-level '
+                                   'directory'%self.use_premade_distfile)
+            # The source tree was copied without its .pyc files, so
+            # it would not match an sdist which has some. Quit loudly
+            # rather than fail silently.
+            for name in names:
+                if name.endswith('.pyc'):
+                    raise RuntimeError('original source dist cannot '
+                                       'contain .pyc files')
             debianized_dirname = repackaged_dirname
-            original_dirname = os.path.split(distname_in_premade_distfile)[-1]
             do_repack=False
             if is_tgz:
                 source_tarball = self.use_premade_distfile
@@ -238,17 +334,8 @@ class sdist_dsc(Command):
                 repack_tarball_with_debianized_dirname(self.use_premade_distfile,
                                                        source_tarball,
                                                        debianized_dirname,
-                                                       original_dirname )
-            if source_tarball is not None:
-                # Because we deleted all .pyc files above, if the
-                # original source dist has them, we will have
-                # (wrongly) deleted them. So, quit loudly rather
-                # than fail silently.
-                for root, dirs, files in os.walk(fullpath_repackaged_dirname):
-                    for name in files:
-                        if name.endswith('.pyc'):
-                            raise RuntimeError('original source dist cannot '
-                                               'contain .pyc files')
+                                                       original_dirname,
+                                                       compresslevel=self.compression_level )
         else:
             if 0:
                 # haven't figured out why
@@ -269,7 +356,21 @@ class sdist_dsc(Command):
                   repackaged_dirname,
                   orig_sdist=source_tarball,
                   patch_posix = self.patch_posix,
-                  remove_expanded_source_dir=self.remove_expanded_source_dir)
+                  remove_expanded_source_dir=self.remove_expanded_source_dir,
+                  compresslevel=self.compression_level,
+                  extract_source_dir=self.extract_source_dir,
+                  use_dpkg_source=self.use_dpkg_source)
 
         for rmdir in cleanup_dirs:
             shutil.rmtree(rmdir)
+
+        if self.remove_expanded_source_dir:
+            source_dir = None
+        else:
+            source_dir = repackaged_dirname
+            self.source_dir = fullpath_repackaged_dirname
+        write_fingerprint(fingerprint_path, fingerprint, dsc_name,
+                          source_dir=source_dir)
+
+        if self.report_subprocesses is not None:
+            process.accounting.write_report(self.report_subprocesses)
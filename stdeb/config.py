@@ -0,0 +1,181 @@
+#
+# .cfg files, parsed once per process.
+#
+# load() keeps every file it has parsed, keyed by path, and parses it
+# again only if its mtime or size has changed. Each value is also
+# split once, as parse_vals() in stdeb.util splits it. Config merges
+# several files (and the defaults of a package) as
+# SafeConfigParser.read() does, so that looking up a value of a
+# package costs a few dictionary lookups.
+#
+# Values containing '%' are interpolated as SafeConfigParser.get()
+# does, when they are looked up.
+#
+import os, ConfigParser
+
+__all__ = ['ConfigFile','Config','load','split_vals']
+
+DEFAULTSECT = ConfigParser.DEFAULTSECT
+
+def split_vals(value):
+    """split a comma separated value, dropping comments and empty values"""
+    vals = value.split('#')[0]
+    vals = vals.strip()
+    vals = vals.split(',')
+    vals = [v.strip() for v in vals]
+    vals = [v for v in vals if len(v)]
+    return vals
+
+def _split_section(section):
+    """return {option: split value}, None for values to interpolate"""
+    result = {}
+    for option, value in section.iteritems():
+        if '%' in value:
+            result[option] = None
+        else:
+            result[option] = split_vals(value)
+    return result
+
+class ConfigFile:
+    """the sections of one .cfg file, with their values split"""
+    def __init__(self, fname):
+        parser = ConfigParser.RawConfigParser()
+        fd = open(fname, mode='r')
+        try:
+            parser.readfp(fd, fname)
+        finally:
+            fd.close()
+        self.fname = fname
+        self.defaults = dict(parser.defaults())
+        self.sections = {}
+        for name in parser.sections():
+            # the options of the section itself, not those of DEFAULT
+            section = dict(parser._sections[name])
+            section.pop('__name__', None)
+            self.sections[name] = section
+        self.split_defaults = _split_section(self.defaults)
+        self.split_sections = {}
+        for name, section in self.sections.iteritems():
+            self.split_sections[name] = _split_section(section)
+
+# path: (mtime, size, ConfigFile)
+_cache = {}
+
+def load(fname):
+    """return the ConfigFile of fname, None if it cannot be read"""
+    path = os.path.abspath(fname)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    cached = _cache.get(path)
+    if cached is not None and cached[:2] == (st.st_mtime, st.st_size):
+        return cached[2]
+    try:
+        cfg_file = ConfigFile(path)
+    except IOError:
+        return None
+    _cache[path] = (st.st_mtime, st.st_size, cfg_file)
+    return cfg_file
+
+class Config:
+    """several .cfg files, later ones taking precedence, and defaults
+
+    Unreadable files are skipped, as SafeConfigParser.read() does.
+    """
+    def __init__(self, cfg_files, defaults=None):
+        self.files = []
+        for fname in cfg_files:
+            cfg_file = load(fname)
+            if cfg_file is not None:
+                self.files.append(cfg_file)
+        # searched from the last file to the first
+        self.files.reverse()
+        self.defaults = {}
+        for option, value in (defaults or {}).iteritems():
+            self.defaults[option.lower()] = value
+        self.split_defaults = _split_section(self.defaults)
+
+    def has_section(self, section):
+        for cfg_file in self.files:
+            if section in cfg_file.sections:
+                return True
+        return False
+
+    def _find(self, section, option):
+        """return (ConfigFile or None, section name or DEFAULT) of option"""
+        if section != DEFAULTSECT:
+            for cfg_file in self.files:
+                if option in cfg_file.sections.get(section, ()):
+                    return cfg_file, section
+        for cfg_file in self.files:
+            if option in cfg_file.defaults:
+                return cfg_file, DEFAULTSECT
+        if option in self.defaults:
+            return None, DEFAULTSECT
+        raise ConfigParser.NoOptionError(option, section)
+
+    def _get_section(self, section):
+        """return the merged raw values of section, including DEFAULT"""
+        values = dict(self.defaults)
+        for cfg_file in self.files[::-1]:
+            values.update(cfg_file.defaults)
+        if section != DEFAULTSECT:
+            for cfg_file in self.files[::-1]:
+                values.update(cfg_file.sections.get(section, {}))
+        return values
+
+    def get(self, section, option):
+        """return a value, as SafeConfigParser.get() would
+
+        As in parse_vals(), values of a section no file has come from
+        DEFAULT.
+        """
+        option = option.lower()
+        if not self.has_section(section):
+            section = DEFAULTSECT
+        cfg_file, found_in = self._find(section, option)
+        if cfg_file is None:
+            value = self.defaults[option]
+        elif found_in == DEFAULTSECT:
+            value = cfg_file.defaults[option]
+        else:
+            value = cfg_file.sections[section][option]
+        if '%' not in value:
+            return value
+        parser = ConfigParser.SafeConfigParser()
+        values = self._get_section(section)
+        if section != DEFAULTSECT:
+            parser.add_section(section)
+        for name, raw in values.iteritems():
+            ConfigParser.RawConfigParser.set(parser, section, name, raw)
+        return parser.get(section, option)
+
+    def get_vals(self, section, option):
+        """return a value split as parse_vals() does"""
+        option = option.lower()
+        if not self.has_section(section):
+            section = DEFAULTSECT
+        cfg_file, found_in = self._find(section, option)
+        if cfg_file is None:
+            vals = self.split_defaults[option]
+        elif found_in == DEFAULTSECT:
+            vals = cfg_file.split_defaults[option]
+        else:
+            vals = cfg_file.split_sections[section][option]
+        if vals is None:
+            vals = split_vals(self.get(section, option))
+        return list(vals)
+
+    def options(self, section):
+        """return the options of section, including those of DEFAULT"""
+        return self._get_section(section).keys()
+
+    def as_dict(self):
+        """return {section: {option: raw value}}, sections including DEFAULT"""
+        result = {DEFAULTSECT:self._get_section(DEFAULTSECT)}
+        for cfg_file in self.files:
+            for section in cfg_file.sections:
+                if section not in result:
+                    result[section] = self._get_section(section)
+        return result
@@ -0,0 +1,316 @@
+#
+# Pure-Python search of apt Contents files for Python distributions.
+#
+# This replaces calling "apt-file search" with a regular expression
+# built from every requirement name. The Contents files are streamed
+# once, only lines naming .egg-info or .dist-info directories are
+# kept, and the result is stored as sorted fixed-width records so that
+# looking up a requirement is a binary search.
+#
+import os, re, glob, bisect, zlib, mmap, struct
+import cPickle as pickle
+from stdeb import log, process
+
+__all__ = ['ContentsIndex','get_contents_files','get_contents_signature']
+
+# Where apt-file keeps the Contents files it searches. Old apt-file
+# versions use their own cache directory, newer ones let apt download
+# the Contents files next to the Packages lists.
+CONTENTS_GLOBS = ['/var/cache/apt/apt-file/*',
+                  '/var/lib/apt/lists/*Contents-*',
+                  ]
+
+CHUNK_SIZE = 1024*1024
+
+# the package of a record, an index into ContentsIndex.packages
+PACKAGE_ID = '<I'
+PACKAGE_ID_SIZE = struct.calcsize(PACKAGE_ID)
+
+EGGINFO_RE = re.compile(r'(?:^|/)([^/]+)\.(?:egg|dist)-info(?:/|$)')
+
+def get_contents_files():
+    """return the sorted list of Contents files apt-file would search"""
+    fnames = set()
+    for pattern in CONTENTS_GLOBS:
+        for fname in glob.glob(pattern):
+            if os.path.isfile(fname) and not fname.endswith('.diff_Index'):
+                fnames.add(fname)
+    fnames = list(fnames)
+    fnames.sort()
+    return fnames
+
+def get_contents_signature(fnames=None):
+    """return a value which changes whenever the Contents files change"""
+    if fnames is None:
+        fnames = get_contents_files()
+    signature = []
+    for fname in fnames:
+        st = os.stat(fname)
+        signature.append((fname, st.st_mtime, st.st_size))
+    return tuple(signature)
+
+def _get_decompressor(fname):
+    """return a function decompressing successive chunks of fname
+
+    Returns None if no in-process decompressor is available for this
+    file type.
+    """
+    if fname.endswith('.gz'):
+        # 16+MAX_WBITS: expect a gzip header and trailer
+        return zlib.decompressobj(16+zlib.MAX_WBITS).decompress
+    if fname.endswith('.xz'):
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                return None
+        return lzma.LZMADecompressor().decompress
+    if fname.endswith('.lz4'):
+        try:
+            import lz4.frame
+        except ImportError:
+            return None
+        return lz4.frame.LZ4FrameDecompressor().decompress
+    return lambda data: data
+
+EXTERNAL_DECOMPRESSORS = {'.xz':['xz','-dc'],
+                          '.lz4':['lz4','-dc'],
+                          }
+
+def iter_chunks(fname):
+    """yield the decompressed contents of fname in large chunks"""
+    decompress = _get_decompressor(fname)
+    if decompress is not None:
+        fd = open(fname,mode='rb')
+        try:
+            while 1:
+                buf = fd.read(CHUNK_SIZE)
+                if not buf:
+                    break
+                buf = decompress(buf)
+                if buf:
+                    yield buf
+        finally:
+            fd.close()
+        return
+
+    # no Python module to decompress this, stream it through the
+    # command line tool instead
+    ext = os.path.splitext(fname)[1]
+    args = EXTERNAL_DECOMPRESSORS[ext]+[fname]
+    for buf in process.iter_output(args):
+        yield buf
+
+def iter_egginfo_lines(fname):
+    """yield the lines of Contents file fname mentioning .egg-info/.dist-info
+
+    Only complete lines are yielded, and memory use is bounded by the
+    chunk size, not the size of the file.
+    """
+    tail = ''
+    for buf in iter_chunks(fname):
+        buf = tail + buf
+        end = buf.rfind('\n')
+        if end == -1:
+            tail = buf
+            continue
+        tail = buf[end+1:]
+        if '-info' not in buf:
+            continue
+        for line in buf[:end].split('\n'):
+            if '.egg-info' in line or '.dist-info' in line:
+                yield line
+    if tail and ('.egg-info' in tail or '.dist-info' in tail):
+        yield tail
+
+def parse_contents_line(line):
+    """return (path, [debian package names]) for a line of a Contents file
+
+    The line looks like "path   section/package,section/package".
+    """
+    parts = line.rstrip().rsplit(None,1)
+    if len(parts) != 2:
+        return None, []
+    path, locations = parts
+    packages = [location.split('/')[-1] for location in locations.split(',')]
+    return path, packages
+
+def _round_to_page(offset):
+    """round offset up to where mmap() can start mapping a file"""
+    granularity = mmap.ALLOCATIONGRANULARITY
+    return (offset+granularity-1)//granularity*granularity
+
+class _Keys:
+    """the lower-cased keys of a ContentsIndex, as a sequence for bisect"""
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        return self.index.get_base(idx).lower()
+
+class ContentsIndex:
+    """sorted index of the .egg-info/.dist-info names in Contents files
+
+    The index is a string of fixed-width records sorted by key, where
+    the key is the lower-cased .egg-info basename without extension
+    (e.g. "foo-1.0-py2.6"). Each record holds the basename, padded
+    with NUL bytes to the width of the longest one, and the position
+    of its Debian package in self.packages. .dist-info directories are
+    reported under the equivalent .egg-info name, so that
+    pkg_resources can parse all of them the same way.
+
+    A saved index is a small pickled header (the signature and the
+    package names) followed by the records, starting at a page
+    boundary. load() maps the records into memory rather than reading
+    them, so only the pages touched by the binary searches of lookup()
+    are read from disk.
+    """
+    format_version = 2
+    magic = 'stdeb Contents index\n'
+
+    def __init__(self, records='', width=0, packages=None, signature=None):
+        if packages is None: packages = []
+        self.records = records # a string or an mmap
+        self.width = width
+        self.packages = packages
+        self.signature = signature
+        self.record_size = width + PACKAGE_ID_SIZE
+
+    def __len__(self):
+        if not self.record_size:
+            return 0
+        return len(self.records)//self.record_size
+
+    def get_base(self, idx):
+        """return the .egg-info basename of record idx"""
+        start = idx*self.record_size
+        return self.records[start:start+self.width].rstrip('\0')
+
+    def get_package(self, idx):
+        """return the Debian package of record idx"""
+        start = idx*self.record_size + self.width
+        data = self.records[start:start+PACKAGE_ID_SIZE]
+        package_id, = struct.unpack(PACKAGE_ID, data)
+        return self.packages[package_id]
+
+    def build(cls, fnames, signature=None):
+        """create an index by streaming through the Contents files fnames"""
+        package_ids = {}
+        entries = set()
+        for fname in fnames:
+            log.info('indexing %s', fname)
+            for line in iter_egginfo_lines(fname):
+                path, packages = parse_contents_line(line)
+                if path is None:
+                    continue
+                mo = EGGINFO_RE.search(path)
+                if mo is None:
+                    continue
+                base = mo.group(1)
+                for package in packages:
+                    package_id = package_ids.setdefault(package,
+                                                        len(package_ids))
+                    entries.add((base.lower(), base, package_id))
+        entries = list(entries)
+        entries.sort()
+        packages = [None]*len(package_ids)
+        for package, package_id in package_ids.iteritems():
+            packages[package_id] = package
+        width = max([len(e[1]) for e in entries] or [0])
+        records = ''.join([e[1].ljust(width,'\0') +
+                           struct.pack(PACKAGE_ID, e[2])
+                           for e in entries])
+        return cls(records=records, width=width, packages=packages,
+                   signature=signature)
+    build = classmethod(build)
+
+    def load(cls, fname, signature=None):
+        """load an index saved with save()
+
+        Returns None if the file does not exist, cannot be read or was
+        built from Contents files other than those described by
+        signature.
+        """
+        if not os.path.exists(fname):
+            return None
+        try:
+            fd = open(fname,mode='rb')
+            try:
+                if fd.read(len(cls.magic)) != cls.magic:
+                    return None
+                header = pickle.load(fd)
+                if header.get('format_version') != cls.format_version:
+                    return None
+                if (signature is not None and
+                    header.get('signature') != signature):
+                    return None
+                offset = _round_to_page(fd.tell())
+                if os.fstat(fd.fileno()).st_size <= offset:
+                    records = '' # mmap() refuses empty maps
+                else:
+                    records = mmap.mmap(fd.fileno(), 0,
+                                        access=mmap.ACCESS_READ,
+                                        offset=offset)
+            finally:
+                fd.close()
+        except Exception, err:
+            log.warn('ignoring unreadable Contents index %s: %s', fname, err)
+            return None
+        return cls(records=records, width=header['width'],
+                   packages=header['packages'],
+                   signature=header['signature'])
+    load = classmethod(load)
+
+    def save(self, fname):
+        """atomically write the index to fname"""
+        header = {'format_version':self.format_version,
+                  'signature':self.signature,
+                  'width':self.width,
+                  'packages':self.packages,
+                  }
+        dirname = os.path.dirname(fname)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp_fname = '%s.%d.tmp'%(fname,os.getpid())
+        fd = open(tmp_fname,mode='wb')
+        try:
+            fd.write(self.magic)
+            pickle.dump(header, fd, pickle.HIGHEST_PROTOCOL)
+            fd.write('\0'*(_round_to_page(fd.tell())-fd.tell()))
+            fd.write(self.records[:])
+        finally:
+            fd.close()
+        os.rename(tmp_fname, fname)
+
+    def lookup(self, name):
+        """return the set of (egg-info, Debian package) pairs for name
+
+        Matches "<name>.egg-info" and "<name>-<anything>.egg-info",
+        ignoring case, like the regular expression formerly given to
+        apt-file. Only the matching records are read.
+        """
+        name = name.lower()
+        keys = _Keys(self)
+        result = set()
+        # '.' sorts right after '-', so [name-, name.) holds the keys
+        # starting with "name-"
+        for lo, hi in [(bisect.bisect_left(keys, name),
+                        bisect.bisect_right(keys, name)),
+                       (bisect.bisect_left(keys, name+'-'),
+                        bisect.bisect_left(keys, name+'.'))]:
+            for idx in xrange(lo, hi):
+                result.add(('/'+self.get_base(idx)+'.egg-info',
+                            self.get_package(idx)))
+        return result
+
+    def search(self, names):
+        """return a dict mapping each lower-cased name to lookup(name)"""
+        found = {}
+        for name in names:
+            found[name.lower()] = self.lookup(name)
+        return found
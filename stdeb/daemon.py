@@ -0,0 +1,363 @@
+#
+# A build server which keeps a warm interpreter.
+#
+# "stdeb-daemon serve" imports setuptools, pkg_resources and stdeb
+# once, loads stdeb's caches (dpkg status, apt-file cache, Contents
+# index, pyversions) and listens on a Unix socket. Every build job
+# runs in a process forked from this warm parent, so a job costs
+# little more than the packaging work itself.
+#
+# The client sends a single line of JSON:
+#
+#   {"command": "py2dsc" or "sdist_dsc", "args": [...], "cwd": "...",
+#    "env": {...}, "umask": 18}
+#
+# and receives frames of a one byte type and a 4 byte big-endian
+# length followed by that many bytes: "o" for output to stdout, "e"
+# for output to stderr and finally "x", whose length field is the exit
+# status of the job.
+#
+# This module is also the client, so it imports nothing heavy at
+# module level.
+#
+import sys, os, socket, struct, select, signal, errno, tempfile, traceback
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+__all__ = ['serve','submit','get_socket_path']
+
+USAGE = """\
+usage: stdeb-daemon [--socket=PATH] serve
+   or: stdeb-daemon [--socket=PATH] py2dsc [py2dsc options] distfile ...
+   or: stdeb-daemon [--socket=PATH] sdist_dsc [sdist_dsc options]
+   or: stdeb-daemon [--socket=PATH] stop
+
+"serve" runs the build server in the foreground. "py2dsc" and
+"sdist_dsc" run the command in the server, in the current directory
+and environment, as if run here. "stop" shuts the server down.
+
+The socket is $STDEB_DAEMON_SOCKET, or stdeb-daemon-<uid>.sock in
+$XDG_RUNTIME_DIR (or the temporary directory) by default. Only the
+user running the server may use it.
+"""
+
+COMMANDS = ['py2dsc','sdist_dsc']
+
+FRAME_HEADER = '!cI'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER)
+BUFSIZE = 64*1024
+
+def get_socket_path():
+    path = os.environ.get('STDEB_DAEMON_SOCKET')
+    if path:
+        return path
+    base = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(base, 'stdeb-daemon-%d.sock'%os.getuid())
+
+def _send_frame(conn, type, data='', length=None):
+    if length is None:
+        length = len(data)
+    conn.sendall(struct.pack(FRAME_HEADER, type, length) + data)
+
+def _recv_exactly(conn, n):
+    chunks = []
+    while n:
+        buf = conn.recv(min(n, BUFSIZE))
+        if not buf:
+            raise EOFError('connection closed by stdeb-daemon')
+        chunks.append(buf)
+        n -= len(buf)
+    return ''.join(chunks)
+
+def _get_peer_uid(conn):
+    """return the uid of the process at the other end, None if unknown"""
+    if not sys.platform.startswith('linux'):
+        return None
+    so_peercred = getattr(socket, 'SO_PEERCRED', 17)
+    creds = conn.getsockopt(socket.SOL_SOCKET, so_peercred,
+                            struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    return uid
+
+############################################################
+# client
+
+def submit(command, args, socket_path=None, cwd=None, env=None,
+           stdout=None, stderr=None):
+    """run command with args in the server and return its exit status
+
+    The job's output is written to stdout and stderr (by default
+    sys.stdout and sys.stderr) as it arrives.
+    """
+    if socket_path is None:
+        socket_path = get_socket_path()
+    if cwd is None:
+        cwd = os.getcwd()
+    if env is None:
+        env = dict(os.environ)
+    if stdout is None:
+        stdout = sys.stdout
+    if stderr is None:
+        stderr = sys.stderr
+    # do not send our environment to a socket made by someone else
+    if os.stat(socket_path).st_uid != os.getuid():
+        raise RuntimeError('%s is not owned by this user'%socket_path)
+    umask = os.umask(0)
+    os.umask(umask)
+    request = {'command':command,
+               'args':list(args),
+               'cwd':cwd,
+               'env':env,
+               'umask':umask,
+               }
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+        conn.sendall(json.dumps(request) + '\n')
+        while 1:
+            type, length = struct.unpack(FRAME_HEADER,
+                                         _recv_exactly(conn,
+                                                       FRAME_HEADER_SIZE))
+            if type == 'x':
+                return length
+            data = _recv_exactly(conn, length)
+            if type == 'o':
+                stdout.write(data)
+                stdout.flush()
+            else:
+                stderr.write(data)
+                stderr.flush()
+    finally:
+        conn.close()
+
+############################################################
+# server
+
+def warm_up():
+    """import what jobs need and load stdeb's caches"""
+    import setuptools, pkg_resources
+    import setuptools.package_index
+    from stdeb import util, py2dsc
+    import stdeb.command.sdist_dsc, stdeb.stdeb_run_setup
+    if os.path.exists(util.DPKG_STATUS):
+        util.get_dpkg_status()
+    util.get_apt_file_cache()
+    if util.get_contents_files():
+        util.get_contents_index()
+    if os.path.exists(util.PYVERSIONS):
+        util.get_pyversions_module()
+
+def run_job(request):
+    """run a job in this (forked) process and return its exit status"""
+    from stdeb import process
+    # the accounting of the server is not the job's
+    process.accounting.records = []
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    os.umask(request['umask'])
+    command = request['command']
+    args = request['args']
+    try:
+        if command == 'py2dsc':
+            from stdeb import py2dsc
+            sys.argv = ['py2dsc'] + args
+            return py2dsc.runit()
+        else:
+            from stdeb.stdeb_run_setup import run_setup
+            return run_setup(['sdist_dsc'] + args)
+    except SystemExit, err:
+        if err.code is None:
+            return 0
+        if isinstance(err.code, int):
+            return err.code
+        print >> sys.stderr, err.code
+        return 1
+    except:
+        traceback.print_exc()
+        return 1
+
+def _relay_output(conn, out_fd, err_fd):
+    """send what arrives on out_fd and err_fd as frames until both close"""
+    types = {out_fd:'o', err_fd:'e'}
+    fds = [out_fd, err_fd]
+    while fds:
+        try:
+            ready = select.select(fds, [], [])[0]
+        except select.error, err:
+            if err.args[0] == errno.EINTR:
+                continue
+            raise
+        for fd in ready:
+            data = os.read(fd, BUFSIZE)
+            if not data:
+                fds.remove(fd)
+                os.close(fd)
+                continue
+            _send_frame(conn, types[fd], data)
+
+def handle_connection(conn):
+    """serve one client in a process forked from the server"""
+    if _get_peer_uid(conn) not in (None, os.getuid()):
+        return
+    request = ''
+    while not request.endswith('\n'):
+        buf = conn.recv(BUFSIZE)
+        if not buf:
+            return
+        request += buf
+    request = json.loads(request)
+    command = request.get('command')
+    if command == 'stop':
+        os.kill(os.getppid(), signal.SIGTERM)
+        _send_frame(conn, 'x', length=0)
+        return
+    if command not in COMMANDS:
+        _send_frame(conn, 'e', 'stdeb-daemon: unknown command %r\n'%command)
+        _send_frame(conn, 'x', length=2)
+        return
+
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            conn.close()
+            os.close(out_r)
+            os.close(err_r)
+            null = os.open(os.devnull, os.O_RDONLY)
+            os.dup2(null, 0)
+            os.dup2(out_w, 1)
+            os.dup2(err_w, 2)
+            for fd in [null, out_w, err_w]:
+                os.close(fd)
+            status = run_job(request)
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(status)
+    os.close(out_w)
+    os.close(err_w)
+    _relay_output(conn, out_r, err_r)
+    status = os.waitpid(pid, 0)[1]
+    if os.WIFSIGNALED(status):
+        status = 128 + os.WTERMSIG(status)
+    else:
+        status = os.WEXITSTATUS(status)
+    _send_frame(conn, 'x', length=status)
+
+def _reap_children():
+    while 1:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError, err:
+            if err.errno == errno.ECHILD:
+                return
+            raise
+        if pid == 0:
+            return
+
+class _Stop(Exception): pass
+
+def _stop(signum, frame):
+    raise _Stop()
+
+def serve(socket_path=None):
+    """warm up, then fork a handler for every connection until stopped"""
+    if socket_path is None:
+        socket_path = get_socket_path()
+    from stdeb import log
+    log.info('stdeb-daemon: loading modules and caches')
+    warm_up()
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(socket_path):
+        # remove the socket of a server which is gone
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                probe.connect(socket_path)
+            except socket.error:
+                os.unlink(socket_path)
+            else:
+                raise RuntimeError('stdeb-daemon already running on %s'%
+                                   socket_path)
+        finally:
+            probe.close()
+    umask = os.umask(0177)
+    try:
+        sock.bind(socket_path)
+    finally:
+        os.umask(umask)
+    sock.listen(16)
+    # wake up regularly to reap finished handlers
+    sock.settimeout(1.0)
+    signal.signal(signal.SIGTERM, _stop)
+    log.info('stdeb-daemon: listening on %s', socket_path)
+    try:
+        try:
+            while 1:
+                _reap_children()
+                try:
+                    conn, addr = sock.accept()
+                except socket.timeout:
+                    continue
+                except socket.error, err:
+                    if err.args[0] == errno.EINTR:
+                        continue
+                    raise
+                conn.settimeout(None)
+                pid = os.fork()
+                if pid == 0:
+                    status = 0
+                    try:
+                        try:
+                            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                            sock.close()
+                            handle_connection(conn)
+                        except:
+                            traceback.print_exc()
+                            status = 1
+                    finally:
+                        os._exit(status)
+                conn.close()
+        except (_Stop, KeyboardInterrupt):
+            log.info('stdeb-daemon: stopping')
+    finally:
+        sock.close()
+        os.unlink(socket_path)
+    return 0
+
+############################################################
+# command line
+
+def main():
+    args = sys.argv[1:]
+    socket_path = None
+    while args and args[0].startswith('--socket'):
+        opt = args.pop(0)
+        if '=' in opt:
+            socket_path = opt.split('=',1)[1]
+        elif args:
+            socket_path = args.pop(0)
+    if not args or args[0] in ['-h','--help']:
+        print USAGE
+        sys.exit(not args and 1 or 0)
+    command, args = args[0], args[1:]
+    if command == 'serve':
+        sys.exit(serve(socket_path))
+    if command == 'stop':
+        sys.exit(submit('stop', [], socket_path=socket_path))
+    if command not in COMMANDS:
+        print >> sys.stderr, 'stdeb-daemon: unknown command %r'%command
+        print USAGE
+        sys.exit(1)
+    sys.exit(submit(command, args, socket_path=socket_path))
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,179 @@
+#
+# Dependency graphs and running jobs in dependency order.
+#
+# A DependencyGraph holds each node once, however many times it is
+# required. run_in_order() runs a job per node once all the nodes it
+# depends on have succeeded, with up to n jobs at a time in worker
+# processes, so that independent branches are built in parallel.
+#
+import multiprocessing, Queue, traceback
+from stdeb import log
+
+__all__ = ['DependencyGraph','CycleError','run_in_order']
+
+class CycleError(ValueError):
+    """the graph has a cycle, given as a list of nodes (first == last)"""
+    def __init__(self, cycle):
+        ValueError.__init__(self, 'dependency cycle: %s'%(
+            ' -> '.join(map(str, cycle))))
+        self.cycle = cycle
+
+class DependencyGraph:
+    """nodes and the nodes each of them depends on, in insertion order"""
+    def __init__(self):
+        self.nodes = []
+        self.depends = {}    # node: [nodes it depends on]
+        self.dependents = {} # node: [nodes depending on it]
+
+    def __contains__(self, node):
+        return node in self.depends
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def add_node(self, node):
+        if node not in self.depends:
+            self.nodes.append(node)
+            self.depends[node] = []
+            self.dependents[node] = []
+
+    def add_dependency(self, node, dependency):
+        """record that node can only be built after dependency"""
+        self.add_node(node)
+        self.add_node(dependency)
+        if dependency not in self.depends[node]:
+            self.depends[node].append(dependency)
+            self.dependents[dependency].append(node)
+
+    def find_cycle(self):
+        """return a cycle as a list of nodes, or None if there is none"""
+        WHITE, GREY, BLACK = 0, 1, 2
+        color = dict([(node, WHITE) for node in self.nodes])
+        for start in self.nodes:
+            if color[start] != WHITE:
+                continue
+            # iterative depth first search, path holds the grey nodes
+            path = [start]
+            iters = [iter(self.depends[start])]
+            color[start] = GREY
+            while iters:
+                for dependency in iters[-1]:
+                    if color[dependency] == GREY:
+                        return path[path.index(dependency):]+[dependency]
+                    if color[dependency] == WHITE:
+                        color[dependency] = GREY
+                        path.append(dependency)
+                        iters.append(iter(self.depends[dependency]))
+                        break
+                else:
+                    color[path.pop()] = BLACK
+                    iters.pop()
+        return None
+
+    def topological_order(self):
+        """return the nodes, each after all its dependencies
+
+        Raises CycleError if there is no such order.
+        """
+        cycle = self.find_cycle()
+        if cycle is not None:
+            raise CycleError(cycle)
+        order = []
+        done = set()
+        def visit(node):
+            if node in done:
+                return
+            done.add(node)
+            for dependency in self.depends[node]:
+                visit(dependency)
+            order.append(node)
+        for node in self.nodes:
+            visit(node)
+        return order
+
+def run_in_order(graph, func, jobs=1, is_success=bool):
+    """call func(node) for every node of graph in dependency order
+
+    Up to jobs calls run at once in worker processes forked from this
+    one (func and everything it uses must therefore be set up before
+    the call, and func must be a module level function). func must
+    return a picklable result; if it raises, the error is raised here
+    once the running calls are stopped. A node is run only if
+    is_success() is true for the results of all its dependencies; the
+    others are skipped. Returns {node: result}, where the result of
+    skipped nodes is None.
+
+    Raises CycleError if the graph has a cycle.
+    """
+    order = graph.topological_order()
+    results = {}
+    if jobs <= 1:
+        for node in order:
+            if _can_run(graph, node, results, is_success):
+                results[node] = func(node)
+            else:
+                results[node] = None
+        return results
+
+    # number of unfinished dependencies of each node
+    waiting = dict([(node, len(graph.depends[node])) for node in order])
+    ready = [node for node in order if waiting[node] == 0]
+    finished = Queue.Queue()
+    running = 0
+    pool = multiprocessing.Pool(jobs)
+    try:
+        while ready or running:
+            while ready:
+                node = ready.pop(0)
+                if not _can_run(graph, node, results, is_success):
+                    results[node] = None
+                    ready.extend(_finish(graph, node, waiting))
+                    continue
+                pool.apply_async(_call, (func, node),
+                                 callback=lambda result, node=node:
+                                     finished.put((node, result)))
+                running += 1
+            if running:
+                # a timeout keeps the wait interruptible by Ctrl-C
+                while 1:
+                    try:
+                        node, (error, result) = finished.get(timeout=1)
+                        break
+                    except Queue.Empty:
+                        pass
+                if error is not None:
+                    raise RuntimeError('error running job for %s:\n%s'%(
+                        node, error))
+                running -= 1
+                results[node] = result
+                ready.extend(_finish(graph, node, waiting))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    pool.join()
+    return results
+
+def _call(func, node):
+    """run func(node) in a worker, returning (traceback or None, result)"""
+    try:
+        return None, func(node)
+    except Exception:
+        return traceback.format_exc(), None
+
+def _can_run(graph, node, results, is_success):
+    for dependency in graph.depends[node]:
+        if results.get(dependency) is None or not is_success(
+            results[dependency]):
+            log.warn('not building %s because %s failed', node, dependency)
+            return False
+    return True
+
+def _finish(graph, node, waiting):
+    """return the dependents of node which became ready"""
+    ready = []
+    for dependent in graph.dependents[node]:
+        waiting[dependent] -= 1
+        if waiting[dependent] == 0:
+            ready.append(dependent)
+    return ready
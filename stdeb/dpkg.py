@@ -0,0 +1,323 @@
+#
+# In-process replacements for querying dpkg.
+#
+import os, re
+
+__all__ = ['parse_version','version_compare','compare_versions',
+           'DpkgStatus','get_dpkg_status']
+
+def lru_memoize(maxsize):
+    """decorator caching the results of a function of hashable arguments
+
+    At most maxsize results are kept. When the cache is full, the least
+    recently used half is dropped.
+    """
+    def decorator(func):
+        cache = {} # {args: [last_used, result]}
+        counter = [0]
+        def wrapper(*args):
+            counter[0] += 1
+            entry = cache.get(args)
+            if entry is not None:
+                entry[0] = counter[0]
+                return entry[1]
+            result = func(*args)
+            if len(cache) >= maxsize:
+                stamps = [e[0] for e in cache.itervalues()]
+                stamps.sort()
+                cutoff = stamps[len(stamps)//2]
+                for key, e in cache.items():
+                    if e[0] <= cutoff:
+                        del cache[key]
+            cache[args] = [counter[0], result]
+            return result
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+def parse_version(version):
+    """split a Debian version into (epoch, upstream_version, revision)
+
+    epoch is an integer (0 if not given) and revision is '' if not
+    given.
+    """
+    version = version.strip()
+    if not version:
+        raise ValueError('version string is empty')
+    epoch = 0
+    if ':' in version:
+        epoch_str, version = version.split(':',1)
+        try:
+            epoch = int(epoch_str)
+        except ValueError:
+            raise ValueError('epoch in version is not a number: %r'%epoch_str)
+        if epoch < 0:
+            raise ValueError('epoch in version is negative: %r'%epoch_str)
+    if '-' in version:
+        upstream, revision = version.rsplit('-',1)
+    else:
+        upstream, revision = version, ''
+    if not upstream:
+        raise ValueError('version %r has empty upstream version'%version)
+    return epoch, upstream, revision
+
+def _order(c):
+    """sort weight of a non-digit character, as in dpkg's order()"""
+    if c == '~':
+        return -1
+    elif c == '' or c.isdigit():
+        return 0
+    elif c.isalpha():
+        return ord(c)
+    else:
+        return ord(c) + 256
+
+_digits_re = re.compile(r'\d*')
+
+def _verrevcmp(a, b):
+    """compare two upstream versions or revisions like dpkg's verrevcmp()
+
+    Returns a negative number, zero or a positive number.
+    """
+    i = j = 0
+    len_a = len(a)
+    len_b = len(b)
+    while i < len_a or j < len_b:
+        # compare the non-digit prefixes character by character
+        while ((i < len_a and not a[i].isdigit()) or
+               (j < len_b and not b[j].isdigit())):
+            ac = _order(a[i:i+1])
+            bc = _order(b[j:j+1])
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        # compare the digit runs numerically
+        mo_a = _digits_re.match(a, i)
+        mo_b = _digits_re.match(b, j)
+        num_a = int(mo_a.group() or '0')
+        num_b = int(mo_b.group() or '0')
+        if num_a != num_b:
+            return cmp(num_a, num_b)
+        i = mo_a.end()
+        j = mo_b.end()
+    return 0
+
+def version_compare(v1, v2):
+    """compare two Debian versions, returning -1, 0 or 1"""
+    return _version_compare(v1.strip(), v2.strip())
+
+def _version_compare(v1, v2):
+    epoch1, upstream1, revision1 = parse_version(v1)
+    epoch2, upstream2, revision2 = parse_version(v2)
+    if epoch1 != epoch2:
+        return cmp(epoch1, epoch2)
+    result = _verrevcmp(upstream1, upstream2)
+    if result:
+        return cmp(result, 0)
+    return cmp(_verrevcmp(revision1, revision2), 0)
+_version_compare = lru_memoize(10000)(_version_compare)
+
+# {operator: (comparison results which make it true, empty_is_newer)}
+_OPERATORS = {'lt':((-1,),False),
+              'le':((-1,0),False),
+              'eq':((0,),False),
+              'ne':((-1,1),False),
+              'ge':((0,1),False),
+              'gt':((1,),False),
+              '<<':((-1,),False),
+              '<=':((-1,0),False),
+              '<':((-1,0),False), # deprecated synonym for <=
+              '=':((0,),False),
+              '>=':((0,1),False),
+              '>':((0,1),False), # deprecated synonym for >=
+              '>>':((1,),False),
+              'lt-nl':((-1,),True),
+              'le-nl':((-1,0),True),
+              'ge-nl':((0,1),True),
+              'gt-nl':((1,),True),
+              }
+
+def compare_versions(v1, op, v2):
+    """return whether 'dpkg --compare-versions v1 op v2' would succeed
+
+    As with dpkg, an empty version is earlier than any other version,
+    except for the -nl operators, for which it is later.
+    """
+    try:
+        true_results, empty_is_newer = _OPERATORS[op]
+    except KeyError:
+        raise ValueError('unknown version comparison operator %r'%op)
+    v1 = v1.strip()
+    v2 = v2.strip()
+    if v1 == '' or v2 == '':
+        if v1 == v2:
+            result = 0
+        elif v1 == '':
+            result = -1
+        else:
+            result = 1
+        if empty_is_newer:
+            result = -result
+    else:
+        result = _version_compare(v1, v2)
+    return result in true_results
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+# dpkg status states in which none of the package's files are present
+NOT_INSTALLED_STATES = ['not-installed','config-files']
+
+def iter_paragraphs(fd, fields=None):
+    """yield the paragraphs of a deb822 file (e.g. dpkg status) as dicts
+
+    Field names are lower-cased. Continuation lines are joined to their
+    field with newlines. If fields is given, only those (lower-case)
+    fields are kept.
+    """
+    para = {}
+    name = None
+    for line in fd:
+        line = line.rstrip('\n')
+        if not line.strip():
+            if para:
+                yield para
+            para = {}
+            name = None
+            continue
+        if line[0] in ' \t':
+            if name is not None:
+                para[name] += '\n' + line.strip()
+            continue
+        key, sep, value = line.partition(':')
+        if not sep:
+            name = None
+            continue
+        key = key.lower()
+        if fields is not None and key not in fields:
+            name = None
+            continue
+        name = key
+        para[name] = value.strip()
+    if para:
+        yield para
+
+def parse_relation_names(value):
+    """return [(name, version or None)] from a Provides-style field
+
+    Only "=" version constraints are kept, as that is all Provides
+    allows.
+    """
+    result = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        version = None
+        if '(' in item:
+            item, constraint = item.split('(',1)
+            constraint = constraint.rstrip(')').strip()
+            if constraint.startswith('='):
+                version = constraint[1:].strip()
+        name = item.strip().split(':')[0] # drop any :arch qualifier
+        result.append((name, version))
+    return result
+
+class DpkgStatus:
+    """index of installed packages, read once from the dpkg status file
+
+    self.versions maps each installed package name to its version and
+    self.provides maps each virtual package name to a set of
+    (providing package, provided version or None). self.shown_versions
+    maps every package dpkg knows of, installed or not, to what
+    "dpkg-query --show --showformat=${Version}" prints for it.
+    """
+    def __init__(self, fname=DPKG_STATUS):
+        self.fname = fname
+        st = os.stat(fname)
+        self.signature = (st.st_mtime, st.st_size)
+        self.versions = {}
+        self.provides = {}
+        self.shown_versions = {}
+        fd = open(fname,mode='r')
+        try:
+            for para in iter_paragraphs(
+                fd, fields=('package','status','version','provides')):
+                self._add(para)
+        finally:
+            fd.close()
+
+    def _add(self, para):
+        name = para.get('package')
+        version = para.get('version','')
+        if name is None:
+            return
+        status = para.get('status','').split()
+        # dpkg-query prints the version whatever the state (even if
+        # only the configuration files are left), except for packages
+        # which are not installed at all. The versions of several
+        # architectures of a package are printed one after the other.
+        shown_version = version
+        if status[-1:] == ['not-installed']:
+            shown_version = ''
+        self.shown_versions[name] = (self.shown_versions.get(name,'') +
+                                     shown_version)
+        if not version:
+            return
+        if not status or status[-1] in NOT_INSTALLED_STATES:
+            return
+        old_version = self.versions.get(name)
+        if old_version is not None and version_compare(old_version,
+                                                       version) >= 0:
+            # another architecture of this package is already known
+            return
+        self.versions[name] = version
+        for virtual, provided_version in parse_relation_names(
+            para.get('provides','')):
+            self.provides.setdefault(virtual,set()).add((name,
+                                                         provided_version))
+
+    def is_current(self):
+        """return whether the status file is unchanged since it was read"""
+        try:
+            st = os.stat(self.fname)
+        except OSError:
+            return False
+        return (st.st_mtime, st.st_size) == self.signature
+
+    def get_shown_version(self, name):
+        """return what "dpkg-query --show --showformat=${Version} name" prints
+
+        Raises KeyError if package name is not in the status file.
+        """
+        return self.shown_versions[name]
+
+    def is_installed(self, name, op=None, version=None):
+        """return whether name is installed or provided by an installed package
+
+        If op and version are given (e.g. 'ge', '1.0'), the installed
+        (or provided) version must also satisfy the constraint.
+        """
+        installed_version = self.versions.get(name)
+        if installed_version is not None:
+            if op is None or compare_versions(installed_version, op, version):
+                return True
+        for provider, provided_version in self.provides.get(name,()):
+            if op is None:
+                return True
+            if (provided_version is not None and
+                compare_versions(provided_version, op, version)):
+                return True
+        return False
+
+_dpkg_status = None
+
+def get_dpkg_status(fname=DPKG_STATUS):
+    """return a DpkgStatus for fname, re-reading it only when it changed"""
+    global _dpkg_status
+    if (_dpkg_status is None or _dpkg_status.fname != fname or
+        not _dpkg_status.is_current()):
+        _dpkg_status = DpkgStatus(fname)
+    return _dpkg_status
@@ -0,0 +1,434 @@
+#
+# Writing Debian source packages (format 1.0) without dpkg-source.
+#
+# write_source_package() makes the .diff.gz by comparing the debianized
+# tree with the orig tarball itself, rather than with an expanded copy
+# of it, and the .dsc from debian/control and debian/changelog, reading
+# each file once for all its checksums. For what stdeb makes, the
+# result is that of "dpkg-source -b" (up to the gzip compression of
+# the .diff.gz). What it cannot write the same way (binary files,
+# changes of file type, control fields it does not know, ...) raises
+# NotRepresentable, so that dpkg-source can be used instead.
+#
+import os, re, stat, mmap, gzip, tarfile, difflib, hashlib
+from stdeb import log
+from stdeb.tree import TreeManifest, hash_file, FILE, DIRECTORY, SYMLINK
+
+__all__ = ['NotRepresentable','hash_file_multi','unified_diff',
+           'write_source_package']
+
+CHECKSUM_ALGORITHMS = ['md5','sha1','sha256']
+HASH_CHUNK_SIZE = 1024*1024
+
+# what dpkg-source leaves out of a 1.0 diff
+_diff_ignore_re = re.compile(r'(?:^|/)debian/source/local-.*$|'
+                             r'(?:^|/)debian/files(?:\.new)?$')
+
+_type_names = {FILE:'file', DIRECTORY:'directory', SYMLINK:'symlink'}
+
+class NotRepresentable(ValueError):
+    """the source package cannot be written without dpkg-source"""
+
+def hash_file_multi(fname, algorithms=CHECKSUM_ALGORITHMS):
+    """return (size, {algorithm: hex digest}) of fname, read once"""
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    fd = open(fname, mode='rb')
+    try:
+        size = os.fstat(fd.fileno()).st_size
+        if size:
+            data = mmap.mmap(fd.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, size, HASH_CHUNK_SIZE):
+                    chunk = buffer(data, offset, HASH_CHUNK_SIZE)
+                    for h in hashes:
+                        h.update(chunk)
+            finally:
+                data.close()
+    finally:
+        fd.close()
+    return size, dict(zip(algorithms, [h.hexdigest() for h in hashes]))
+
+############################################################
+# .diff.gz
+
+def _split_lines(data):
+    """split data after each newline (only), as diff does"""
+    lines = data.split('\n')
+    result = [line+'\n' for line in lines[:-1]]
+    if lines[-1]:
+        result.append(lines[-1])
+    return result
+
+def _format_range(start, stop):
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return '%d'%beginning
+    if not length:
+        beginning -= 1
+    return '%d,%d'%(beginning, length)
+
+def unified_diff(old_data, new_data, old_label, new_label, context=3):
+    """return the lines of "diff -u" of two strings, labelled as given"""
+    old = _split_lines(old_data)
+    new = _split_lines(new_data)
+    matcher = difflib.SequenceMatcher(None, old, new, autojunk=False)
+    result = []
+    def add(prefix, line):
+        result.append(prefix+line)
+        if not line.endswith('\n'):
+            result.append('\n\\ No newline at end of file\n')
+    for group in matcher.get_grouped_opcodes(context):
+        if not result:
+            result.append('--- %s\n'%old_label)
+            result.append('+++ %s\n'%new_label)
+        result.append('@@ -%s +%s @@\n'%(
+            _format_range(group[0][1], group[-1][2]),
+            _format_range(group[0][3], group[-1][4])))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in old[i1:i2]:
+                    add(' ', line)
+                continue
+            if tag in ('replace','delete'):
+                for line in old[i1:i2]:
+                    add('-', line)
+            if tag in ('replace','insert'):
+                for line in new[j1:j2]:
+                    add('+', line)
+    return result
+
+def _read_file(fname):
+    fd = open(fname, mode='rb')
+    try:
+        return fd.read()
+    finally:
+        fd.close()
+
+def _read_orig_tarball(orig_tarball, tree):
+    """return {path: (type, data)} of orig_tarball without its top directory
+
+    For files, data is None if the file in tree (a {path:
+    ManifestEntry} dict) has the same contents, else the contents in
+    the tarball. For symlinks, it is the target.
+    """
+    result = {}
+    tar = tarfile.open(orig_tarball, 'r:*')
+    try:
+        for member in tar:
+            path = member.name
+            while path.startswith('./'):
+                path = path[2:]
+            path = path.rstrip('/')
+            if '/' not in path:
+                continue # the top-level directory
+            path = path.split('/',1)[1]
+            if member.isdir():
+                result[path] = (DIRECTORY, None)
+            elif member.issym():
+                result[path] = (SYMLINK, member.linkname)
+            elif member.isfile():
+                data = tar.extractfile(member).read()
+                entry = tree.get(path)
+                if (entry is not None and entry.type == FILE and
+                    entry.size == len(data) and
+                    hash_file(entry.fullpath) ==
+                    hashlib.sha1(data).hexdigest()):
+                    data = None
+                result[path] = (FILE, data)
+            else:
+                raise NotRepresentable('%s is not a file, directory or '
+                                       'symlink in %s'%(member.name,
+                                                        orig_tarball))
+    finally:
+        tar.close()
+    return result
+
+def write_diff(diff_fname, orig_tarball, source_dir):
+    """write the 1.0 .diff.gz of source_dir against orig_tarball"""
+    basedir = os.path.basename(source_dir.rstrip('/'))
+    manifest = TreeManifest.scan(source_dir)
+    tree = {}
+    for entry in manifest.entries:
+        entry.fullpath = os.path.join(source_dir, entry.path)
+        tree[entry.path] = entry
+    orig = _read_orig_tarball(orig_tarball, tree)
+
+    raw_fd = open(diff_fname, mode='wb')
+    fd = gzip.GzipFile(filename='', mode='wb', compresslevel=9,
+                       fileobj=raw_fd, mtime=0)
+    modified = []
+    try:
+        for path in sorted(tree):
+            if _diff_ignore_re.search(path):
+                continue
+            entry = tree[path]
+            orig_type, orig_data = orig.get(path, (None, None))
+            if entry.type == DIRECTORY:
+                if orig_type not in (None, DIRECTORY):
+                    raise NotRepresentable('%s is no longer a %s'%(
+                        path, _type_names[orig_type]))
+                continue
+            if entry.type == SYMLINK:
+                if orig_type != SYMLINK or entry.linkname != orig_data:
+                    raise NotRepresentable('symlink %s was changed'%path)
+                continue
+            if entry.type != FILE:
+                raise NotRepresentable('%s is not a file, directory or '
+                                       'symlink'%path)
+            if orig_type is None:
+                old_data = ''
+                if not entry.size:
+                    log.warn("WARNING: newly created empty file '%s' will "
+                             "not be represented in diff", path)
+                    continue
+                if entry.mode & 0111 and path != 'debian/rules':
+                    log.warn("WARNING: executable mode %04o of '%s' will "
+                             "not be represented in diff",
+                             stat.S_IMODE(entry.mode), path)
+            elif orig_type != FILE:
+                raise NotRepresentable('%s is no longer a %s'%(
+                    path, _type_names[orig_type]))
+            elif orig_data is None:
+                continue # unchanged
+            else:
+                old_data = orig_data
+            new_data = _read_file(entry.fullpath)
+            if '\0' in old_data or '\0' in new_data:
+                raise NotRepresentable('binary file contents of %s '
+                                       'changed'%path)
+            old_label = '%s.orig/%s'%(basedir, path)
+            new_label = '%s/%s'%(basedir, path)
+            if ' ' in path:
+                old_label += '\t'
+                new_label += '\t'
+            lines = unified_diff(old_data, new_data, old_label, new_label)
+            if '\n\\ No newline at end of file\n' in lines:
+                log.warn('WARNING: file %s has no final newline (either '
+                         'original or modified version)', new_label)
+            if not path.startswith('debian/'):
+                modified.append(path)
+            fd.write(''.join(lines))
+        for path in sorted(orig):
+            if path not in tree and not _diff_ignore_re.search(path):
+                log.warn('WARNING: ignoring deletion of %s %s',
+                         _type_names[orig[path][0]], path)
+    finally:
+        fd.close()
+        raw_fd.close()
+    if modified:
+        log.warn('WARNING: the diff modifies the following upstream '
+                 'files:\n %s', '\n '.join(modified))
+
+############################################################
+# .dsc
+
+_dep_re = re.compile(r'^([a-zA-Z0-9][a-zA-Z0-9+.\-]*(?::[a-z0-9\-]+)?)\s*'
+                     r'(?:\(\s*(<<|<=|=|>=|>>)\s*([^\s()]+)\s*\))?$')
+
+# fields of debian/control going into the .dsc, in the order of
+# dpkg-source
+SOURCE_DEP_FIELDS = ['Build-Depends','Build-Depends-Arch',
+                     'Build-Depends-Indep','Build-Conflicts',
+                     'Build-Conflicts-Arch','Build-Conflicts-Indep']
+SOURCE_FIELDS = ['Source','Maintainer','Uploaders','Homepage',
+                 'Standards-Version'] + SOURCE_DEP_FIELDS
+# fields of binary packages which do not go into the .dsc
+BINARY_ONLY_FIELDS = ['Package','Architecture','Section','Priority',
+                      'Description','Homepage','Depends','Pre-Depends',
+                      'Recommends','Suggests','Enhances','Conflicts',
+                      'Breaks','Replaces','Provides']
+
+def _normalize_deps(value):
+    """return a dependency field as dpkg-source writes it"""
+    items = []
+    seen = set()
+    for item in value.split(','):
+        alternatives = []
+        for alternative in item.split('|'):
+            match = _dep_re.match(alternative.strip())
+            if match is None:
+                raise NotRepresentable('cannot parse dependency %r'%
+                                       alternative.strip())
+            name, op, version = match.groups()
+            if op is None:
+                alternatives.append(name)
+            else:
+                alternatives.append('%s (%s %s)'%(name, op, version))
+            if name in seen:
+                # dpkg-source would merge or drop some
+                raise NotRepresentable('dependency on %s repeated'%name)
+            seen.add(name)
+        items.append(' | '.join(alternatives))
+    return ', '.join(items)
+
+def parse_control(fname):
+    """return the stanzas of a control file as lists of (field, value)"""
+    stanzas = []
+    stanza = None
+    fd = open(fname, mode='r')
+    try:
+        for line in fd:
+            line = line.rstrip('\n')
+            if not line.strip():
+                stanza = None
+                continue
+            if line.startswith('#'):
+                continue
+            if line[0] in ' \t':
+                if not stanza:
+                    raise NotRepresentable('unexpected continuation line '
+                                           'in %s'%fname)
+                field, value = stanza[-1]
+                stanza[-1] = (field, value+'\n'+line.strip())
+                continue
+            if ':' not in line:
+                raise NotRepresentable('cannot parse %r in %s'%(line, fname))
+            if stanza is None:
+                stanza = []
+                stanzas.append(stanza)
+            field, value = line.split(':',1)
+            stanza.append((field.strip(), value.strip()))
+    finally:
+        fd.close()
+    return stanzas
+
+def _get_changelog_version(fname):
+    """return the source and version of the latest changelog entry"""
+    fd = open(fname, mode='r')
+    try:
+        line = fd.readline()
+    finally:
+        fd.close()
+    match = re.match(r'^(\S+) \(([^()\s]+)\)', line)
+    if match is None:
+        raise NotRepresentable('cannot parse %s'%fname)
+    return match.groups()
+
+def get_dsc_fields(source_dir):
+    """return the fields of the .dsc (without checksums) of source_dir
+
+    The result is ([(field, value)], [(extra field, value)]), the
+    extra fields going after the checksums.
+    """
+    stanzas = parse_control(os.path.join(source_dir,'debian','control'))
+    if len(stanzas) < 2:
+        raise NotRepresentable('debian/control lists no binary package')
+    source_stanza = stanzas[0]
+    source_fields = {}
+    extras = []
+    for field, value in source_stanza:
+        if field in ('Section','Priority'):
+            continue
+        if re.match(r'^X[BC]*S[BC]*-', field):
+            extras.append((field.split('-',1)[1], value))
+            continue
+        if re.match(r'^X[BC]+-', field):
+            continue
+        if field not in SOURCE_FIELDS:
+            raise NotRepresentable('unknown field %s in debian/control'%field)
+        if not value:
+            raise NotRepresentable('empty field %s in debian/control'%field)
+        if field == 'Uploaders':
+            value = re.sub(r'\s*[\r\n]\s*', ' ', value)
+        elif field in SOURCE_DEP_FIELDS:
+            value = _normalize_deps(value)
+        source_fields[field] = value
+    source_stanza = dict(source_stanza)
+
+    binaries = []
+    archs = []
+    package_list = []
+    for stanza in stanzas[1:]:
+        for field, value in stanza:
+            if field not in BINARY_ONLY_FIELDS and not re.match(
+                r'^X[BC]+-', field):
+                raise NotRepresentable('unknown field %s of a binary '
+                                       'package in debian/control'%field)
+        stanza = dict(stanza)
+        name = stanza['Package']
+        arch = stanza.get('Architecture')
+        if arch not in ('all','any'):
+            raise NotRepresentable('architecture %r of %s'%(arch, name))
+        if arch not in archs:
+            archs.append(arch)
+        binaries.append(name)
+        package_list.append('%s deb %s %s arch=%s'%(
+            name,
+            stanza.get('Section') or source_stanza.get('Section','unknown'),
+            stanza.get('Priority') or source_stanza.get('Priority',
+                                                        'unknown'),
+            arch))
+    if 'any' in archs:
+        archs = [arch for arch in ['any','all'] if arch in archs]
+    binary = ', '.join(binaries)
+    if len(binary) > 980:
+        raise NotRepresentable('Binary field too long')
+
+    source, version = _get_changelog_version(
+        os.path.join(source_dir,'debian','changelog'))
+    if source != source_fields['Source']:
+        raise NotRepresentable('source %s in debian/changelog is %s in '
+                               'debian/control'%(source,
+                                                 source_fields['Source']))
+    fields = [('Format','1.0'),
+              ('Source',source),
+              ('Binary',binary),
+              ('Architecture',' '.join(archs)),
+              ('Version',version),
+              ]
+    for field in SOURCE_FIELDS[1:]:
+        if field in source_fields:
+            fields.append((field, source_fields[field]))
+    package_list.sort()
+    fields.append(('Package-List', '\n'+'\n'.join(package_list)))
+    return fields, extras
+
+def _format_field(field, value):
+    if value.startswith('\n'):
+        return '%s:%s\n'%(field, value.replace('\n','\n '))
+    return '%s: %s\n'%(field, value.replace('\n','\n '))
+
+def write_source_package(dist_dir, dirname, orig_tarball):
+    """write the .diff.gz and .dsc of dist_dir/dirname, return the .dsc name
+
+    orig_tarball is the name of the .orig.tar.gz in dist_dir.
+    """
+    source_dir = os.path.join(dist_dir, dirname)
+    fields, extras = get_dsc_fields(source_dir)
+    source = dict(fields)['Source']
+    version = dict(fields)['Version']
+    if ':' in version:
+        version = version.split(':',1)[1]
+    diff_name = '%s_%s.diff.gz'%(source, version)
+    dsc_name = '%s_%s.dsc'%(source, version)
+
+    log.info('writing %s and %s in %s', diff_name, dsc_name, dist_dir)
+    diff_path = os.path.join(dist_dir, diff_name)
+    try:
+        write_diff(diff_path, os.path.join(dist_dir, orig_tarball),
+                   source_dir)
+    except:
+        if os.path.exists(diff_path):
+            os.unlink(diff_path)
+        raise
+
+    checksums = {}
+    for algorithm in CHECKSUM_ALGORITHMS:
+        checksums[algorithm] = []
+    for name in [orig_tarball, diff_name]:
+        size, digests = hash_file_multi(os.path.join(dist_dir, name))
+        for algorithm in CHECKSUM_ALGORITHMS:
+            checksums[algorithm].append('%s %d %s'%(digests[algorithm],
+                                                    size, name))
+    fields.append(('Checksums-Sha1', '\n'+'\n'.join(checksums['sha1'])))
+    fields.append(('Checksums-Sha256', '\n'+'\n'.join(checksums['sha256'])))
+    fields.append(('Files', '\n'+'\n'.join(checksums['md5'])))
+
+    fd = open(os.path.join(dist_dir, dsc_name), mode='w')
+    try:
+        for field, value in fields + extras:
+            fd.write(_format_field(field, value))
+    finally:
+        fd.close()
+    return dsc_name
@@ -0,0 +1,208 @@
+#
+# Fingerprints of what a source package is built from.
+#
+# sdist_dsc hashes its inputs (the source tree, the premade sdist, the
+# merged configuration, the options, the patch file and the stdeb
+# version) and stores the result next to the .dsc in dist_dir, along
+# with the files the .dsc lists and their sizes. If the next run has
+# the same fingerprint and those files are unchanged, there is
+# nothing to build.
+#
+# The state of the build system (e.g. which Debian packages provide
+# the requirements) is not part of the fingerprint.
+#
+# The fingerprint is checked before anything else is done, so it does
+# not cover the .egg-info directory, which egg_info makes from the
+# rest of the tree (its stdeb.cfg is covered as part of the
+# configuration).
+#
+# Hashing the source tree means reading all of it, so the hashes of
+# its files are kept in a second file next to the fingerprint, and a
+# file is read again only if its size or mtime changed.
+#
+import os, glob, hashlib, time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from stdeb import __version__ as __stdeb_version__
+from stdeb.tree import hash_file
+from stdeb.config import Config
+
+__all__ = ['InputFingerprint','get_fingerprint_path','is_up_to_date',
+           'write_fingerprint','remove_fingerprint','read_fingerprint',
+           'get_hash_cache_path','read_hash_cache','write_hash_cache']
+
+# files modified less than this many seconds before they were hashed
+# may change again without a new mtime, so their hash is not kept
+# (the hashes keep mtimes in whole seconds, rounded down)
+RACY_SECONDS = 2
+
+# change when the fingerprint no longer covers what it used to
+FINGERPRINT_FORMAT = 2
+
+class InputFingerprint:
+    """a hash of the inputs of a build, fed one named input at a time"""
+    def __init__(self, algorithm='sha1'):
+        self._hash = hashlib.new(algorithm)
+        self.algorithm = algorithm
+        self.add('format', FINGERPRINT_FORMAT)
+        self.add('stdeb', __stdeb_version__)
+
+    def add(self, name, value):
+        """add a value made of strings, numbers, None, lists and dicts"""
+        self._hash.update('%s\0%s\n'%(name, json.dumps(value,
+                                                       sort_keys=True)))
+
+    def add_file(self, name, fname):
+        """add the contents of fname (or the lack of it if None)"""
+        if fname is None:
+            self.add(name, None)
+        else:
+            self.add(name, hash_file(fname, self.algorithm))
+
+    def add_tree(self, name, manifest, known_hashes=None):
+        """add the contents of the tree listed by a TreeManifest
+
+        See TreeManifest.checksum() for known_hashes.
+        """
+        self.add(name, manifest.checksum(self.algorithm,
+                                         known_hashes=known_hashes))
+
+    def add_config(self, name, cfg_files):
+        """add the configuration the .cfg files amount to together"""
+        self.add(name, Config(cfg_files).as_dict())
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+def get_fingerprint_path(dist_dir, name, version):
+    """return where the fingerprint of distribution name is kept
+
+    name and version are those given to setup(), as the Debian ones
+    are not known yet when the fingerprint is checked.
+    """
+    return os.path.join(dist_dir, '%s-%s.stdeb-fingerprint'%(name, version))
+
+def get_hash_cache_path(dist_dir, name):
+    # shared by all versions, as most files do not change between them
+    return os.path.join(dist_dir, '%s.stdeb-hashes'%name)
+
+def _get_dsc_files(dsc_path):
+    """return the names of the files listed in the Files field of a .dsc"""
+    result = []
+    in_files = False
+    fd = open(dsc_path, mode='r')
+    try:
+        for line in fd:
+            if in_files and line[:1] in (' ','\t'):
+                result.append(line.split()[2])
+            else:
+                in_files = line.startswith('Files:')
+    finally:
+        fd.close()
+    return result
+
+def _read(path):
+    try:
+        fd = open(path, mode='r')
+    except IOError:
+        return None
+    try:
+        try:
+            return json.load(fd)
+        except ValueError:
+            return None
+    finally:
+        fd.close()
+
+def read_fingerprint(path):
+    """return {'fingerprint', 'files', 'dsc', 'source_dir'} or None"""
+    data = _read(path)
+    if not isinstance(data, dict):
+        return None
+    return data
+
+def is_up_to_date(path, fingerprint):
+    """is what was built with fingerprint still there?"""
+    data = _read(path)
+    if data is None or data.get('fingerprint') != fingerprint:
+        return False
+    dist_dir = os.path.dirname(path)
+    for name, size in data['files'].items():
+        fname = os.path.join(dist_dir, name)
+        if size is None:
+            if not os.path.isdir(fname):
+                return False
+        elif (not os.path.isfile(fname) or
+              os.path.getsize(fname) != size):
+            return False
+    return True
+
+def write_fingerprint(path, fingerprint, dsc_name, source_dir=None):
+    """record that dsc_name (and source_dir, if kept) was built
+
+    dsc_name and source_dir are relative to the directory of path.
+    """
+    dist_dir = os.path.dirname(path)
+    files = {}
+    for name in [dsc_name] + _get_dsc_files(os.path.join(dist_dir,
+                                                         dsc_name)):
+        files[name] = os.path.getsize(os.path.join(dist_dir, name))
+    if source_dir is not None:
+        files[source_dir] = None
+        # other versions built in dist_dir lost their source_dir
+        for other in glob.glob(os.path.join(dist_dir,
+                                            '*.stdeb-fingerprint')):
+            data = _read(other)
+            if (other != path and data is not None and
+                source_dir in data['files']):
+                os.unlink(other)
+    tmp_path = path + '.tmp'
+    fd = open(tmp_path, mode='w')
+    try:
+        json.dump({'fingerprint':fingerprint, 'files':files,
+                   'dsc':dsc_name, 'source_dir':source_dir}, fd,
+                  indent=2, sort_keys=True)
+    finally:
+        fd.close()
+    os.rename(tmp_path, path)
+
+def read_hash_cache(path, algorithm='sha1'):
+    """return the known_hashes stored in path (empty if there are none)"""
+    data = _read(path)
+    if (not isinstance(data, dict) or data.get('algorithm') != algorithm or
+        not isinstance(data.get('files'), dict)):
+        return {}
+    # json gives unicode, the manifest has byte strings
+    known_hashes = {}
+    for name, known in data['files'].items():
+        try:
+            size, mtime, digest = known
+        except (TypeError, ValueError):
+            continue
+        known_hashes[name.encode('utf-8')] = (size, mtime, str(digest))
+    return known_hashes
+
+def write_hash_cache(path, known_hashes, algorithm='sha1'):
+    """store known_hashes in path, except for recently modified files"""
+    newest = time.time() - RACY_SECONDS
+    files = {}
+    for name, known in known_hashes.items():
+        try:
+            name.decode('utf-8')
+        except UnicodeDecodeError:
+            continue # json cannot store it
+        if known[1] + 1 < newest:
+            files[name] = known
+    tmp_path = path + '.tmp'
+    fd = open(tmp_path, mode='w')
+    try:
+        json.dump({'algorithm':algorithm, 'files':files}, fd)
+    finally:
+        fd.close()
+    os.rename(tmp_path, path)
+
+def remove_fingerprint(path):
+    if os.path.exists(path):
+        os.unlink(path)
@@ -0,0 +1,335 @@
+#
+# Applying unified diffs without /usr/bin/patch.
+#
+# apply_patches() reads a series of patches, applies every hunk in
+# memory (each one exactly, though possibly at an offset from the line
+# it names, never with fuzz), and only then writes the files it
+# changed, each one atomically. A patch which does not apply leaves
+# the tree untouched.
+#
+# Files are chosen, created and removed as "patch -pN" does, and as
+# "patch -pN --posix" does in posix mode, where files emptied by a
+# patch are kept (but where, unlike patch, the timestamps of "diff -N"
+# still mark new files). What this module does not handle (context diffs,
+# renames, mode changes, binary patches) raises Unsupported, so that
+# /usr/bin/patch can be used instead.
+#
+import os, re
+from stdeb import log
+
+__all__ = ['PatchError','Unsupported','parse_patch','apply_patches']
+
+DEV_NULL = '/dev/null'
+
+_hunk_re = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+# the timestamp of a file which does not exist, as diff -N writes it
+_epoch_re = re.compile(r'^1970-01-01 00:00:00(?:\.0+)?(?: [+-]0000)?$|'
+                       r'^Thu Jan  1 00:00:00 1970$')
+# a name quoted as diff and git do, with C escapes
+_quoted_re = re.compile(r'^"((?:[^"\\]|\\.)*)"(.*)$')
+_unsupported_headers = ['rename from ','rename to ','copy from ','copy to ',
+                        'old mode ','new mode ','new file mode ',
+                        'deleted file mode ','GIT binary patch',
+                        'Binary files ']
+
+class PatchError(RuntimeError):
+    """a patch cannot be parsed or does not apply"""
+
+class Unsupported(PatchError):
+    """a patch uses something this module does not implement"""
+
+class Hunk:
+    """one @@ section: old_lines are replaced by new_lines at old_start"""
+    def __init__(self, old_start, old_lines, new_lines):
+        self.old_start = old_start
+        self.old_lines = old_lines
+        self.new_lines = new_lines
+
+class FilePatch:
+    """the hunks for one file, as named in the --- and +++ lines"""
+    def __init__(self, old_name, new_name, creates=False, deletes=False):
+        self.old_name = old_name
+        self.new_name = new_name
+        self.creates = creates
+        self.deletes = deletes
+        self.hunks = []
+
+def _split_lines(data):
+    """split data after each newline (only), as patch does"""
+    lines = data.split('\n')
+    result = [line+'\n' for line in lines[:-1]]
+    if lines[-1]:
+        result.append(lines[-1])
+    return result
+
+def _parse_name(text):
+    """return (name, whether it is a file which does not exist)"""
+    text = text.rstrip('\r\n')
+    match = _quoted_re.match(text)
+    if match is not None:
+        name = match.group(1).decode('string_escape')
+        timestamp = match.group(2)
+    elif '\t' in text:
+        name, timestamp = text.split('\t',1)
+    else:
+        name, timestamp = text, ''
+    absent = name == DEV_NULL or bool(_epoch_re.match(timestamp.strip()))
+    return name, absent
+
+def _read_hunk(lines, i, match, source):
+    """parse the hunk starting with lines[i], return (Hunk, next index)"""
+    old_start = int(match.group(1))
+    old_len = int(match.group(2) or 1)
+    new_len = int(match.group(4) or 1)
+    old_lines = []
+    new_lines = []
+    # how many lines of each side remain to be read
+    n_old, n_new = old_len, new_len
+    i += 1
+    last = None
+    while i < len(lines):
+        line = lines[i]
+        tag = line[:1]
+        if tag == '\\':
+            # "\ No newline at end of file" after the last line read
+            if last in (' ','-'):
+                old_lines[-1] = old_lines[-1].rstrip('\n')
+            if last in (' ','+'):
+                new_lines[-1] = new_lines[-1].rstrip('\n')
+            i += 1
+            continue
+        if not n_old and not n_new:
+            break
+        if line in ('\n','\r\n'):
+            # a context line whose leading space was lost
+            tag, text = ' ', line
+        else:
+            text = line[1:]
+        if tag == ' ' and n_old and n_new:
+            old_lines.append(text)
+            new_lines.append(text)
+            n_old -= 1
+            n_new -= 1
+        elif tag == '-' and n_old:
+            old_lines.append(text)
+            n_old -= 1
+        elif tag == '+' and n_new:
+            new_lines.append(text)
+            n_new -= 1
+        else:
+            raise PatchError('malformed hunk at line %d of %s'%(i+1, source))
+        last = tag
+        i += 1
+    if n_old or n_new:
+        raise PatchError('truncated hunk at the end of %s'%source)
+    if not old_len:
+        # the hunk goes after line old_start
+        old_start += 1
+    return Hunk(old_start, old_lines, new_lines), i
+
+def parse_patch(data, source='patch'):
+    """return the FilePatches of the unified diff data
+
+    source names data in error messages.
+    """
+    lines = _split_lines(data)
+    result = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        for header in _unsupported_headers:
+            if line.startswith(header):
+                raise Unsupported('%r in %s'%(line.rstrip(), source))
+        if line.startswith('*** ') and i+1 < len(lines) and \
+               lines[i+1].startswith('--- '):
+            raise Unsupported('context diff in %s'%source)
+        if not (line.startswith('--- ') and i+1 < len(lines) and
+                lines[i+1].startswith('+++ ')):
+            i += 1 # anything between file patches is ignored
+            continue
+        old_name, old_absent = _parse_name(line[4:])
+        new_name, new_absent = _parse_name(lines[i+1][4:])
+        file_patch = FilePatch(old_name, new_name, creates=old_absent,
+                               deletes=new_absent)
+        i += 2
+        while i < len(lines) and lines[i].startswith('@@ '):
+            match = _hunk_re.match(lines[i])
+            if match is None:
+                raise PatchError('malformed hunk header at line %d of %s'%(
+                    i+1, source))
+            hunk, i = _read_hunk(lines, i, match, source)
+            file_patch.hunks.append(hunk)
+        if not file_patch.hunks:
+            raise PatchError('no hunks for %s in %s'%(new_name, source))
+        result.append(file_patch)
+    if not result:
+        raise PatchError('%s does not contain a unified diff'%source)
+    return result
+
+def _strip(name, level):
+    """strip level leading components of name, as patch -p does"""
+    parts = re.split('/+', name)
+    if len(parts) <= level:
+        raise PatchError('cannot strip %d components from %s'%(level, name))
+    name = '/'.join(parts[level:])
+    if name.startswith('/') or '..' in name.split('/'):
+        raise PatchError('refusing to patch %s outside the tree'%name)
+    return name
+
+class _Tree:
+    """the files of a tree as patched so far, read lazily"""
+    def __init__(self, top):
+        self.top = top
+        self.contents = {} # path: contents, None if removed
+        self.order = []    # the changed paths, in the order changed
+
+    def exists(self, path):
+        if path in self.contents:
+            return self.contents[path] is not None
+        return os.path.isfile(os.path.join(self.top, path))
+
+    def read(self, path):
+        if path in self.contents:
+            return self.contents[path]
+        fd = open(os.path.join(self.top, path), mode='rb')
+        try:
+            return fd.read()
+        finally:
+            fd.close()
+
+    def set(self, path, contents):
+        if path not in self.contents:
+            self.order.append(path)
+        self.contents[path] = contents
+
+def _adds_whole_file(file_patch):
+    """whether file_patch is a single hunk adding to an empty file"""
+    return (len(file_patch.hunks) == 1 and
+            file_patch.hunks[0].old_start == 1 and
+            not file_patch.hunks[0].old_lines)
+
+def _choose_path(file_patch, level, posix, tree):
+    """return which file of the tree file_patch is for"""
+    if file_patch.creates:
+        return _strip(file_patch.new_name, level)
+    names = [_strip(name, level)
+             for name in [file_patch.old_name, file_patch.new_name]
+             if name != DEV_NULL]
+    existing = [name for name in names if tree.exists(name)]
+    if not existing and _adds_whole_file(file_patch):
+        # "@@ -0,0" without timestamps, as in the diffs of dpkg-source
+        return names[-1]
+    if not existing:
+        raise PatchError("can't find file to patch: %s"%' or '.join(names))
+    if not posix:
+        # the best name, as GNU patch sees it
+        existing.sort(key=lambda name: (name.count('/'),
+                                        len(os.path.basename(name)),
+                                        len(name)))
+    return existing[0]
+
+def _find(lines, wanted, expected, start):
+    """return where wanted is in lines, from start and nearest to expected"""
+    n = len(wanted)
+    last = len(lines) - n
+    expected = max(start, min(expected, last))
+    for distance in xrange(0, max(expected-start, last-expected)+1):
+        for at in (expected-distance, expected+distance):
+            if start <= at <= last and lines[at:at+n] == wanted:
+                return at
+    return None
+
+def _apply_hunks(data, file_patch, path, source):
+    """return data patched by the hunks of file_patch"""
+    lines = _split_lines(data)
+    result = []
+    pos = 0
+    offset = 0
+    for n, hunk in enumerate(file_patch.hunks):
+        expected = hunk.old_start - 1 + offset
+        at = _find(lines, hunk.old_lines, expected, pos)
+        if at is None:
+            raise PatchError('hunk #%d of %s does not apply to %s'%(
+                n+1, source, path))
+        if at != expected:
+            log.info('Hunk #%d succeeded at %d (offset %d lines).',
+                     n+1, at+1, at-expected)
+        offset = at - (hunk.old_start - 1)
+        result.extend(lines[pos:at])
+        result.extend(hunk.new_lines)
+        pos = at + len(hunk.old_lines)
+    result.extend(lines[pos:])
+    return ''.join(result)
+
+def _remove_empty_dirs(top, path):
+    dirname = os.path.dirname(path)
+    while dirname:
+        try:
+            os.rmdir(os.path.join(top, dirname))
+        except OSError:
+            return
+        dirname = os.path.dirname(dirname)
+
+def _write(top, path, contents, posix):
+    fullpath = os.path.join(top, path)
+    if contents is None:
+        if os.path.lexists(fullpath):
+            os.unlink(fullpath)
+        if not posix:
+            _remove_empty_dirs(top, path)
+        return
+    dirname = os.path.dirname(fullpath)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmp_path = os.path.join(dirname, '.%s.stdeb-patch'%
+                            os.path.basename(fullpath))
+    fd = open(tmp_path, mode='wb')
+    try:
+        fd.write(contents)
+    finally:
+        fd.close()
+    if os.path.exists(fullpath):
+        os.chmod(tmp_path, os.stat(fullpath).st_mode & 07777)
+    os.rename(tmp_path, fullpath)
+
+def apply_patches(patchfiles, cwd=None, level=0, posix=False, dry_run=False):
+    """apply the patch files in order, as "patch -p[level] [--posix]" does
+
+    Every hunk of every patch is applied in memory before any file is
+    written; if one does not apply, PatchError is raised and nothing
+    is changed. With dry_run, nothing is written at all. Returns the
+    paths changed, relative to cwd.
+    """
+    if cwd is None:
+        cwd = os.getcwd()
+    tree = _Tree(cwd)
+    for patchfile in patchfiles:
+        fd = open(patchfile, mode='rb')
+        try:
+            data = fd.read()
+        finally:
+            fd.close()
+        for file_patch in parse_patch(data, patchfile):
+            path = _choose_path(file_patch, level, posix, tree)
+            if file_patch.creates and tree.exists(path):
+                if tree.read(path):
+                    raise PatchError('%s would create %s, which already '
+                                     'exists'%(patchfile, path))
+                old_data = ''
+            elif file_patch.creates or not tree.exists(path):
+                old_data = ''
+            else:
+                old_data = tree.read(path)
+            log.info('%s file %s', dry_run and 'checking' or 'patching',
+                     path)
+            new_data = _apply_hunks(old_data, file_patch, path, patchfile)
+            if file_patch.deletes and not new_data and not posix:
+                new_data = None
+            elif file_patch.deletes and new_data:
+                log.warn('WARNING: not deleting %s as its contents '
+                         'differ from %s', path, patchfile)
+            tree.set(path, new_data)
+    if not dry_run:
+        for path in tree.order:
+            _write(cwd, path, tree.contents[path], posix)
+    return tree.order
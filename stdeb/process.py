@@ -0,0 +1,493 @@
+#
+# Execution of external commands, with accounting.
+#
+# Every external command stdeb runs goes through this module, which
+# records its wall time, CPU time, exit status and (when the output
+# passes through stdeb) the number of bytes it wrote. The totals can
+# be printed or written as JSON with --report-subprocesses.
+#
+# Commands run with a timeout (--command-timeout sets the default) get
+# a process group of their own, which is terminated, then killed, when
+# the time is up.
+#
+import sys, os, time, errno, select, signal, subprocess, traceback
+import multiprocessing
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from stdeb import log
+
+__all__ = ['Popen','run','call','get_output','iter_output','iter_lines',
+           'call_in_fork','accounting','get_cpu_count','CommandTimeout',
+           'INHERIT','RELAY','CAPTURE']
+
+# what run() does with the stdout or stderr of a command
+INHERIT = 'inherit' # the command writes to ours directly
+RELAY = 'relay'     # copied to sys.stdout or sys.stderr as it arrives
+CAPTURE = 'capture' # kept in memory and returned
+
+BUFSIZE = 64*1024
+
+# seconds between SIGTERM and SIGKILL when stopping a command
+KILL_GRACE_TIME = 5.0
+
+# timeout in seconds of the commands not given one (None: no limit)
+default_timeout = None
+
+class CommandTimeout(RuntimeError):
+    """a command ran out of time and was stopped"""
+    def __init__(self, command, timeout):
+        RuntimeError.__init__(self, '%s did not finish within %s s'%(
+            ' '.join(command), timeout))
+        self.command = command
+        self.timeout = timeout
+
+def get_cpu_count():
+    """return the number of CPUs, or 1 if it cannot be found"""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def _children_cpu_time():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+class CommandRecord:
+    """what was run, for how long and with what result"""
+    def __init__(self, args, cwd=None):
+        self.args = list(args)
+        self.cwd = cwd
+        self.wall_time = None
+        self.cpu_time = None
+        self.returncode = None
+        self.stdout_bytes = None
+        self.stderr_bytes = None
+
+    def get_name(self):
+        """the program name used to group commands in reports"""
+        return os.path.basename(self.args[0])
+
+    def as_dict(self):
+        return {'args':self.args,
+                'cwd':self.cwd,
+                'wall_time':self.wall_time,
+                'cpu_time':self.cpu_time,
+                'returncode':self.returncode,
+                'stdout_bytes':self.stdout_bytes,
+                'stderr_bytes':self.stderr_bytes,
+                }
+
+    def from_dict(cls, data):
+        self = cls(data['args'], cwd=data.get('cwd'))
+        for attr in ['wall_time','cpu_time','returncode',
+                     'stdout_bytes','stderr_bytes']:
+            setattr(self, attr, data.get(attr))
+        return self
+    from_dict = classmethod(from_dict)
+
+class ProcessAccounting:
+    """the CommandRecords of all external commands run by this process"""
+    def __init__(self):
+        self.records = []
+
+    def add(self, record):
+        self.records.append(record)
+
+    def extend_from_file(self, fname):
+        """add the records from a JSON report written by another process"""
+        fd = open(fname,mode='r')
+        try:
+            data = json.load(fd)
+        finally:
+            fd.close()
+        for rec in data['commands']:
+            self.add(CommandRecord.from_dict(rec))
+
+    def get_totals(self):
+        """return {program name: totals dict}"""
+        totals = {}
+        for record in self.records:
+            tot = totals.setdefault(record.get_name(),
+                                    {'runs':0,
+                                     'failures':0,
+                                     'wall_time':0.0,
+                                     'cpu_time':0.0,
+                                     'output_bytes':0,
+                                     })
+            tot['runs'] += 1
+            if record.returncode:
+                tot['failures'] += 1
+            tot['wall_time'] += record.wall_time or 0.0
+            tot['cpu_time'] += record.cpu_time or 0.0
+            for nbytes in [record.stdout_bytes, record.stderr_bytes]:
+                if nbytes is not None:
+                    tot['output_bytes'] += nbytes
+        return totals
+
+    def as_dict(self):
+        return {'commands':[r.as_dict() for r in self.records],
+                'totals':self.get_totals(),
+                }
+
+    def format_report(self):
+        totals = self.get_totals()
+        names = totals.keys()
+        # the most expensive commands first
+        names.sort(key=lambda name: -totals[name]['wall_time'])
+        lines = ['%-24s %5s %5s %10s %10s %12s'%(
+            'command','runs','fails','wall (s)','cpu (s)','output (B)')]
+        all_wall = all_cpu = 0.0
+        for name in names:
+            tot = totals[name]
+            lines.append('%-24s %5d %5d %10.3f %10.3f %12d'%(
+                name, tot['runs'], tot['failures'], tot['wall_time'],
+                tot['cpu_time'], tot['output_bytes']))
+            all_wall += tot['wall_time']
+            all_cpu += tot['cpu_time']
+        lines.append('%d external command(s), %.3f s wall, %.3f s cpu'%(
+            len(self.records), all_wall, all_cpu))
+        return '\n'.join(lines)
+
+    def write_report(self, dest):
+        """print the report (dest is '-') or write it as JSON to dest"""
+        if dest == '-':
+            log.info('external commands run:\n%s', self.format_report())
+            return
+        fd = open(dest,mode='w')
+        try:
+            json.dump(self.as_dict(), fd, indent=2)
+            fd.write('\n')
+        finally:
+            fd.close()
+
+accounting = ProcessAccounting()
+
+class Popen(subprocess.Popen):
+    """subprocess.Popen which records the command in accounting
+
+    The record is added once the exit status has been collected by
+    wait(), poll() or communicate(). Output sizes are known only if
+    the output was read with communicate() or iter_chunks(), or
+    reported with add_output_bytes().
+
+    Given a timeout (in seconds), the command runs in a process group
+    of its own (made before any preexec_fn is called), and
+    iter_chunks() and wait_for_exit() stop it and raise CommandTimeout
+    once the time is up.
+    """
+    def __init__(self, args, timeout=None, **kwargs):
+        self.record = CommandRecord(args, cwd=kwargs.get('cwd'))
+        self._start_time = time.time()
+        self._start_cpu = _children_cpu_time()
+        self._recorded = False
+        self.timeout = timeout
+        self.deadline = None
+        self.new_group = timeout is not None
+        if self.new_group:
+            self.deadline = self._start_time + timeout
+            preexec_fn = kwargs.get('preexec_fn')
+            def setpgrp_then_preexec():
+                os.setpgrp()
+                if preexec_fn is not None:
+                    preexec_fn()
+            kwargs['preexec_fn'] = setpgrp_then_preexec
+        subprocess.Popen.__init__(self, args, **kwargs)
+
+    def _finish(self):
+        if self._recorded or self.returncode is None:
+            return
+        self._recorded = True
+        self.record.wall_time = time.time()-self._start_time
+        self.record.cpu_time = _children_cpu_time()-self._start_cpu
+        self.record.returncode = self.returncode
+        accounting.add(self.record)
+
+    def add_output_bytes(self, nbytes, stderr=False):
+        """account for output read from the process by the caller"""
+        if stderr:
+            self.record.stderr_bytes = (self.record.stderr_bytes or 0) + nbytes
+        else:
+            self.record.stdout_bytes = (self.record.stdout_bytes or 0) + nbytes
+
+    def iter_chunks(self):
+        """yield ('stdout' or 'stderr', data) as output arrives on the pipes
+
+        Ends once all pipes are closed. Data comes in chunks of up to
+        BUFSIZE bytes, as much as is available.
+        """
+        pipes = {}
+        for name, pipe in [('stdout',self.stdout), ('stderr',self.stderr)]:
+            if pipe is not None:
+                pipes[pipe.fileno()] = name
+        while pipes:
+            wait = None
+            if self.deadline is not None:
+                wait = self.deadline - time.time()
+                if wait <= 0:
+                    self._time_out()
+            try:
+                ready = select.select(pipes.keys(), [], [], wait)[0]
+            except select.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                data = os.read(fd, BUFSIZE)
+                if not data:
+                    del pipes[fd]
+                    continue
+                self.add_output_bytes(len(data),
+                                      stderr=pipes[fd] == 'stderr')
+                yield pipes[fd], data
+
+    def _poll_until(self, deadline):
+        """wait for the command until deadline, return whether it exited"""
+        delay = 0.001
+        while self.poll() is None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay*2, 0.05)
+        return True
+
+    def wait_for_exit(self):
+        """wait(), but stop the command if it runs out of time"""
+        if self.deadline is None:
+            return self.wait()
+        if not self._poll_until(self.deadline):
+            self._time_out()
+        return self.returncode
+
+    def _time_out(self):
+        log.error('ERROR: %s did not finish within %s s, stopping it',
+                  ' '.join(self.record.args), self.timeout)
+        self.stop()
+        raise CommandTimeout(self.record.args, self.timeout)
+
+    def stop(self, grace=KILL_GRACE_TIME):
+        """terminate the command, kill it if still there after grace seconds
+
+        If the command has a process group of its own, all of it is
+        terminated, and killed once grace seconds have passed or the
+        command has exited.
+        """
+        for sig in [signal.SIGTERM, signal.SIGKILL]:
+            try:
+                if self.new_group:
+                    os.killpg(self.pid, sig)
+                elif self.returncode is None:
+                    os.kill(self.pid, sig)
+            except OSError, err:
+                if err.errno not in (errno.ESRCH, errno.EPERM):
+                    raise
+            if sig == signal.SIGTERM:
+                self._poll_until(time.time()+grace)
+        self.wait()
+
+    def poll(self):
+        returncode = subprocess.Popen.poll(self)
+        self._finish()
+        return returncode
+
+    def wait(self):
+        returncode = subprocess.Popen.wait(self)
+        self._finish()
+        return returncode
+
+    def communicate(self, input=None):
+        stdout, stderr = subprocess.Popen.communicate(self, input)
+        if stdout is not None:
+            self.record.stdout_bytes = len(stdout)
+        if stderr is not None:
+            self.record.stderr_bytes = len(stderr)
+        self._finish()
+        return stdout, stderr
+
+def run(args, stdout=INHERIT, stderr=INHERIT, timeout=None, **kwargs):
+    """run a command to completion, return (exit status, stdout, stderr)
+
+    stdout and stderr are INHERIT, RELAY or CAPTURE. The output is
+    returned only if captured (else None is). If the command runs
+    longer than timeout seconds (default_timeout if None), its process
+    group is stopped and CommandTimeout raised. Other keyword
+    arguments are those of Popen.
+    """
+    if timeout is None:
+        timeout = default_timeout
+    modes = {'stdout':stdout, 'stderr':stderr}
+    sinks = {'stdout':sys.stdout, 'stderr':sys.stderr}
+    captured = {'stdout':None, 'stderr':None}
+    for name, mode in modes.items():
+        if mode not in (INHERIT, RELAY, CAPTURE):
+            raise ValueError('unknown output mode %r'%mode)
+        if mode != INHERIT:
+            kwargs[name] = subprocess.PIPE
+        if mode == CAPTURE:
+            captured[name] = []
+    # what is buffered here comes before the output of the command
+    sys.stdout.flush()
+    sys.stderr.flush()
+    proc = Popen(args, timeout=timeout, **kwargs)
+    try:
+        try:
+            for name, data in proc.iter_chunks():
+                if modes[name] == CAPTURE:
+                    captured[name].append(data)
+                else:
+                    sinks[name].write(data)
+                    sinks[name].flush()
+            proc.wait_for_exit()
+        except CommandTimeout:
+            raise
+        except:
+            # e.g. KeyboardInterrupt, which a command in its own
+            # process group does not get
+            proc.stop(grace=0)
+            raise
+    finally:
+        for pipe in [proc.stdout, proc.stderr]:
+            if pipe is not None:
+                pipe.close()
+    for name in captured:
+        if captured[name] is not None:
+            captured[name] = ''.join(captured[name])
+    return proc.returncode, captured['stdout'], captured['stderr']
+
+def call(args, timeout=None, **kwargs):
+    """run a command, wait for it and return its exit status"""
+    return run(args, timeout=timeout, **kwargs)[0]
+
+def get_output(args, timeout=None, **kwargs):
+    """run a command and return (exit status, stdout)"""
+    returncode, stdout, stderr = run(args, stdout=CAPTURE, timeout=timeout,
+                                     **kwargs)
+    return returncode, stdout
+
+def iter_output(args, timeout=None, **kwargs):
+    """run a command, yielding its stdout in chunks as it arrives
+
+    Raises RuntimeError if the command fails, and CommandTimeout as
+    run() does. If the caller stops early, the pipe is closed and the
+    command waited for, for up to KILL_GRACE_TIME seconds, after which
+    it (or its process group) is killed.
+    """
+    if timeout is None:
+        timeout = default_timeout
+    proc = Popen(args, stdout=subprocess.PIPE, timeout=timeout, **kwargs)
+    try:
+        try:
+            for name, data in proc.iter_chunks():
+                yield data
+        finally:
+            proc.stdout.close()
+    except (GeneratorExit, CommandTimeout):
+        if proc.returncode is None:
+            # most commands exit once their output pipe is closed
+            deadline = time.time() + KILL_GRACE_TIME
+            if proc.deadline is not None:
+                deadline = min(deadline, proc.deadline)
+            if not proc._poll_until(deadline):
+                proc.stop(grace=0)
+        raise
+    except:
+        proc.stop(grace=0)
+        raise
+    proc.wait_for_exit()
+    if proc.returncode:
+        log.error('ERROR running: %s', ' '.join(args))
+        raise RuntimeError('returncode %d from subprocess %s' % (
+            proc.returncode, args))
+
+def iter_lines(chunks):
+    """yield the lines, with their newline, of a sequence of chunks"""
+    tail = ''
+    for chunk in chunks:
+        lines = (tail + chunk).split('\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if tail:
+        yield tail
+
+def call_in_fork(func, args=(), cwd=None, name=None):
+    """run func(*args) in a forked child process and return its exit status
+
+    func returns the exit status (or raises SystemExit). The child
+    starts in cwd, and reports back over a pipe which external
+    commands it ran, so that they are added to accounting here, along
+    with a record of the child itself under name (func's name by
+    default).
+    """
+    if name is None:
+        name = func.__name__
+    record = CommandRecord([name]+[str(arg) for arg in args], cwd=cwd)
+    start_time = time.time()
+    start_cpu = _children_cpu_time()
+    # do not let the child print what is still buffered here
+    sys.stdout.flush()
+    sys.stderr.flush()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_fd)
+            n_records = len(accounting.records)
+            try:
+                if cwd is not None:
+                    os.chdir(cwd)
+                status = func(*args)
+            except SystemExit, err:
+                if err.code is None:
+                    status = 0
+                elif isinstance(err.code, int):
+                    status = err.code
+                else:
+                    print >> sys.stderr, err.code
+                    status = 1
+            except:
+                traceback.print_exc()
+                status = 1
+            if status is None:
+                status = 0
+            fd = os.fdopen(write_fd, 'w')
+            json.dump({'returncode':status,
+                       'commands':[rec.as_dict() for rec in
+                                   accounting.records[n_records:]],
+                       }, fd)
+            fd.close()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(status & 0xff)
+    os.close(write_fd)
+    fd = os.fdopen(read_fd, 'r')
+    try:
+        data = fd.read()
+    finally:
+        fd.close()
+    status = os.waitpid(pid, 0)[1]
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    if data:
+        report = json.loads(data)
+        for rec in report['commands']:
+            accounting.add(CommandRecord.from_dict(rec))
+    record.wall_time = time.time()-start_time
+    record.cpu_time = _children_cpu_time()-start_cpu
+    record.returncode = returncode
+    accounting.add(record)
+    return returncode
@@ -1,39 +1,70 @@
 #!/usr/bin/env python
 USAGE = """\
-usage: py2dsc [options] distfile
+usage: py2dsc [options] distfile [distfile ...]
+   or: py2dsc [options] --from-file=listfile
    or: py2dsc --help
 
 where distfile is a .zip or .tar.gz file built with the sdist command
-of distutils.
+of distutils. Several distfiles (given on the command line, or one per
+line in listfile) are built concurrently, each in its own scratch
+directory, and a summary is printed at the end.
 """
 
-import sys, os, shutil, subprocess
-from ConfigParser import SafeConfigParser
+import sys, os, shutil, copy, time, tempfile, traceback
 from distutils.util import strtobool
 from distutils.fancy_getopt import FancyGetopt, translate_longopt
 from stdeb.util import stdeb_cmdline_opts, stdeb_cmd_bool_opts
 from stdeb.util import expand_sdist_file, apply_patch
-from stdeb import log
-
-from setuptools.package_index import PackageIndex, distros_for_filename, \
-                                     EXTENSIONS
-from pkg_resources import Requirement, Distribution
-
-EXTRA_OPTS = [('process-dependencies', 'D', "process package dependencies")]
-
+from stdeb import log, process
+from stdeb.process import get_cpu_count
+from stdeb.config import Config
+from stdeb.depgraph import DependencyGraph, CycleError, run_in_order
+from stdeb.stdeb_run_setup import run_setup
+
+# setuptools.package_index and pkg_resources are only imported when a
+# distfile is resolved, so that "py2dsc --help" starts quickly
+
+EXTRA_OPTS = [('process-dependencies', 'D', "process package dependencies"),
+              ('jobs=', 'j',
+               "number of distfiles to build at once "
+               "(default: the number of CPUs)"),
+              ('from-file=', 'f',
+               "read the distfiles to build from this file, one per line"),
+              ('setup-in-subprocess', None,
+               "run setup.py in a new Python interpreter rather than in "
+               "a fork of py2dsc"),
+              ]
+
+# options used by py2dsc itself, not passed on to sdist_dsc
+PY2DSC_OPTS = ['dist-dir=','patch-file=','process-dependencies',
+               'report-subprocesses=','jobs=','from-file=',
+               'setup-in-subprocess']
 
 class OptObj: pass
 
+def read_distfile_list(fname):
+    """return the distfiles listed in fname, ignoring blanks and comments"""
+    result = []
+    fd = open(fname,mode='r')
+    try:
+        for line in fd:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                result.append(line)
+    finally:
+        fd.close()
+    return result
+
 def runit():
     # process command-line options
     bool_opts = map(translate_longopt, stdeb_cmd_bool_opts)
     bool_opts.append('process-dependencies')
+    bool_opts.append('setup-in-subprocess')
     parser = FancyGetopt(stdeb_cmdline_opts+[
         ('help', 'h', "show detailed help message"),
         ]+EXTRA_OPTS)
     optobj = OptObj()
     args = parser.getopt(object=optobj)
-    idx = PackageIndex()
     for option in optobj.__dict__:
         value = getattr(optobj,option)
         is_string = type(value) == str
@@ -46,29 +77,212 @@ def runit():
         parser.print_help("Options:")
         return 0
 
-    if len(args)!=1:
-        log.error('not given single argument (distfile), args=%r', args)
+    if hasattr(optobj,'from_file'):
+        args = args + read_distfile_list(optobj.from_file)
+
+    if not args:
+        log.error('not given any distfile')
         print USAGE
         return 1
 
+    jobs = int(optobj.__dict__.get('jobs',0)) or get_cpu_count()
+    report_subprocesses = optobj.__dict__.get('report_subprocesses',None)
+    if optobj.__dict__.get('command_timeout') is not None:
+        process.default_timeout = float(optobj.command_timeout)
+
+    process_dependencies = bool(int(optobj.__dict__.get(
+        'process_dependencies',0)))
+    if len(args) == 1 and not process_dependencies:
+        returncode = build_package(args[0], parser, optobj, bool_opts)
+    else:
+        returncode = build_batch(args, jobs, parser, optobj, bool_opts,
+                                 process_dependencies=process_dependencies)
 
-    sdist_file = args[0]
+    if report_subprocesses is not None:
+        process.accounting.write_report(report_subprocesses)
+    return returncode
 
-    package = None
+############################################################
+# batch mode
 
-    final_dist_dir = optobj.__dict__.get('dist_dir','deb_dist')
-    tmp_dist_dir = os.path.join(final_dist_dir,'tmp_py2dsc')
-    if os.path.exists(tmp_dist_dir):
-        shutil.rmtree(tmp_dist_dir)
-    os.makedirs(tmp_dist_dir)
+def plan_builds(distfiles, download_dir, process_dependencies=False):
+    """return the DependencyGraph of what to build and the node details
 
+    The nodes are project keys (or distfile names if no project was
+    found) and the details map each node to (distfile, Distribution
+    or None). With process_dependencies, the requirements of every
+    package are resolved (and downloaded if necessary) recursively
+    and each project becomes a single node, however often it is
+    required.
+    """
+    from setuptools.package_index import PackageIndex
+    idx = PackageIndex()
+    graph = DependencyGraph()
+    details = {}
+    def add(name):
+        sdist_file, package = resolve_distfile(name, idx, download_dir)
+        if package is None:
+            node = sdist_file
+        else:
+            node = package.key
+        if node not in details:
+            details[node] = (sdist_file, package)
+            graph.add_node(node)
+        return node
+    todo = [add(name) for name in distfiles]
+    seen = set(todo)
+    while process_dependencies and todo:
+        node = todo.pop(0)
+        sdist_file, package = details[node]
+        if package is None:
+            log.warn('WARNING: cannot find the requirements of %s',
+                     sdist_file)
+            continue
+        for req in package.requires():
+            dep = req.key
+            if dep not in details:
+                log.info("Resolving dependency %s of %s", req, package)
+                dep = add("%s" % req)
+            elif details[dep][1] is not None and details[dep][1] not in req:
+                log.warn('WARNING: %s requires %s, but %s is built',
+                         package, req, details[dep][1])
+            graph.add_dependency(node, dep)
+            if dep not in seen:
+                seen.add(dep)
+                todo.append(dep)
+    return graph, details
+
+# set in the parent before the worker processes are forked
+_batch_state = None
+
+def _move_into(src_dir, dest_dir):
+    """move everything in src_dir into dest_dir, replacing existing files"""
+    for name in os.listdir(src_dir):
+        dest = os.path.join(dest_dir, name)
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            shutil.rmtree(dest)
+        elif os.path.lexists(dest):
+            os.unlink(dest)
+        os.rename(os.path.join(src_dir, name), dest)
+
+def _run_job(node):
+    """build one package of a batch in a scratch dir, return a result dict"""
+    parser, optobj, bool_opts, final_dist_dir, details = _batch_state
+    sdist_file = details[node][0]
+    scratch_dir = tempfile.mkdtemp(prefix='tmp_py2dsc_job_',
+                                   dir=final_dist_dir)
+    n_records = len(process.accounting.records)
+    start = time.time()
+    result = {'sdist_file':sdist_file,
+              'scratch_dir':scratch_dir,
+              'error':None,
+              }
+    try:
+        returncode = build_package(sdist_file, parser, optobj, bool_opts,
+                                   dist_dir=scratch_dir,
+                                   resolved=details[node])
+    except Exception, err:
+        log.error('ERROR building %s:\n%s', sdist_file,
+                  traceback.format_exc())
+        returncode = 1
+        result['error'] = '%s: %s'%(err.__class__.__name__, err)
+    if not returncode:
+        _move_into(scratch_dir, final_dist_dir)
+        shutil.rmtree(scratch_dir)
+    result['returncode'] = returncode
+    result['duration'] = time.time()-start
+    # the accounting of this job, for the parent to merge
+    result['commands'] = [rec.as_dict() for rec in
+                          process.accounting.records[n_records:]]
+    return result
+
+def format_summary(results):
+    """format [(distfile, result dict or None if skipped)] as a table"""
+    lines = ['%-40s %-8s %10s'%('distfile','result','time (s)')]
+    n_failed = n_skipped = 0
+    for sdist_file, result in results:
+        name = os.path.basename(sdist_file)
+        if result is None:
+            n_skipped += 1
+            lines.append('%-40s %-8s %10s'%(name, 'skipped', '-'))
+            continue
+        if result['returncode']:
+            status = 'FAILED'
+            n_failed += 1
+        else:
+            status = 'ok'
+        lines.append('%-40s %-8s %10.1f'%(name, status, result['duration']))
+        if result['returncode']:
+            if result['error'] is not None:
+                lines.append('    %s'%result['error'])
+            lines.append('    scratch directory kept: %s'%
+                         result['scratch_dir'])
+    lines.append('%d built, %d failed, %d skipped'%(
+        len(results)-n_failed-n_skipped, n_failed, n_skipped))
+    return '\n'.join(lines)
+
+def build_batch(distfiles, jobs, parser, optobj, bool_opts,
+                process_dependencies=False):
+    """build many packages with a pool of jobs worker processes
+
+    Packages are built after the packages they depend on (when
+    process_dependencies is set), independent ones concurrently.
+    """
+    global _batch_state
+    final_dist_dir = optobj.__dict__.get('dist_dir','deb_dist')
+    if not os.path.exists(final_dist_dir):
+        os.makedirs(final_dist_dir)
+    graph, details = plan_builds(distfiles, final_dist_dir,
+                                 process_dependencies=process_dependencies)
+    try:
+        order = graph.topological_order()
+    except CycleError, err:
+        log.error('ERROR: cannot build packages with a %s', err)
+        return 1
+    jobs = min(jobs, len(order))
+    log.info('building %d packages, %d at a time', len(order), jobs)
+    _batch_state = parser, optobj, bool_opts, final_dist_dir, details
+    start = time.time()
+    try:
+        results = run_in_order(graph, _run_job, jobs=jobs,
+                               is_success=lambda result:
+                                   not result['returncode'])
+    finally:
+        _batch_state = None
+    if jobs > 1:
+        for result in results.itervalues():
+            if result is None:
+                continue
+            for rec in result['commands']:
+                process.accounting.add(process.CommandRecord.from_dict(rec))
+    log.info('-='*35 + '-')
+    log.info('%s\nfinished in %.1f s', format_summary(
+        [(details[node][0], results[node]) for node in order]),
+             time.time()-start)
+    for result in results.itervalues():
+        if result is None or result['returncode']:
+            return 1
+    return 0
+
+############################################################
+# a single package
+
+def resolve_distfile(sdist_file, idx, download_dir):
+    """return (distfile, Distribution or None) for a distfile or requirement
+
+    If sdist_file is not an existing file, it is taken as a
+    requirement and the matching source distribution is downloaded
+    from PyPI into download_dir.
+    """
+    from setuptools.package_index import distros_for_filename, EXTENSIONS
+    from pkg_resources import Requirement
     if not os.path.isfile(sdist_file):
         for ext in EXTENSIONS:
             if sdist_file.endswith(ext):
                 raise IOError, "File not found"
         package = Requirement.parse(sdist_file)
         log.info("Package %s not found, trying PyPI..." % sdist_file)
-        dist = idx.fetch_distribution(package, final_dist_dir,
+        dist = idx.fetch_distribution(package, download_dir,
                                             force_scan=True,
                                             source=True)
         if hasattr(dist, 'location'):
@@ -80,32 +294,41 @@ def runit():
     dist = list(distros_for_filename(sdist_file))[0]
     idx.scan_egg_links(dist.location)
     package = idx.obtain(Requirement.parse(dist.project_name))
+    return sdist_file, package
+
+def build_package(sdist_file, parser, optobj, bool_opts, dist_dir=None,
+                  resolved=None):
+    """make a Debian source package of sdist_file, return the exit status
+
+    resolved is what resolve_distfile() returns for sdist_file, if
+    already known. Dependencies are not built, see build_batch() for
+    that.
+    """
+    # per-package settings from the extra config file must not leak
+    # into other packages
+    optobj = copy.copy(optobj)
+
+    if dist_dir is None:
+        dist_dir = optobj.__dict__.get('dist_dir','deb_dist')
+    final_dist_dir = dist_dir
+    tmp_dist_dir = os.path.join(final_dist_dir,'tmp_py2dsc')
+    if os.path.exists(tmp_dist_dir):
+        shutil.rmtree(tmp_dist_dir)
+    os.makedirs(tmp_dist_dir)
 
-    if hasattr(optobj, 'process_dependencies'):
-        if bool(int(getattr(optobj, 'process_dependencies'))):
-            backup_argv = sys.argv[:]
-            oldargv = sys.argv[:]
-            oldargv.pop(-1)
-
-            if package.requires():
-                log.info("Processing package dependencies for %s", package)
-            for req in package.requires():
-#                print >> sys.stderr
-                new_argv = oldargv + ["%s" % req]
-                log.info("Bulding dependency package %s", req)
-                log.info("  running '%s'", ' '.join(new_argv))
-                sys.argv = new_argv
-                runit()
-#                print >> sys.stderr
-            if package.requires():
-                log.info("Completed building dependencies "
-                         "for %s, continuing...", package)
-        sys.argv = backup_argv
+    if resolved is None:
+        from setuptools.package_index import PackageIndex
+        resolved = resolve_distfile(sdist_file, PackageIndex(),
+                                    final_dist_dir)
+    sdist_file, package = resolved
 
     if package is not None and hasattr(optobj, 'extra_cfg_file'):
         # Allow one to have patch-files setup on config file for example
-        local_parser = SafeConfigParser()
-        local_parser.readfp(open(optobj.__dict__.get('extra_cfg_file')))
+        # (parsed once however many packages are built)
+        extra_cfg_file = optobj.__dict__.get('extra_cfg_file')
+        local_parser = Config([extra_cfg_file])
+        if not local_parser.files:
+            raise IOError('cannot read %s'%extra_cfg_file)
         if local_parser.has_section(package.project_name):
             for opt in local_parser.options(package.project_name):
                 _opt = opt.replace('_', '-')
@@ -154,10 +377,11 @@ def runit():
 
 
     abs_dist_dir = os.path.abspath(final_dist_dir)
+    report_subprocesses = optobj.__dict__.get('report_subprocesses',None)
 
     extra_args = []
     for long in parser.long_opts:
-        if long in ['dist-dir=','patch-file=', 'process-dependencies']:
+        if long in PY2DSC_OPTS:
             continue # dealt with by this invocation
         attr = parser.get_attr_name(long).rstrip('=')
         if hasattr(optobj,attr):
@@ -172,10 +396,30 @@ def runit():
     if patch_already_applied == 1:
         extra_args.append('--patch-already-applied')
 
-    args = [sys.executable,'-c',"import stdeb, sys; f='setup.py'; " + \
-            "sys.argv[0]=f; execfile(f,{'__file__':f,'__name__':'__main__'})",
-            'sdist_dsc','--dist-dir=%s'%abs_dist_dir,
-            '--use-premade-distfile=%s'%os.path.abspath(sdist_file)]+extra_args
+    # Unless asked otherwise, run setup.py in a fork of this process,
+    # which has already imported stdeb. The child still
+    # gets its own directory, sys.argv and sys.path, as a new
+    # interpreter would.
+    in_subprocess = (bool(int(optobj.__dict__.get('setup_in_subprocess',0)))
+                     or not hasattr(os,'fork'))
+
+    if in_subprocess and report_subprocesses is not None:
+        # have sdist_dsc save its own accounting so that it can be
+        # merged with ours (a fork reports it over its pipe)
+        child_report = os.path.abspath(os.path.join(tmp_dist_dir,
+                                                    'subprocesses.json'))
+        extra_args.append('--report-subprocesses=%s'%child_report)
+
+    setup_args = ['sdist_dsc','--dist-dir=%s'%abs_dist_dir,
+                  '--use-premade-distfile=%s'%os.path.abspath(sdist_file)
+                  ]+extra_args
+    if in_subprocess:
+        args = [sys.executable,'-c',"import setuptools, stdeb, sys; f='setup.py'; " + \
+                "sys.argv[0]=f; "
+                "execfile(f,{'__file__':f,'__name__':'__main__'})"
+                ]+setup_args
+    else:
+        args = ['setup.py']+setup_args
 
     log.info('-='*35 + '-')
 #    print >> sys.stderr, '-='*20
@@ -187,14 +431,23 @@ def runit():
     log.info('-='*35 + '-')
 
     try:
-        returncode = subprocess.call(
-            args,cwd=fullpath_repackaged_dirname,
-            )
+        if in_subprocess:
+            returncode = process.call(
+                args,cwd=fullpath_repackaged_dirname,
+                )
+        else:
+            returncode = process.call_in_fork(
+                run_setup, (setup_args, fullpath_repackaged_dirname),
+                name='setup.py')
     except:
         log.error('ERROR running: %s', ' '.join(args))
         log.error('ERROR in %s', fullpath_repackaged_dirname)
         raise
 
+    if in_subprocess and report_subprocesses is not None:
+        if os.path.exists(child_report):
+            process.accounting.extend_from_file(child_report)
+
     if returncode:
         log.error('ERROR running: %s', ' '.join(args))
         log.error('ERROR in %s', fullpath_repackaged_dirname)
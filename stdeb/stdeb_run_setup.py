@@ -10,7 +10,25 @@ usage: stdeb_run_setup [options]
 import sys, os
 import stdeb
 
+def run_setup(args, cwd=None):
+    """run setup.py with args in cwd in this process, return the exit status
+
+    This changes the current directory, sys.argv and sys.path, so it
+    is meant to be called in a forked child process (see
+    stdeb.process.call_in_fork).
+    """
+    import setuptools # for the sdist_dsc command
+    if cwd is None:
+        cwd = os.path.abspath(os.curdir)
+    os.chdir(cwd)
+    f='setup.py'
+    sys.argv = [f]+list(args)
+    sys.path.insert(0,cwd) # as "python setup.py" would
+    execfile(f,{'__file__':f,'__name__':'__main__'})
+    return 0
+
 def main():
+    import setuptools # for the sdist_dsc command
     f='setup.py'
     sys.argv[0] = f
     sys.argv.insert(1,'sdist_dsc')
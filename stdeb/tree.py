@@ -0,0 +1,440 @@
+#
+# Copying of files and directory trees with as little data copying as
+# possible.
+#
+# clone_file() makes a hardlink if the caller says that sharing the
+# inode is safe. Otherwise, or if linking fails, it tries in order a
+# copy-on-write clone (FICLONE reflink), an in-kernel copy
+# (copy_file_range or sendfile) and finally a plain userspace copy.
+# Methods which fail with "not supported" for a pair of filesystems
+# are not tried again for that pair.
+#
+import os, errno, stat, hashlib
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = ['clone_file','clone_tree','link_or_clone','hash_file',
+           'TreeManifest']
+
+# from <linux/fs.h>: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+COPY_BUFSIZE = 1024*1024
+
+# errors meaning "this method does not work here", as opposed to a
+# real I/O error
+UNSUPPORTED_ERRNOS = set([errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                          errno.EPERM, errno.EBADF,
+                          getattr(errno,'ENOTSUP',errno.EOPNOTSUPP),
+                          errno.EOPNOTSUPP, errno.ENOTTY])
+
+# {method name: set((src st_dev, dst st_dev))} of known failures
+_unsupported = {}
+
+def _is_unsupported(method, devs):
+    return devs in _unsupported.get(method,())
+
+def _mark_unsupported(method, devs):
+    _unsupported.setdefault(method,set()).add(devs)
+
+_libc_funcs = {}
+
+def _get_libc_func(name):
+    """return (ctypes module, libc function) or None if unavailable"""
+    try:
+        return _libc_funcs[name]
+    except KeyError:
+        pass
+    result = None
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None,
+                           use_errno=True)
+        func = getattr(libc, name)
+        func.restype = ctypes.c_ssize_t
+        result = ctypes, func
+    except (ImportError, OSError, AttributeError):
+        pass
+    _libc_funcs[name] = result
+    return result
+
+def _copy_file_range(src_fd, dst_fd, count):
+    """copy count bytes in the kernel, returning the number copied"""
+    if hasattr(os,'copy_file_range'):
+        return os.copy_file_range(src_fd, dst_fd, count)
+    libc_func = _get_libc_func('copy_file_range')
+    if libc_func is None:
+        raise OSError(errno.ENOSYS, 'copy_file_range not available')
+    ctypes, func = libc_func
+    result = func(src_fd, None, dst_fd, None, ctypes.c_size_t(count), 0)
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+def _sendfile(src_fd, dst_fd, count):
+    if hasattr(os,'sendfile'):
+        return os.sendfile(dst_fd, src_fd, None, count)
+    libc_func = _get_libc_func('sendfile')
+    if libc_func is None:
+        raise OSError(errno.ENOSYS, 'sendfile not available')
+    ctypes, func = libc_func
+    result = func(dst_fd, src_fd, None, ctypes.c_size_t(count))
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+def _kernel_copy(copy_func, src_fd, dst_fd, size):
+    """copy size bytes with copy_func, returning False if not supported"""
+    copied = 0
+    while copied < size:
+        try:
+            n = copy_func(src_fd, dst_fd, min(size-copied, 1024*COPY_BUFSIZE))
+        except OSError, err:
+            if copied == 0 and err.errno in UNSUPPORTED_ERRNOS:
+                return False
+            raise
+        if n == 0:
+            break
+        copied += n
+    return True
+
+def _copy_data(src, dst, devs):
+    """copy the contents of file src to new file dst"""
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        size = os.fstat(src_fd).st_size
+        dst_fd = os.open(dst, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0600)
+        try:
+            if fcntl is not None and not _is_unsupported('reflink',devs):
+                try:
+                    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                    return 'reflink'
+                except (IOError, OSError), err:
+                    if err.errno not in UNSUPPORTED_ERRNOS:
+                        raise
+                    _mark_unsupported('reflink',devs)
+            for method, copy_func in [('copy_file_range',_copy_file_range),
+                                      ('sendfile',_sendfile)]:
+                if _is_unsupported(method,devs):
+                    continue
+                if _kernel_copy(copy_func, src_fd, dst_fd, size):
+                    return method
+                _mark_unsupported(method,devs)
+                # start over in case a partial copy was made
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.ftruncate(dst_fd, 0)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+            while 1:
+                buf = os.read(src_fd, COPY_BUFSIZE)
+                if not buf:
+                    break
+                while buf:
+                    n = os.write(dst_fd, buf)
+                    buf = buf[n:]
+            return 'copy'
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+def clone_file(src, dst, hardlink=False, src_st=None, dst_dev=None,
+               replace=True):
+    """copy file src to dst as cheaply as possible, preserving metadata
+
+    If hardlink is True, src and dst may end up sharing their inode, so
+    this is only safe if neither will be modified in place. Symlinks
+    are followed. An existing dst is replaced, unless replace is False
+    to say that dst is known not to exist. Returns the method used.
+    """
+    if src_st is None:
+        src_st = os.stat(src)
+    if dst_dev is None:
+        dst_dev = os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+    devs = (src_st.st_dev, dst_dev)
+    # matplotlib deletes link from the os namespace
+    if (hardlink and hasattr(os,'link') and devs[0] == devs[1] and
+        not _is_unsupported('link',devs)):
+        try:
+            os.link(src, dst)
+            return 'link'
+        except OSError, err:
+            if err.errno == errno.EEXIST:
+                dst_st = os.lstat(dst)
+                if (dst_st.st_dev, dst_st.st_ino) == (src_st.st_dev,
+                                                      src_st.st_ino):
+                    return 'link'
+                os.unlink(dst)
+                return clone_file(src, dst, hardlink=hardlink,
+                                  src_st=src_st, dst_dev=dst_dev)
+            if err.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            _mark_unsupported('link',devs)
+    if replace and os.path.lexists(dst):
+        os.unlink(dst)
+    method = _copy_data(src, dst, devs)
+    os.chmod(dst, stat.S_IMODE(src_st.st_mode))
+    os.utime(dst, (src_st.st_atime, src_st.st_mtime))
+    return method
+
+def link_or_clone(src, dst):
+    """hardlink src to dst, or clone it if that is not possible"""
+    return clone_file(src, dst, hardlink=True)
+
+def hash_file(fname, algorithm='sha1'):
+    """return the hex digest of the contents of fname"""
+    h = hashlib.new(algorithm)
+    fd = open(fname,mode='rb')
+    try:
+        while 1:
+            buf = fd.read(COPY_BUFSIZE)
+            if not buf:
+                break
+            h.update(buf)
+    finally:
+        fd.close()
+    return h.hexdigest()
+
+def _mkdir(path):
+    """create directory path, returning False if it already existed"""
+    try:
+        os.mkdir(path)
+    except OSError, err:
+        if err.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+        return False
+    return True
+
+def clone_tree(src, dst, hardlink=False, exclude=None, manifest=None):
+    """clone the directory tree src into dst (which may already exist)
+
+    Symlinks are recreated, files are cloned with clone_file() and the
+    modes and times of directories are copied once their contents are
+    in place. The tree is described by manifest, a TreeManifest of
+    src, which is built (passing on exclude) if not given. Returns the
+    manifest.
+    """
+    if manifest is None:
+        manifest = TreeManifest.scan(src, exclude=exclude)
+    directories = []
+    created = set() # directories created here, so known to be empty
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+        directories.append((dst, os.stat(src)))
+        created.add('')
+    dst_dev = os.stat(dst).st_dev
+    for entry in manifest:
+        dst_path = os.path.join(dst, entry.path)
+        replace = entry.path.rpartition('/')[0] not in created
+        if entry.type == DIRECTORY:
+            if _mkdir(dst_path):
+                created.add(entry.path)
+            directories.append((dst_path, entry.st))
+        elif entry.type == SYMLINK:
+            if replace and os.path.lexists(dst_path):
+                os.unlink(dst_path)
+            os.symlink(entry.linkname, dst_path)
+        elif entry.type == FILE:
+            clone_file(os.path.join(manifest.top, entry.path), dst_path,
+                       hardlink=hardlink, src_st=entry.st, dst_dev=dst_dev,
+                       replace=replace)
+    directories.reverse()
+    for dst_dir, st in directories:
+        os.chmod(dst_dir, stat.S_IMODE(st.st_mode))
+        os.utime(dst_dir, (st.st_atime, st.st_mtime))
+    return manifest
+
+############################################################
+# tree manifests
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+FILE = 'f'
+DIRECTORY = 'd'
+SYMLINK = 'l'
+OTHER = 'o'
+
+def _get_type(mode):
+    if stat.S_ISREG(mode):
+        return FILE
+    if stat.S_ISDIR(mode):
+        return DIRECTORY
+    if stat.S_ISLNK(mode):
+        return SYMLINK
+    return OTHER
+
+def _iter_dir(path):
+    """yield (name, lstat result) for the entries of directory path"""
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name, entry.stat(follow_symlinks=False)
+    else:
+        for name in os.listdir(path):
+            yield name, os.lstat(os.path.join(path, name))
+
+class ManifestEntry:
+    """one file, directory or symlink of a TreeManifest
+
+    path is relative to the top of the tree, with '/' as separator.
+    st is the lstat() result recorded when the tree was scanned.
+    """
+    def __init__(self, path, type, st, linkname=None, hash=None):
+        self.path = path
+        self.type = type
+        self.st = st
+        self.linkname = linkname
+        self.hash = hash
+
+    def get_size(self):
+        return self.st.st_size
+    size = property(get_size)
+
+    def get_mtime(self):
+        return self.st.st_mtime
+    mtime = property(get_mtime)
+
+    def get_mode(self):
+        return self.st.st_mode
+    mode = property(get_mode)
+
+class TreeManifest:
+    """everything below a directory, recorded in a single traversal
+
+    The entries are in the order a recursive walk visiting names in
+    sorted order would produce (each directory before its contents),
+    which is also the order in which they are written to tarballs.
+    Later stages query or filter the manifest instead of walking the
+    tree again.
+    """
+    def __init__(self, top, entries, hash_algorithm=None):
+        self.top = top
+        self.entries = entries
+        self.hash_algorithm = hash_algorithm
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def scan(cls, top, exclude=None, hash_algorithm=None,
+             follow_toplevel_symlinks=False):
+        """build the manifest of the directory top
+
+        exclude is an optional function called with the relative path
+        and type of each entry; entries for which it returns True are
+        left out (directories with all their contents). If
+        hash_algorithm is given, the files are hashed as well. With
+        follow_toplevel_symlinks, symlinks directly in top are
+        described (and descended into) as what they point to.
+        """
+        top = os.path.normpath(top)
+        entries = []
+        def scan_dir(prefix, dirname, follow):
+            children = list(_iter_dir(dirname))
+            children.sort(key=lambda child: child[0])
+            for name, st in children:
+                path = prefix+name
+                fullpath = os.path.join(dirname, name)
+                if follow and stat.S_ISLNK(st.st_mode):
+                    st = os.stat(fullpath)
+                type = _get_type(st.st_mode)
+                if exclude is not None and exclude(path, type):
+                    continue
+                entry = ManifestEntry(path, type, st)
+                if type == SYMLINK:
+                    entry.linkname = os.readlink(fullpath)
+                elif type == FILE and hash_algorithm is not None:
+                    entry.hash = hash_file(fullpath, hash_algorithm)
+                entries.append(entry)
+                if type == DIRECTORY:
+                    scan_dir(path+'/', fullpath, False)
+        scan_dir('', top, follow_toplevel_symlinks)
+        return cls(top, entries, hash_algorithm=hash_algorithm)
+    scan = classmethod(scan)
+
+    def filter(self, func):
+        """return a new manifest of the entries for which func is True"""
+        return self.__class__(self.top, [e for e in self.entries if func(e)],
+                              hash_algorithm=self.hash_algorithm)
+
+    def files(self):
+        """return the entries of regular files"""
+        return [e for e in self.entries if e.type == FILE]
+
+    def get_total_size(self):
+        """the total size in bytes of the regular files"""
+        total = 0
+        for entry in self.entries:
+            if entry.type == FILE:
+                total += entry.st.st_size
+        return total
+
+    def is_unchanged(self, top=None):
+        """check that no file in top has changed size, mtime or mode
+
+        Only the files are stat()ed, no directory is listed, so this
+        does not notice files added since the scan.
+        """
+        if top is None:
+            top = self.top
+        for entry in self.entries:
+            if entry.type != FILE:
+                continue
+            try:
+                st = os.lstat(os.path.join(top, entry.path))
+            except OSError:
+                return False
+            if (st.st_size, st.st_mtime, st.st_mode) != (
+                entry.st.st_size, entry.st.st_mtime, entry.st.st_mode):
+                return False
+        return True
+
+    def checksum(self, algorithm='sha1', known_hashes=None):
+        """return a hex digest of the tree's names, types, modes and data
+
+        Files hashed during the scan are not read again. known_hashes
+        is an optional dict mapping paths to the (size, mtime, hex
+        digest) of files hashed before; files whose size and mtime are
+        still the same are not read again either, even in a copy of
+        the tree made since. It is updated with the files hashed.
+
+        mtime is in whole seconds: os.utime() copies times only to the
+        microsecond, through a float, so a copy's mtime may differ from
+        the original's in the last digits.
+        """
+        h = hashlib.new(algorithm)
+        for entry in self.entries:
+            if entry.type == FILE:
+                if entry.hash is None or self.hash_algorithm != algorithm:
+                    key = (entry.st.st_size, int(entry.st.st_mtime))
+                    known = None
+                    if known_hashes is not None:
+                        known = known_hashes.get(entry.path)
+                    if known is not None and tuple(known[:2]) == key:
+                        entry.hash = known[2]
+                    else:
+                        entry.hash = hash_file(os.path.join(self.top,
+                                                            entry.path),
+                                               algorithm)
+                    if known_hashes is not None:
+                        known_hashes[entry.path] = key + (entry.hash,)
+                data = entry.hash
+            elif entry.type == SYMLINK:
+                data = entry.linkname
+            else:
+                data = ''
+            h.update('%s\0%s\0%o\0%s\n'%(entry.path, entry.type,
+                                             stat.S_IMODE(entry.st.st_mode),
+                                             data))
+        self.hash_algorithm = algorithm
+        return h.hexdigest()
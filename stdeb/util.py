@@ -1,19 +1,28 @@
 #
 # This module contains most of the code of stdeb.
 #
-import re, sys, os, shutil, select
+import re, sys, os, shutil, stat, gzip, tarfile
 import ConfigParser
-import subprocess
 import tempfile
+import cPickle as pickle
 import stdeb
-import pkg_resources
-from stdeb import log, __version__ as __stdeb_version__
-
-if hasattr(os,'link'):
-    link_func = os.link
-else:
-    # matplotlib deletes link from os namespace, expected distutils workaround
-    link_func = shutil.copyfile
+from stdeb import log, process, __version__ as __stdeb_version__
+from stdeb.process import get_cpu_count
+from stdeb.archive import expand_tarball, expand_zip, make_tarball, \
+     repack_as_tar_gz, expand_archive, ExtractionCache, DEFAULT_COMPRESSLEVEL
+from stdeb.dpkg import compare_versions, get_dpkg_status, DPKG_STATUS
+from stdeb.contents import ContentsIndex, get_contents_files, \
+     get_contents_signature
+from stdeb.tree import clone_tree, link_or_clone, TreeManifest, FILE, \
+     DIRECTORY, SYMLINK
+from stdeb.dsc import write_source_package, NotRepresentable
+from stdeb.patch import apply_patches, parse_patch, PatchError, \
+     Unsupported
+from stdeb.config import Config, split_vals
+
+# hardlink, or clone where that is not possible (e.g. across
+# filesystems, or when matplotlib has deleted link from os namespace)
+link_func = link_or_clone
 
 __all__ = ['DebianInfo','build_dsc','expand_tarball','expand_zip',
            'stdeb_cmdline_opts','stdeb_cmd_bool_opts','recursive_hardlink',
@@ -32,7 +41,7 @@ import exceptions
 class CalledProcessError(exceptions.Exception): pass
 
 def check_call(*popenargs, **kwargs):
-    retcode = subprocess.call(*popenargs, **kwargs)
+    retcode = process.call(*popenargs, **kwargs)
     if retcode == 0:
         return
     raise CalledProcessError(retcode)
@@ -75,6 +84,23 @@ stdeb_cmdline_opts = [
     ('xs-python-version=', None,
      'Build only for specified python versions. Force write XS-Python-Version'
      'to control file. (Default build for all installed pythons)'),
+    ('compression-level=', None,
+     'gzip compression level of generated .orig.tar.gz files, from 1 '
+     '(fastest) to 9 (smallest) (default=6)'),
+    ('report-subprocesses=', None,
+     'when done, print a summary of the external commands run (if "-") '
+     'or write it as JSON to the given file'),
+    ('extract-source-dir', None,
+     'recreate the expanded source directory with "dpkg-source -x" rather '
+     'than keeping the tree the source package was built from'),
+    ('force-rebuild', None,
+     'build even if nothing changed since the last build in dist-dir'),
+    ('use-dpkg-source', None,
+     'write the .diff.gz and .dsc with "dpkg-source -b" rather than '
+     'stdeb\'s own writer'),
+    ('command-timeout=', None,
+     'stop any external command still running after this many seconds '
+     '(default: no limit)'),
     ]
 
 stdeb_cmd_bool_opts = [
@@ -83,6 +109,9 @@ stdeb_cmd_bool_opts = [
     'patch-posix',
     'ignore-install-requires',
     'no-backwards-compatibility',
+    'extract-source-dir',
+    'force-rebuild',
+    'use-dpkg-source',
     ]
 
 class NotGiven: pass
@@ -93,27 +122,8 @@ def process_command(args, cwd=None):
     check_call(args, cwd=cwd)
 
 def recursive_hardlink(src,dst):
-    dst = os.path.abspath(dst)
-    orig_dir = os.path.abspath(os.curdir)
-    os.chdir(src)
-    try:
-        for root,dirs,files in os.walk(os.curdir):
-            for file in files:
-                fullpath = os.path.normpath(os.path.join(root,file))
-                dirname, fname = os.path.split(fullpath)
-                dstdir = os.path.normpath(os.path.join(dst,dirname))
-                if not os.path.exists(dstdir):
-                    os.makedirs(dstdir)
-                newpath = os.path.join(dstdir,fname)
-                if os.path.exists(newpath):
-                    if os.path.samefile(fullpath,newpath):
-                        continue
-                    else:
-                        os.unlink(newpath)
-                #print 'linking %s -> %s'%(fullpath,newpath)
-                link_func(fullpath,newpath)
-    finally:
-        os.chdir(orig_dir)
+    """hardlink (or clone) every file in directory src into directory dst"""
+    clone_tree(src,dst,hardlink=True)
 
 def debianize_name(name):
     "make name acceptable as a Debian (binary) package name"
@@ -139,25 +149,31 @@ def debianize_version(name):
     return name
 
 def dpkg_compare_versions(v1,op,v2):
-    args = ['/usr/bin/dpkg','--compare-versions',v1,op,v2]
-    cmd = subprocess.Popen(args)
-    returncode = cmd.wait()
-    if returncode:
+    """return whether 'dpkg --compare-versions v1 op v2' would succeed"""
+    try:
+        return compare_versions(v1,op,v2)
+    except ValueError, err:
+        log.warn('could not compare versions %r %s %r: %s', v1, op, v2, err)
         return False
-    else:
-        return True
 
-def get_cmd_stdout(args):
-    cmd = subprocess.Popen(args,stdout=subprocess.PIPE)
-    returncode = cmd.wait()
+def find_command(name, default):
+    """return the path of the first executable name on $PATH, or default"""
+    for dirname in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(dirname or os.curdir, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return default
+
+def get_cmd_stdout(args, timeout=None):
+    returncode, stdout = process.get_output(args, timeout=timeout)
     if returncode:
         log.error('ERROR running: %s', ' '.join(args))
         raise RuntimeError('returncode %d', returncode)
-    return cmd.stdout.read()
+    return stdout
 
 def get_date_822():
     """return output of 822-date command"""
-    cmd = '/bin/date'
+    cmd = find_command('date','/bin/date')
     if not os.path.exists(cmd):
         raise ValueError('%s command does not exist.'%cmd)
     args = [cmd,'-R']
@@ -165,9 +181,25 @@ def get_date_822():
     return result
 
 def get_version_str(pkg):
-    args = ['/usr/bin/dpkg-query','--show',
+    """return the version of Debian package pkg as dpkg-query shows it
+
+    This is '' if pkg is not installed, and RuntimeError is raised if
+    dpkg does not know pkg at all.
+    """
+    if os.path.exists(DPKG_STATUS):
+        # read the dpkg database once rather than forking dpkg-query
+        # for every package
+        try:
+            return get_dpkg_status().get_shown_version(pkg)
+        except KeyError:
+            # dpkg also knows of packages only named by others (e.g.
+            # in their Depends), leave those to dpkg-query
+            pass
+    args = [find_command('dpkg-query','/usr/bin/dpkg-query'),'--show',
            '--showformat=${Version}',pkg]
-    stdout = get_cmd_stdout(args)
+    returncode, stdout = process.get_output(args)
+    if returncode:
+        raise RuntimeError('dpkg-query found no package %s'%pkg)
     return stdout.strip()
 
 def load_module(name,fname):
@@ -188,20 +220,182 @@ def load_module(name,fname):
         fd.close()
     return module
 
-def get_deb_depends_from_setuptools_requires(requirements):
-    depends = [] # This will be the return value from this function.
+PYVERSIONS = '/usr/bin/pyversions'
+_pyversions_module = None
 
-    parsed_reqs=[]
+def get_pyversions_module():
+    """return the pyversions script as a module, loading it only once"""
+    global _pyversions_module
+    if _pyversions_module is None:
+        assert os.path.exists(PYVERSIONS)
+        _pyversions_module = load_module('pyversions',PYVERSIONS)
+    return _pyversions_module
 
-    for extra,reqs in pkg_resources.split_sections(requirements):
-        if extra: continue
-        parsed_reqs.extend(pkg_resources.parse_requirements(reqs))
+def get_cache_dir():
+    """return the directory holding stdeb's persistent caches
 
-    if not parsed_reqs:
-        return depends
+    This is $STDEB_CACHE_DIR if set, otherwise $XDG_CACHE_HOME/stdeb
+    (~/.cache/stdeb by default).
+    """
+    cache_dir = os.environ.get('STDEB_CACHE_DIR')
+    if not cache_dir:
+        base = os.environ.get('XDG_CACHE_HOME')
+        if not base:
+            base = os.path.join(os.path.expanduser('~'),'.cache')
+        cache_dir = os.path.join(base,'stdeb')
+    return cache_dir
+
+class AptFileCache:
+    """persistent map of Python distribution names to Debian packages
+
+    For each (lower-cased) distribution name, the cache holds the set
+    of (egg-info filename, Debian package name) pairs that apt-file
+    reported. Names for which apt-file found nothing are cached, too.
+    The whole cache is discarded when the apt-file Contents files
+    change (as judged by their mtime and size). If there are no
+    Contents files (the signature is empty), nothing tells when the
+    data of apt-file changes, so the cache is neither read from nor
+    written to disk.
+    """
+    format_version = 1
+
+    def __init__(self, fname=None, signature=None):
+        if fname is None:
+            fname = os.path.join(get_cache_dir(),'apt-file-cache.pickle')
+        if signature is None:
+            signature = get_contents_signature()
+        self.fname = fname
+        self.signature = signature
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        if not self.signature or not os.path.exists(self.fname):
+            return
+        try:
+            fd = open(self.fname,mode='rb')
+            try:
+                data = pickle.load(fd)
+            finally:
+                fd.close()
+        except Exception, err:
+            log.warn('ignoring unreadable apt-file cache %s: %s',
+                     self.fname, err)
+            return
+        if (data.get('format_version') != self.format_version or
+            data.get('signature') != self.signature):
+            log.info('apt-file data changed, discarding cache %s', self.fname)
+            self._dirty = True
+            return
+        self.entries = data['entries']
+
+    def lookup(self, name):
+        """return the cached set of pairs for name or None if not cached"""
+        pairs = self.entries.get(name.lower())
+        if pairs is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return pairs
+
+    def store(self, name, pairs):
+        self.entries[name.lower()] = set(pairs)
+        self._dirty = True
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits)/total
+
+    def save(self):
+        """write the cache to disk (atomically) if it was modified"""
+        if not self._dirty or not self.signature:
+            return
+        data = {'format_version':self.format_version,
+                'signature':self.signature,
+                'entries':self.entries,
+                }
+        cache_dir = os.path.dirname(self.fname)
+        try:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmp_fname = tempfile.mkstemp(dir=cache_dir)
+            fobj = os.fdopen(fd,'wb')
+            try:
+                pickle.dump(data, fobj, pickle.HIGHEST_PROTOCOL)
+            finally:
+                fobj.close()
+            os.rename(tmp_fname, self.fname)
+        except EnvironmentError, err:
+            log.warn('could not write apt-file cache %s: %s', self.fname, err)
+            return
+        self._dirty = False
+
+_apt_file_cache = None
+_contents_index = None
+
+def get_apt_file_cache():
+    """return the AptFileCache shared by this process"""
+    global _apt_file_cache
+    signature = get_contents_signature()
+    if _apt_file_cache is None or _apt_file_cache.signature != signature:
+        _apt_file_cache = AptFileCache(signature=signature)
+    return _apt_file_cache
+
+def get_contents_index():
+    """return a ContentsIndex of apt-file's Contents files
+
+    The index is built on first use and kept in the stdeb cache
+    directory until the Contents files change.
+    """
+    global _contents_index
+    fnames = get_contents_files()
+    signature = get_contents_signature(fnames)
+    if _contents_index is not None and _contents_index.signature == signature:
+        return _contents_index
+    index_fname = os.path.join(get_cache_dir(),'contents-index')
+    index = ContentsIndex.load(index_fname, signature=signature)
+    if index is None:
+        index = ContentsIndex.build(fnames, signature=signature)
+        try:
+            index.save(index_fname)
+        except EnvironmentError, err:
+            log.warn('could not write Contents index %s: %s',
+                     index_fname, err)
+    _contents_index = index
+    return index
+
+def _matching_names(egginfo, names):
+    """return the names in the set names which egginfo could belong to
+
+    The .egg-info basename is "<name>[-<version>][-py<X.Y>].egg-info",
+    so every name must be followed by either "-" or ".egg-info".
+    """
+    base = egginfo.split('/')[-1].lower()
+    base = base[:-len('.egg-info')]
+    result = []
+    if base in names:
+        result.append(base)
+    idx = base.find('-')
+    while idx != -1:
+        if base[:idx] in names:
+            result.append(base[:idx])
+        idx = base.find('-',idx+1)
+    return result
 
-    if not os.path.exists('/usr/bin/apt-file'):
-        raise ValueError('apt-file not in /usr/bin. Please install '
+def apt_file_search_egginfo(names):
+    """ask apt-file which Debian packages ship .egg-info files for names
+
+    Returns a dict mapping each lower-cased name to a set of
+    (egg-info filename, Debian package name) pairs.
+    """
+    cmd = find_command('apt-file','/usr/bin/apt-file')
+    if not os.path.exists(cmd):
+        raise ValueError('apt-file not found. Please install '
                          'with: sudo apt-get install apt-file')
 
     # Ask apt-file for any packages which have a .egg-info file by
@@ -212,36 +406,87 @@ def get_deb_depends_from_setuptools_requires(requirements):
     # "foo.egg-info" directory.
 
     egginfore=("(/(%s)(?:-[^/]+)?(?:-py[0-9]\.[0-9.]+)?\.egg-info)"
-               % '|'.join(req.project_name for req in parsed_reqs))
+               % '|'.join(names))
 
-    args = ["apt-file", "search", "--ignore-case", "--regexp", egginfore]
+    args = [cmd, "search", "--ignore-case", "--regexp", egginfore]
+    devnull = open(os.devnull, 'r')
     try:
-        cmd = subprocess.Popen(args, stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE,
-                               universal_newlines=True)
-    except Exception, le:
-        log.error('ERROR running: %s', ' '.join(args))
-        raise RuntimeError('exception %s from subprocess %s' % (le,args))
-    returncode = cmd.wait()
-    if returncode:
-        log.error('ERROR running: %s', ' '.join(args))
-        raise RuntimeError('returncode %d from subprocess %s' % (returncode,
-                                                                 args))
+        # Consume the output while apt-file is still running. (Waiting
+        # for it to exit first deadlocks once the output fills the pipe.)
+        E=re.compile(egginfore, re.I)
+        lower_names = set([name.lower() for name in names])
+        found = {}
+        lines = process.iter_lines(process.iter_output(args, stdin=devnull))
+        for pair in parse_apt_file_output(lines, E):
+            for name in _matching_names(pair[0], lower_names):
+                found.setdefault(name, set()).add(pair)
+    finally:
+        devnull.close()
+    return found
 
-    inlines = cmd.stdout.readlines()
+def parse_apt_file_output(lines, egginfo_re):
+    """yield (egg-info filename, Debian package name) from apt-file output
 
-    dd = {} # {pydistname: {pydist: set(debpackagename)}}
-    E=re.compile(egginfore, re.I)
-    D=re.compile("^([^:]*):", re.I)
+    lines is an iterable of lines like "package: /path/to/file" and is
+    consumed incrementally. Duplicate pairs are dropped and package
+    names are interned, so memory use depends on the number of
+    distinct results, not on the length of the output.
+    """
+    seen = set()
+    for line in lines:
+        if not line:
+            continue
+        debname, sep, path = line.partition(':')
+        assert sep, line
+        emo = egginfo_re.search(path)
+        assert emo, line
+        pair = (emo.group(1), intern(debname))
+        if pair not in seen:
+            seen.add(pair)
+            yield pair
+
+def get_deb_depends_from_setuptools_requires(requirements):
+    import pkg_resources # slow to import, see stdeb/__init__.py
+    depends = [] # This will be the return value from this function.
+
+    parsed_reqs=[]
+
+    for extra,reqs in pkg_resources.split_sections(requirements):
+        if extra: continue
+        parsed_reqs.extend(pkg_resources.parse_requirements(reqs))
+
+    if not parsed_reqs:
+        return depends
+
+    # Look up each requirement in the persistent cache first and only
+    # ask apt-file about the names we have not seen before.
+    cache = get_apt_file_cache()
     eggsndebs = set()
-    for l in inlines:
-        if l:
-            emo = E.search(l)
-            assert emo, l
-            dmo = D.search(l)
-            assert dmo, l
-            eggsndebs.add((emo.group(1), dmo.group(1)))
+    missing = []
+    for req in parsed_reqs:
+        pairs = cache.lookup(req.project_name)
+        if pairs is None:
+            missing.append(req.project_name)
+        else:
+            eggsndebs.update(pairs)
 
+    if missing:
+        if get_contents_files():
+            # search the Contents files directly rather than through
+            # apt-file
+            found = get_contents_index().search(missing)
+        else:
+            found = apt_file_search_egginfo(missing)
+        for name in missing:
+            pairs = found.get(name.lower(), set())
+            cache.store(name, pairs)
+            eggsndebs.update(pairs)
+        cache.save()
+
+    log.info('apt-file cache: %d hit(s), %d miss(es) (%.0f%% hit rate)',
+             cache.hits, cache.misses, 100.0*cache.hit_rate())
+
+    dd = {} # {pydistname: {pydist: set(debpackagename)}}
     for (egginfo, debname) in eggsndebs:
         pydist = pkg_resources.Distribution.from_filename(egginfo)
         try:
@@ -311,135 +556,204 @@ def get_deb_depends_from_setuptools_requires(requirements):
 
     return depends
 
-def make_tarball(tarball_fname,directory,cwd=None):
-    "create a tarball from a directory"
-    if tarball_fname.endswith('.gz'): opts = 'czf'
-    else: opts = 'cf'
-    args = ['/bin/tar',opts,tarball_fname,directory]
-    process_command(args, cwd=cwd)
-
-
-def expand_tarball(tarball_fname,cwd=None):
-    "expand a tarball"
-    if tarball_fname.endswith('.gz'): opts = 'xzf'
-    elif tarball_fname.endswith('.bz2'): opts = 'xjf'
-    else: opts = 'xf'
-    args = ['/bin/tar',opts,tarball_fname]
-    process_command(args, cwd=cwd)
-
-
-def expand_zip(zip_fname,cwd=None):
-    "expand a zip"
-    args = ['/usr/bin/unzip',zip_fname]
-    # Does it have a top dir
-    res = subprocess.Popen(
-        [args[0], '-l', args[1]], cwd=cwd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    contents = []
-    for line in res.stdout.readlines()[3:-2]:
-        contents.append(line.split()[-1])
-    commonprefix = os.path.commonprefix(contents)
-    if not commonprefix:
-        extdir = os.path.join(cwd, os.path.basename(zip_fname[:-4]))
-        args.extend(['-d', os.path.abspath(extdir)])
-
-    process_command(args, cwd=cwd)
-
-
 def expand_sdist_file(sdist_file,cwd=None):
-    lower_sdist_file = sdist_file.lower()
-    if lower_sdist_file.endswith('.zip'):
-        expand_zip(sdist_file,cwd=cwd)
-    elif lower_sdist_file.endswith('.tar.bz2'):
-        expand_tarball(sdist_file,cwd=cwd)
-    elif lower_sdist_file.endswith('.tar.gz'):
-        expand_tarball(sdist_file,cwd=cwd)
+    """expand a .zip, .tar.gz, .tgz, .tar.bz2 or .tar.xz file into cwd
+
+    If the extraction cache is enabled, the archive is extracted only
+    once per content into it; later calls get a copy of the cached
+    tree.
+    """
+    cache = get_extraction_cache()
+    if cache is None:
+        expand_archive(sdist_file,cwd=cwd)
     else:
-        raise RuntimeError('could not guess format of original sdist file')
+        if cwd is None:
+            cwd = os.curdir
+        cache.checkout(sdist_file,cwd)
+
+# default size budget of the extraction cache in MiB; set the
+# STDEB_EXTRACT_CACHE_MB environment variable to enable it (0, the
+# default, disables the cache)
+EXTRACT_CACHE_MB = 0
+
+def get_extraction_cache():
+    """return the ExtractionCache to use, or None if it is disabled"""
+    max_mb = int(os.environ.get('STDEB_EXTRACT_CACHE_MB',EXTRACT_CACHE_MB))
+    if max_mb <= 0:
+        return None
+    return ExtractionCache(os.path.join(get_cache_dir(),'extract'),
+                           max_mb*1024*1024)
 
 def repack_tarball_with_debianized_dirname( orig_sdist_file,
                                             repacked_sdist_file,
                                             debianized_dirname,
-                                            original_dirname ):
-    working_dir = tempfile.mkdtemp()
-    expand_sdist_file( orig_sdist_file, cwd=working_dir )
-    fullpath_original_dirname = os.path.join(working_dir,original_dirname)
-    fullpath_debianized_dirname = os.path.join(working_dir,debianized_dirname)
-
-    # ensure sdist looks like sdist:
-    assert os.path.exists( fullpath_original_dirname )
-    assert len(os.listdir(working_dir))==1
-
-    if fullpath_original_dirname != fullpath_debianized_dirname:
-        # rename original dirname to debianized dirname
-        os.rename(fullpath_original_dirname,
-                  fullpath_debianized_dirname)
-    make_tarball(repacked_sdist_file,debianized_dirname,cwd=working_dir)
-    shutil.rmtree(working_dir)
+                                            original_dirname,
+                                            compresslevel=DEFAULT_COMPRESSLEVEL ):
+    """copy orig_sdist_file to repacked_sdist_file (a .tar.gz)
+
+    The top-level directory (original_dirname) is renamed to
+    debianized_dirname while the archive is converted, without
+    extracting it to disk. ArchiveError is raised if
+    orig_sdist_file has members outside of original_dirname.
+    """
+    repack_as_tar_gz(orig_sdist_file, repacked_sdist_file, debianized_dirname,
+                     src_top_dirname=original_dirname,
+                     compresslevel=compresslevel)
+
+def get_diff_paths(diff_file):
+    """return the paths of the files changed by a (.gz) unified diff
+
+    The paths are those of the new files, without their top-level
+    directory.
+    """
+    if diff_file.endswith('.gz'):
+        fd = gzip.open(diff_file, 'rb')
+    else:
+        fd = open(diff_file, mode='rb')
+    try:
+        data = fd.read()
+    finally:
+        fd.close()
+    if not data:
+        return []
+    return [file_patch.new_name.split('/',1)[-1]
+            for file_patch in parse_patch(data, diff_file)]
+
+def get_source_dir_differences(source_dir, orig_tarball, diff_file):
+    """compare source_dir with what "dpkg-source -x" would make of it
+
+    "dpkg-source -x" expands orig_tarball and applies diff_file. A
+    file the diff does not change has the contents it has in the
+    tarball, so comparing the names, types and executable bits of
+    everything in source_dir with the tarball and the diff is enough.
+    Returns a list of the differences found.
+    """
+    def is_executable(mode):
+        return bool(mode & 0111)
+    expected = {} # path: (type, executable or None)
+    tar = tarfile.open(orig_tarball, 'r:*')
+    try:
+        for member in tar:
+            path = member.name
+            while path.startswith('./'):
+                path = path[2:]
+            if '/' not in path.rstrip('/'):
+                continue # the top-level directory
+            path = path.rstrip('/').split('/',1)[1]
+            # tar makes the parents of members, listed or not
+            parts = path.split('/')
+            for i in range(1,len(parts)):
+                expected.setdefault('/'.join(parts[:i]), (DIRECTORY, None))
+            if member.isdir():
+                expected[path] = (DIRECTORY, None)
+            elif member.issym():
+                expected[path] = (SYMLINK, None)
+            else:
+                expected[path] = (FILE, is_executable(member.mode))
+    finally:
+        tar.close()
+    try:
+        diff_paths = get_diff_paths(diff_file)
+    except PatchError, err:
+        return ['%s cannot be read: %s'%(diff_file, err)]
+    for path in diff_paths:
+        parts = path.split('/')
+        for i in range(1,len(parts)):
+            expected.setdefault('/'.join(parts[:i]), (DIRECTORY, None))
+        if path not in expected:
+            # made by the diff, only debian/rules is made executable
+            expected[path] = (FILE, path == 'debian/rules')
+
+    differences = []
+    manifest = TreeManifest.scan(source_dir)
+    for entry in manifest.entries:
+        if entry.path not in expected:
+            differences.append('%s would not be extracted'%entry.path)
+            continue
+        type, executable = expected.pop(entry.path)
+        if entry.type != type:
+            differences.append('%s would be extracted as a %s, not a %s'%(
+                entry.path, type, entry.type))
+        elif (executable is not None and
+              is_executable(entry.mode) != executable):
+            differences.append('%s would be extracted with a different '
+                               'mode'%entry.path)
+    for path in sorted(expected):
+        differences.append('%s is missing'%path)
+    return differences
 
 def dpkg_source(b_or_x,arg1,arg2=None,cwd=None):
     "call dpkg-source -b|x arg1 [arg2]"
     assert b_or_x in ['-b','-x']
-    args = ['/usr/bin/dpkg-source',b_or_x,arg1]
+    args = [find_command('dpkg-source','/usr/bin/dpkg-source'),b_or_x,arg1]
     if arg2 is not None:
         args.append(arg2)
 
     process_command(args, cwd=cwd)
 
-def apply_patch(patchfile,cwd=None,posix=False,level=0):
-    """call 'patch -p[level] [--posix] < arg1'
+def apply_patch(patchfile,cwd=None,posix=False,level=0,dry_run=False):
+    """apply patchfile (or a list of them) like 'patch -p[level] [--posix]'
 
     posix mode is sometimes necessary. It keeps empty files so that
     dpkg-source removes their contents.
 
+    The patches are applied by stdeb.patch, which changes nothing
+    unless all of them apply (with dry_run, nothing at all), and by
+    patch if they use what stdeb.patch does not support.
     """
-    if not os.path.exists(patchfile):
-        raise RuntimeError('patchfile "%s" does not exist'%patchfile)
-    fd = open(patchfile,mode='r')
-
+    if isinstance(patchfile, basestring):
+        patchfiles = [patchfile]
+    else:
+        patchfiles = list(patchfile)
+    for patchfile in patchfiles:
+        if not os.path.exists(patchfile):
+            raise RuntimeError('patchfile "%s" does not exist'%patchfile)
     level_str = '-p%d'%level
-    args = ['/usr/bin/patch',level_str]
+    args = [find_command('patch','/usr/bin/patch'),level_str]
     if posix:
         args.append('--posix')
+    if dry_run:
+        args.append('--dry-run')
 
-    log.info('PATCH COMMAND: %s < %s', ' '.join(args), patchfile)
+    log.info('APPLYING PATCH(ES) %s (%s)', ' '.join(patchfiles),
+             ' '.join(args[1:]))
     log.info('  PATCHING in dir: %s', cwd)
-#    print >> sys.stderr, 'PATCH COMMAND:',' '.join(args),'<',patchfile
-#    print >> sys.stderr, '  PATCHING in dir:',cwd
-    res = subprocess.Popen(
-        args, cwd=cwd,
-        stdin=fd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        )
-    returncode=None
-    while returncode is None:
-        returncode = res.poll()
-        ready = select.select( [res.stdout,res.stderr],[],[],0.1)
-        # XXX figure out how to do this without reading byte-by-byte
-        if res.stdout in ready[0]:
-            sys.stdout.write(res.stdout.read(1))
-            sys.stdout.flush()
-        if res.stderr in ready[0]:
-            sys.stderr.write(res.stderr.read(1))
-            sys.stderr.flush()
-    # finish outputting file
-    sys.stdout.write(res.stdout.read())
-    sys.stdout.flush()
-    sys.stderr.write(res.stderr.read())
-    sys.stderr.flush()
-
-    if returncode:
-        log.error('ERROR running: %s', ' '.join(args))
+    try:
+        apply_patches(patchfiles, cwd=cwd, level=level, posix=posix,
+                      dry_run=dry_run)
+        return
+    except Unsupported, err:
+        log.warn('WARNING: %s, calling patch instead', err)
+    except RuntimeError:
         log.error('ERROR in %s', cwd)
-#        print >> sys.stderr, 'ERROR running: %s'%(' '.join(args),)
-#        print >> sys.stderr, 'ERROR in',cwd
-        raise RuntimeError('returncode %d'%returncode)
+        raise
+
+    for patchfile in patchfiles:
+        log.info('PATCH COMMAND: %s < %s', ' '.join(args), patchfile)
+#        print >> sys.stderr, 'PATCH COMMAND:',' '.join(args),'<',patchfile
+        fd = open(patchfile,mode='r')
+        try:
+            returncode = process.call(args, cwd=cwd, stdin=fd,
+                                      stdout=process.RELAY,
+                                      stderr=process.RELAY)
+        finally:
+            fd.close()
+
+        if returncode:
+            log.error('ERROR running: %s < %s', ' '.join(args), patchfile)
+            log.error('ERROR in %s', cwd)
+#            print >> sys.stderr, 'ERROR running: %s'%(' '.join(args),)
+#            print >> sys.stderr, 'ERROR in',cwd
+            raise RuntimeError('returncode %d'%returncode)
 
 def parse_vals(cfg,section,option):
-    """parse comma separated values in debian control file style from .cfg"""
+    """parse comma separated values in debian control file style from .cfg
+
+    cfg is a stdeb.config.Config, which has split the values already,
+    or a ConfigParser.
+    """
+    if isinstance(cfg, Config):
+        return cfg.get_vals(section,option)
     try:
         vals = cfg.get(section,option)
     except ConfigParser.NoSectionError, err:
@@ -447,12 +761,7 @@ def parse_vals(cfg,section,option):
             vals = cfg.get('DEFAULT',option)
         else:
             raise err
-    vals = vals.split('#')[0]
-    vals = vals.strip()
-    vals = vals.split(',')
-    vals = [v.strip() for v in vals]
-    vals = [v for v in vals if len(v)]
-    return vals
+    return split_vals(vals)
 
 def parse_val(cfg,section,option):
     """extract a single value from .cfg"""
@@ -507,8 +816,7 @@ class DebianInfo:
             default_maintainer=default_maintainer,
             )
 
-        cfg = ConfigParser.SafeConfigParser(cfg_defaults)
-        cfg.read(cfg_files)
+        cfg = Config(cfg_files, cfg_defaults)
 
         self.stdeb_version = __stdeb_version__
         self.module_name = module_name
@@ -690,9 +998,7 @@ class DebianInfo:
                 # specified more than one. (Specifying a single
                 # version won't trigger the bug.)
 
-                pyversions_fname = '/usr/bin/pyversions'
-                assert os.path.exists(pyversions_fname)
-                pyversions = load_module('pyversions',pyversions_fname)
+                pyversions = get_pyversions_module()
                 vstring = ', '.join(xs_python_version)
                 pyversions_result = pyversions.parse_versions(vstring)
                 if ('versions' in pyversions_result and
@@ -827,8 +1133,21 @@ def build_dsc(debinfo,
               repackaged_dirname,
               orig_sdist=None,
               patch_posix=0,
-              remove_expanded_source_dir=0):
-    """make debian source package"""
+              remove_expanded_source_dir=0,
+              compresslevel=DEFAULT_COMPRESSLEVEL,
+              manifest=None,
+              extract_source_dir=False,
+              use_dpkg_source=False):
+    """make debian source package
+
+    manifest is a TreeManifest of the copied source tree in
+    dist_dir/repackaged_dirname, if one was already built. Unless extract_source_dir is true, the tree the source
+    package is made from is kept as the expanded source directory if
+    "dpkg-source -x" would make the same, rather than extracting it
+    again. Unless use_dpkg_source is true, the .diff.gz and .dsc are
+    written by stdeb.dsc, and by "dpkg-source -b" only if it cannot
+    represent the source package.
+    """
     #    A. Find new dirname and delete any pre-existing contents
 
     # dist_dir is usually 'deb_dist'
@@ -861,7 +1180,9 @@ def build_dsc(debinfo,
     else:
         make_tarball(repackaged_orig_tarball,
                      repackaged_dirname,
-                     cwd=dist_dir)
+                     cwd=dist_dir,
+                     compresslevel=compresslevel,
+                     manifest=manifest)
 
     # apply patch
     if debinfo.patch_file != '':
@@ -967,18 +1288,21 @@ def build_dsc(debinfo,
     ###############################################
     # 3. unpack original source tarball
 
+    #    (only for dpkg-source, stdeb.dsc reads the tarball itself)
+
     debianized_package_dirname = fullpath_repackaged_dirname+'.debianized'
-    if os.path.exists(debianized_package_dirname):
+    if use_dpkg_source and os.path.exists(debianized_package_dirname):
         raise RuntimeError('debianized_package_dirname exists: %s' %
                            debianized_package_dirname)
     #    A. move debianized tree away
-    os.rename(fullpath_repackaged_dirname, debianized_package_dirname )
-    if orig_sdist is not None:
+    if use_dpkg_source:
+        os.rename(fullpath_repackaged_dirname, debianized_package_dirname )
+    if use_dpkg_source and orig_sdist is not None:
         #    B. expand repackaged original tarball
         tmp_dir = os.path.join(dist_dir,'tmp-expand')
         os.mkdir(tmp_dir)
         try:
-            expand_tarball(orig_sdist,cwd=tmp_dir)
+            expand_sdist_file(orig_sdist,cwd=tmp_dir)
             orig_tarball_top_contents = os.listdir(tmp_dir)
 
             # make sure original tarball has exactly one directory
@@ -998,7 +1322,10 @@ def build_dsc(debinfo,
 
     if 1:
         # check versions of debhelper and python-support
-        debhelper_version_str = get_version_str('debhelper')
+        try:
+            debhelper_version_str = get_version_str('debhelper')
+        except RuntimeError:
+            debhelper_version_str = '' # not even known to dpkg
         if len(debhelper_version_str)==0:
             log.warn('This version of stdeb requires debhelper >= %s, but you '
                      'do not have debhelper installed. '
@@ -1011,7 +1338,10 @@ def build_dsc(debinfo,
                          'compatible with older versions of debhelper.'%(
                     DH_MIN_VERS,))
 
-        pysupport_version_str = get_version_str('python-support')
+        try:
+            pysupport_version_str = get_version_str('python-support')
+        except RuntimeError:
+            pysupport_version_str = '' # not even known to dpkg
         if len(pysupport_version_str)==0:
             log.warn('This version of stdeb requires python-support >= %s, '
                      'but you do not have python-support installed. '
@@ -1025,29 +1355,60 @@ def build_dsc(debinfo,
                     PYSUPPORT_MIN_VERS,))
 
     #    D. restore debianized tree
-    os.rename(fullpath_repackaged_dirname+'.debianized',
-              fullpath_repackaged_dirname)
+    if use_dpkg_source:
+        os.rename(fullpath_repackaged_dirname+'.debianized',
+                  fullpath_repackaged_dirname)
 
-    #    Re-generate tarball using best practices see
-    #    http://www.debian.org/doc/developers-reference/ch-best-pkging-practices.en.html
-    #    call "dpkg-source -b new_dirname orig_dirname"
-    log.info('CALLING dpkg-source -b %s %s (in dir %s)'%(
-        repackaged_dirname,
-        repackaged_orig_tarball,
-        dist_dir))
+    dsc_written = False
+    if not use_dpkg_source:
+        try:
+            write_source_package(dist_dir, repackaged_dirname,
+                                 repackaged_orig_tarball)
+            dsc_written = True
+        except NotRepresentable, err:
+            log.warn('WARNING: %s, calling dpkg-source instead', err)
+
+    if not dsc_written:
+        #    Re-generate tarball using best practices see
+        #    http://www.debian.org/doc/developers-reference/ch-best-pkging-practices.en.html
+        #    call "dpkg-source -b new_dirname orig_dirname"
+        log.info('CALLING dpkg-source -b %s %s (in dir %s)'%(
+            repackaged_dirname,
+            repackaged_orig_tarball,
+            dist_dir))
+
+        dpkg_source('-b',repackaged_dirname,
+                    repackaged_orig_tarball,
+                    cwd=dist_dir)
 
-    dpkg_source('-b',repackaged_dirname,
-                repackaged_orig_tarball,
-                cwd=dist_dir)
+    # dpkg-source may leave the expanded original tree behind
+    if os.path.exists(fullpath_repackaged_dirname+'.orig'):
+        shutil.rmtree(fullpath_repackaged_dirname+'.orig')
 
-    if 1:
+    if remove_expanded_source_dir:
         shutil.rmtree(fullpath_repackaged_dirname)
-
-    if not remove_expanded_source_dir:
-        # expand the debian source package
-        dsc_name = debinfo.source + '_' + debinfo.dsc_version + '.dsc'
-        dpkg_source('-x',dsc_name,
-                    cwd=dist_dir)
+    else:
+        differences = []
+        diff_name = debinfo.source + '_' + debinfo.dsc_version + '.diff.gz'
+        if not extract_source_dir:
+            if os.path.exists(os.path.join(dist_dir,diff_name)):
+                differences = get_source_dir_differences(
+                    fullpath_repackaged_dirname,
+                    repackaged_orig_tarball_path,
+                    os.path.join(dist_dir,diff_name))
+            else:
+                differences = ['%s was not made'%diff_name]
+            for msg in differences[:10]:
+                log.warn('WARNING: in the source package, %s', msg)
+            if differences:
+                log.warn('WARNING: not keeping %s, expanding the source '
+                         'package instead', fullpath_repackaged_dirname)
+        if extract_source_dir or differences:
+            shutil.rmtree(fullpath_repackaged_dirname)
+            # expand the debian source package
+            dsc_name = debinfo.source + '_' + debinfo.dsc_version + '.dsc'
+            dpkg_source('-x',dsc_name,
+                        cwd=dist_dir)
 
 CONTROL_FILE = """\
 Source: %(source)s
@@ -0,0 +1,232 @@
+import os, fcntl, gzip, shutil, tarfile, tempfile, time, unittest, zipfile
+import multiprocessing
+from StringIO import StringIO
+from stdeb.archive import expand_tarball, repack_as_tar_gz, ArchiveError, \
+     ExtractionCache, ParallelGzipFile, get_archive_names, \
+     get_archive_top_dirname
+
+class ExpandTarballTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmp_dir, 'dest')
+        os.mkdir(self.dest)
+        self.outside = os.path.join(self.tmp_dir, 'outside')
+        os.mkdir(self.outside)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_tarball(self, members):
+        """members: (name, symlink target or None, data)"""
+        fname = os.path.join(self.tmp_dir, 'pkg-1.0.tar.gz')
+        tar = tarfile.open(fname, 'w:gz')
+        try:
+            for name, target, data in members:
+                info = tarfile.TarInfo(name)
+                if target is not None:
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = target
+                    tar.addfile(info)
+                else:
+                    info.size = len(data)
+                    tar.addfile(info, StringIO(data))
+        finally:
+            tar.close()
+        return fname
+
+    def test_file_over_symlink_outside(self):
+        # a symlink out of dest, then a file of the same name
+        fname = self.make_tarball([
+            ('pkg-1.0/x', os.path.join(self.outside, 'pwned'), None),
+            ('pkg-1.0/x', None, 'pwned\n')])
+        self.assertRaises(ArchiveError, expand_tarball, fname, self.dest)
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def test_relative_symlink_outside(self):
+        fname = self.make_tarball([
+            ('pkg-1.0/x', '../../outside/pwned', None),
+            ('pkg-1.0/x', None, 'pwned\n')])
+        self.assertRaises(ArchiveError, expand_tarball, fname, self.dest)
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def test_file_replaces_symlink(self):
+        # a symlink inside dest is replaced, not written through
+        fname = self.make_tarball([
+            ('pkg-1.0/y', None, 'y\n'),
+            ('pkg-1.0/x', 'y', None),
+            ('pkg-1.0/x', None, 'x\n')])
+        expand_tarball(fname, self.dest)
+        top = os.path.join(self.dest, 'pkg-1.0')
+        self.failIf(os.path.islink(os.path.join(top, 'x')))
+        self.assertEqual(open(os.path.join(top, 'x')).read(), 'x\n')
+        self.assertEqual(open(os.path.join(top, 'y')).read(), 'y\n')
+
+    def test_symlink_inside(self):
+        fname = self.make_tarball([
+            ('pkg-1.0/y', None, 'y\n'),
+            ('pkg-1.0/x', 'y', None)])
+        expand_tarball(fname, self.dest)
+        self.assertEqual(os.readlink(os.path.join(self.dest, 'pkg-1.0', 'x')),
+                         'y')
+
+class RepackTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.tmp_dir, 'pkg_1.0.orig.tar.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_tarball(self, names):
+        """as "tar -cjf pkg-1.0.tar.bz2 ./" makes it, if names start so"""
+        fname = os.path.join(self.tmp_dir, 'pkg-1.0.tar.bz2')
+        tar = tarfile.open(fname, 'w:bz2')
+        try:
+            for name in names:
+                info = tarfile.TarInfo(name)
+                if name.endswith('/'):
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(info)
+                else:
+                    info.size = 5
+                    tar.addfile(info, StringIO('data\n'))
+        finally:
+            tar.close()
+        return fname
+
+    def get_names(self):
+        tar = tarfile.open(self.dest)
+        try:
+            return tar.getnames()
+        finally:
+            tar.close()
+
+    def test_dot_entry(self):
+        fname = self.make_tarball(['./', './pkg-1.0/', './pkg-1.0/setup.py'])
+        repack_as_tar_gz(fname, self.dest, 'pkg-1.0')
+        self.assertEqual(self.get_names(), ['pkg-1.0', 'pkg-1.0/setup.py'])
+        repack_as_tar_gz(fname, self.dest, 'pkg-1.0',
+                         src_top_dirname='pkg-1.0')
+        self.assertEqual(self.get_names(), ['pkg-1.0', 'pkg-1.0/setup.py'])
+
+    def test_archive_names(self):
+        fname = self.make_tarball(['pkg-1.0/', 'pkg-1.0/mod.pyc'])
+        self.assertEqual(get_archive_names(fname),
+                         ['pkg-1.0/', 'pkg-1.0/mod.pyc'])
+
+    def test_archive_top_dirname(self):
+        fname = self.make_tarball(['./', './pkg-1.0/', './pkg-1.0/setup.py'])
+        self.assertEqual(get_archive_top_dirname(fname), 'pkg-1.0')
+        fname = self.make_tarball(['pkg-1.0/setup.py', 'other/setup.py'])
+        self.assertEqual(get_archive_top_dirname(fname), None)
+
+    def test_no_top_dirname(self):
+        fname = self.make_tarball(['./setup.py', './pkg/', './pkg/mod.py'])
+        repack_as_tar_gz(fname, self.dest, 'pkg-1.0')
+        self.assertEqual(self.get_names(), ['pkg-1.0/setup.py', 'pkg-1.0/pkg',
+                                            'pkg-1.0/pkg/mod.py'])
+
+    def test_member_outside_top_dirname(self):
+        fname = self.make_tarball(['pkg-1.0/setup.py', 'other/setup.py'])
+        self.assertRaises(ArchiveError, repack_as_tar_gz, fname, self.dest,
+                          'pkg-1.0', src_top_dirname='pkg-1.0')
+
+    def test_zip_is_reproducible(self):
+        fname = os.path.join(self.tmp_dir, 'pkg-1.0.zip')
+        zf = zipfile.ZipFile(fname, 'w')
+        try:
+            zf.writestr(zipfile.ZipInfo('pkg-1.0/setup.py',
+                                        (2010, 1, 2, 3, 4, 6)), 'pass\n')
+            zf.writestr(zipfile.ZipInfo('pkg-1.0/README',
+                                        (2009, 1, 2, 3, 4, 6)), 'read\n')
+        finally:
+            zf.close()
+        repack_as_tar_gz(fname, self.dest, 'pkg-1.0',
+                         src_top_dirname='pkg-1.0')
+        tar = tarfile.open(self.dest)
+        try:
+            top = tar.getmember('pkg-1.0')
+            self.assertEqual(top.mtime,
+                             time.mktime((2010, 1, 2, 3, 4, 6, 0, 0, -1)))
+        finally:
+            tar.close()
+
+class ParallelGzipFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cpu_count = multiprocessing.cpu_count
+
+    def tearDown(self):
+        multiprocessing.cpu_count = self.cpu_count
+        shutil.rmtree(self.tmp_dir)
+
+    def test_unknown_cpu_count(self):
+        def cpu_count():
+            raise NotImplementedError('cannot determine number of cpus')
+        multiprocessing.cpu_count = cpu_count
+        fname = os.path.join(self.tmp_dir, 'data.gz')
+        fd = ParallelGzipFile(fname)
+        fd.write('data\n'*1000)
+        fd.close()
+        self.assertEqual(gzip.open(fname).read(), 'data\n'*1000)
+
+class ExtractionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'cache')
+        self.archive = os.path.join(self.tmp_dir, 'pkg-1.0.tar.gz')
+        fd = open(self.archive, mode='wb')
+        try:
+            fd.write('not really an archive')
+        finally:
+            fd.close()
+        self.extractions = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def extract(self, fname, cwd):
+        self.extractions += 1
+        os.mkdir(os.path.join(cwd, 'pkg-1.0'))
+        fd = open(os.path.join(cwd, 'pkg-1.0', 'setup.py'), mode='wb')
+        try:
+            fd.write('pass\n')
+        finally:
+            fd.close()
+
+    def checkout(self, cache):
+        dest = tempfile.mkdtemp(dir=self.tmp_dir)
+        cache.checkout(self.archive, dest)
+        return os.path.join(dest, 'pkg-1.0', 'setup.py')
+
+    def test_checkout_is_a_copy(self):
+        cache = ExtractionCache(self.cache_dir, 1<<20, self.extract)
+        setup_py = self.checkout(cache)
+        # as setup.py egg_info would do to the checked out tree
+        fd = open(setup_py, mode='ab')
+        try:
+            fd.write('# changed\n')
+        finally:
+            fd.close()
+        os.chmod(setup_py, 0700)
+        setup_py = self.checkout(cache)
+        self.assertEqual(self.extractions, 1)
+        self.assertEqual(open(setup_py).read(), 'pass\n')
+
+    def test_no_eviction_in_use(self):
+        cache = ExtractionCache(self.cache_dir, 1<<20, self.extract)
+        self.checkout(cache)
+        key, = os.listdir(self.cache_dir)
+        fd = open(os.path.join(self.cache_dir, key, 'lock'))
+        try:
+            fcntl.flock(fd.fileno(), fcntl.LOCK_SH)
+            cache.max_size = 0
+            cache.evict()
+            self.assertEqual(os.listdir(self.cache_dir), [key])
+        finally:
+            fd.close()
+        cache.evict()
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os, gzip, shutil, tempfile, unittest
+from stdeb.contents import ContentsIndex
+from stdeb.util import AptFileCache
+
+# a small stand-in for a Contents-amd64.gz file
+CONTENTS = """\
+usr/bin/foo                                             utils/foo-utils
+usr/lib/python2.7/dist-packages/Foo-1.0.egg-info/PKG-INFO python/python-foo
+usr/lib/python2.7/dist-packages/Foo-1.0.egg-info/top_level.txt python/python-foo
+usr/lib/python3/dist-packages/foo-1.0.dist-info/METADATA python/python3-foo
+usr/lib/python2.7/dist-packages/foobar-2.0.egg-info      python/python-foobar
+usr/lib/python2.7/dist-packages/foo.bar-3.0.egg-info     python/python-foo.bar
+usr/share/pyshared/Bar.egg-info             python/python-bar,python/python-bar-dbg
+"""
+
+class ContentsIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.contents = os.path.join(self.tmp_dir, 'Contents-amd64.gz')
+        fd = gzip.open(self.contents, 'wb')
+        try:
+            fd.write(CONTENTS)
+        finally:
+            fd.close()
+        self.index_fname = os.path.join(self.tmp_dir, 'contents-index')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def check_lookups(self, index):
+        self.assertEqual(index.lookup('foo'),
+                         set([('/Foo-1.0.egg-info', 'python-foo'),
+                              ('/foo-1.0.egg-info', 'python3-foo')]))
+        self.assertEqual(index.lookup('FOOBAR'),
+                         set([('/foobar-2.0.egg-info', 'python-foobar')]))
+        self.assertEqual(index.lookup('foo.bar'),
+                         set([('/foo.bar-3.0.egg-info', 'python-foo.bar')]))
+        self.assertEqual(index.lookup('bar'),
+                         set([('/Bar.egg-info', 'python-bar'),
+                              ('/Bar.egg-info', 'python-bar-dbg')]))
+        self.assertEqual(index.lookup('fo'), set())
+        self.assertEqual(index.lookup('zzz'), set())
+
+    def test_build(self):
+        index = ContentsIndex.build([self.contents], signature='sig')
+        self.assertEqual(len(index), 6)
+        self.check_lookups(index)
+
+    def test_save_and_load(self):
+        ContentsIndex.build([self.contents], signature='sig').save(
+            self.index_fname)
+        index = ContentsIndex.load(self.index_fname, signature='sig')
+        self.assertEqual(len(index), 6)
+        self.check_lookups(index)
+        self.assertEqual(ContentsIndex.load(self.index_fname,
+                                            signature='other'), None)
+
+    def test_apt_file_cache(self):
+        fname = os.path.join(self.tmp_dir, 'apt-file-cache.pickle')
+        pairs = set([('/Foo-1.0.egg-info', 'python-foo')])
+        signature = (self.contents, 1.0, 100)
+        cache = AptFileCache(fname, signature=signature)
+        cache.store('Foo', pairs)
+        cache.save()
+        self.assertEqual(AptFileCache(fname, signature=signature).lookup(
+            'foo'), pairs)
+        self.assertEqual(AptFileCache(fname, signature=(self.contents, 2.0,
+                                                        100)).lookup('foo'),
+                         None)
+
+    def test_apt_file_cache_without_contents(self):
+        # nothing tells when the data of apt-file changes
+        fname = os.path.join(self.tmp_dir, 'apt-file-cache.pickle')
+        cache = AptFileCache(fname, signature=())
+        cache.store('Foo', [('/Foo-1.0.egg-info', 'python-foo')])
+        cache.save()
+        self.failIf(os.path.exists(fname))
+
+    def test_empty(self):
+        ContentsIndex.build([], signature='sig').save(self.index_fname)
+        index = ContentsIndex.load(self.index_fname, signature='sig')
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.lookup('foo'), set())
+
+if __name__=='__main__':
+    unittest.main()
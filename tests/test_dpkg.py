@@ -0,0 +1,68 @@
+import os, shutil, tempfile, unittest
+from stdeb.dpkg import DpkgStatus
+
+STATUS = """\
+Package: cfgonly
+Status: deinstall ok config-files
+Architecture: all
+Version: 1.2-3
+
+Package: notinst
+Status: purge ok not-installed
+Architecture: all
+
+Package: notinstv
+Status: purge ok not-installed
+Architecture: all
+Version: 2.0
+
+Package: halfinst
+Status: install ok half-installed
+Architecture: all
+Version: 3.0
+
+Package: multi
+Status: install ok installed
+Architecture: amd64
+Multi-Arch: same
+Version: 1.0
+
+Package: multi
+Status: install ok installed
+Architecture: i386
+Multi-Arch: same
+Version: 1.0
+"""
+
+class DpkgStatusTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        fname = os.path.join(self.tmp_dir, 'status')
+        fd = open(fname, mode='w')
+        try:
+            fd.write(STATUS)
+        finally:
+            fd.close()
+        self.status = DpkgStatus(fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_shown_version(self):
+        # as printed by "dpkg-query --show --showformat=${Version}"
+        for name, version in [('cfgonly', '1.2-3'),
+                              ('notinst', ''),
+                              ('notinstv', ''),
+                              ('halfinst', '3.0'),
+                              ('multi', '1.01.0')]:
+            self.assertEqual(self.status.get_shown_version(name), version)
+        self.assertRaises(KeyError, self.status.get_shown_version, 'unknown')
+
+    def test_is_installed(self):
+        self.failIf(self.status.is_installed('cfgonly'))
+        self.failIf(self.status.is_installed('notinstv'))
+        self.failUnless(self.status.is_installed('halfinst'))
+        self.failUnless(self.status.is_installed('multi', 'eq', '1.0'))
+
+if __name__=='__main__':
+    unittest.main()
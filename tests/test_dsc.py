@@ -0,0 +1,119 @@
+import os, shutil, tarfile, tempfile, subprocess, gzip, unittest
+import logging
+from stdeb import log
+from stdeb.dsc import write_source_package
+from stdeb.util import find_command
+
+DIRNAME = 'smallpkg-1.0'
+ORIG_TARBALL = 'smallpkg_1.0.orig.tar.gz'
+DIFF_NAME = 'smallpkg_1.0-1.diff.gz'
+DSC_NAME = 'smallpkg_1.0-1.dsc'
+
+CONTROL = """\
+Source: smallpkg
+Maintainer: A B <a@b.c>
+Section: python
+Priority: optional
+Build-Depends: python-setuptools (>= 0.6b3), debhelper (>= 7)
+Standards-Version: 3.7.2
+
+Package: python-smallpkg
+Architecture: all
+Depends: ${python:Depends}
+Description: small package
+ for test_dsc.py
+"""
+
+CHANGELOG = """\
+smallpkg (1.0-1) unstable; urgency=low
+
+  * source package automatically created by stdeb
+
+ -- A B <a@b.c>  Thu, 01 Jan 2009 00:00:00 +0000
+"""
+
+def write_file(fname, data, mode=None):
+    dirname = os.path.dirname(fname)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    fd = open(fname, mode='wb')
+    try:
+        fd.write(data)
+    finally:
+        fd.close()
+    if mode is not None:
+        os.chmod(fname, mode)
+
+def read_outputs(dist_dir):
+    """return the decompressed diff and the .dsc without diff checksums"""
+    fd = gzip.open(os.path.join(dist_dir, DIFF_NAME))
+    try:
+        diff = fd.read()
+    finally:
+        fd.close()
+    dsc = [line for line in open(os.path.join(dist_dir, DSC_NAME))
+           if not line.rstrip().endswith(' '+DIFF_NAME)]
+    return diff, ''.join(dsc)
+
+class WriteSourcePackageTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.template = os.path.join(self.tmp_dir, 'template')
+        top = os.path.join(self.template, DIRNAME)
+        write_file(os.path.join(top, 'pkg', 'mod.py'),
+                   ''.join(['line %d\n'%i for i in range(20)]))
+        write_file(os.path.join(top, 'with space.txt'), 'a\nb\n')
+        write_file(os.path.join(top, 'no-newline.txt'), 'a\nb')
+        write_file(os.path.join(top, 'deleted.txt'), 'gone\n')
+        tar = tarfile.open(os.path.join(self.template, ORIG_TARBALL),
+                           'w:gz')
+        try:
+            tar.add(top, DIRNAME)
+        finally:
+            tar.close()
+        write_file(os.path.join(top, 'pkg', 'mod.py'),
+                   ''.join(['line %d\n'%i for i in range(20) if i != 10]))
+        write_file(os.path.join(top, 'with space.txt'), 'a\nc\n')
+        write_file(os.path.join(top, 'no-newline.txt'), 'a\nc')
+        write_file(os.path.join(top, 'new.txt'), 'new\nfile')
+        write_file(os.path.join(top, 'empty.txt'), '')
+        write_file(os.path.join(top, 'script.sh'), '#!/bin/sh\n', 0755)
+        os.unlink(os.path.join(top, 'deleted.txt'))
+        write_file(os.path.join(top, 'debian', 'control'), CONTROL)
+        write_file(os.path.join(top, 'debian', 'changelog'), CHANGELOG)
+        write_file(os.path.join(top, 'debian', 'compat'), '7\n')
+        write_file(os.path.join(top, 'debian', 'rules'),
+                   '#!/usr/bin/make -f\n%:\n\tdh $@\n', 0755)
+        self.level = log.level
+        log.setLevel(logging.ERROR)
+
+    def tearDown(self):
+        log.setLevel(self.level)
+        shutil.rmtree(self.tmp_dir)
+
+    def build(self, name, func):
+        dist_dir = os.path.join(self.tmp_dir, name)
+        shutil.copytree(self.template, dist_dir, symlinks=True)
+        func(dist_dir)
+        return read_outputs(dist_dir)
+
+    @unittest.skipUnless(find_command('dpkg-source', None),
+                         'dpkg-source is not installed')
+    def test_same_as_dpkg_source(self):
+        def dpkg_source(dist_dir):
+            devnull = open(os.devnull, 'w')
+            try:
+                subprocess.check_call(['dpkg-source','-b',DIRNAME,
+                                       ORIG_TARBALL], cwd=dist_dir,
+                                      stdout=devnull, stderr=devnull)
+            finally:
+                devnull.close()
+        def native(dist_dir):
+            write_source_package(dist_dir, DIRNAME, ORIG_TARBALL)
+        expected_diff, expected_dsc = self.build('dpkg', dpkg_source)
+        diff, dsc = self.build('native', native)
+        self.assertEqual(diff, expected_diff)
+        self.assertEqual(dsc, expected_dsc)
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os, shutil, tempfile, time, unittest
+from stdeb.tree import TreeManifest, clone_tree
+import stdeb.tree
+from stdeb.fingerprint import read_hash_cache, write_hash_cache
+
+def write_file(fname, data):
+    fd = open(fname, mode='wb')
+    try:
+        fd.write(data)
+    finally:
+        fd.close()
+
+class HashCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmp_dir, 'pkg-1.0')
+        os.mkdir(self.top)
+        self.old = time.time() - 60
+        for name in ['setup.py', 'README']:
+            fname = os.path.join(self.top, name)
+            write_file(fname, name+'\n')
+            os.utime(fname, (self.old, self.old))
+        self.cache = os.path.join(self.tmp_dir, 'pkg.stdeb-hashes')
+        self.hashed = []
+        self.hash_file = stdeb.tree.hash_file
+        def hash_file(fname, algorithm='sha1'):
+            self.hashed.append(os.path.basename(fname))
+            return self.hash_file(fname, algorithm)
+        stdeb.tree.hash_file = hash_file
+
+    def tearDown(self):
+        stdeb.tree.hash_file = self.hash_file
+        shutil.rmtree(self.tmp_dir)
+
+    def checksum(self, top=None):
+        if top is None:
+            top = self.top
+        known_hashes = read_hash_cache(self.cache)
+        result = TreeManifest.scan(top).checksum(
+            known_hashes=known_hashes)
+        write_hash_cache(self.cache, known_hashes)
+        return result
+
+    def test_unchanged_files_not_read(self):
+        first = self.checksum()
+        self.assertEqual(sorted(self.hashed), ['README', 'setup.py'])
+        del self.hashed[:]
+        self.assertEqual(self.checksum(), first)
+        self.assertEqual(self.hashed, [])
+
+    def test_copy_not_read(self):
+        # as py2dsc and batch builds work on fresh copies of the tree
+        first = self.checksum()
+        del self.hashed[:]
+        copy = os.path.join(self.tmp_dir, 'copy')
+        os.mkdir(copy)
+        clone_tree(self.top, copy)
+        self.assertEqual(self.checksum(copy), first)
+        self.assertEqual(self.hashed, [])
+
+    def test_changed_file_read(self):
+        first = self.checksum()
+        del self.hashed[:]
+        fname = os.path.join(self.top, 'setup.py')
+        write_file(fname, 'changed\n')
+        os.utime(fname, (self.old+1, self.old+1))
+        self.failIf(self.checksum() == first)
+        self.assertEqual(self.hashed, ['setup.py'])
+
+    def test_recent_files_not_kept(self):
+        os.utime(os.path.join(self.top, 'README'), None)
+        self.checksum()
+        self.assertEqual(read_hash_cache(self.cache).keys(), ['setup.py'])
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os, shutil, stat, tempfile, unittest
+from stdeb.patch import apply_patches, PatchError, Unsupported
+from stdeb.util import apply_patch
+
+# as dpkg-source writes the .diff.gz: new files have no timestamps
+DPKG_DIFF = """\
+--- pkg-1.0.orig/pkg/mod.py
++++ pkg-1.0/pkg/mod.py
+@@ -1,2 +1,2 @@
+ a = 1
+-b = 2
++b = 3
+--- pkg-1.0.orig/debian/compat
++++ pkg-1.0/debian/compat
+@@ -0,0 +1 @@
++7
+"""
+
+# as git diff writes a new executable file
+GIT_DIFF = """\
+diff --git a/run.sh b/run.sh
+new file mode 100755
+index 0000000..1a2b3c4
+--- /dev/null
++++ b/run.sh
+@@ -0,0 +1,2 @@
++#!/bin/sh
++exit 0
+"""
+
+def write_file(fname, data):
+    dirname = os.path.dirname(fname)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    fd = open(fname, mode='wb')
+    try:
+        fd.write(data)
+    finally:
+        fd.close()
+
+def read_file(fname):
+    fd = open(fname, mode='rb')
+    try:
+        return fd.read()
+    finally:
+        fd.close()
+
+class ApplyPatchesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tmp_dir, 'pkg-1.0')
+        write_file(os.path.join(self.top, 'pkg', 'mod.py'), 'a = 1\nb = 2\n')
+        self.patch = os.path.join(self.tmp_dir, 'pkg.diff')
+        write_file(self.patch, DPKG_DIFF)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_new_file_without_timestamps(self):
+        changed = apply_patches([self.patch], cwd=self.top, level=1)
+        self.assertEqual(changed, ['pkg/mod.py', 'debian/compat'])
+        self.assertEqual(read_file(os.path.join(self.top, 'pkg', 'mod.py')),
+                         'a = 1\nb = 3\n')
+        self.assertEqual(read_file(os.path.join(self.top, 'debian',
+                                                'compat')), '7\n')
+
+    def test_nothing_written_on_failure(self):
+        write_file(os.path.join(self.top, 'pkg', 'mod.py'), 'a = 1\nb = 4\n')
+        self.assertRaises(PatchError, apply_patches, [self.patch],
+                          cwd=self.top, level=1)
+        self.failIf(os.path.exists(os.path.join(self.top, 'debian')))
+
+    def test_git_file_mode(self):
+        write_file(self.patch, GIT_DIFF)
+        self.assertRaises(Unsupported, apply_patches, [self.patch],
+                          cwd=self.top, level=1)
+        # apply_patch falls back to patch, which sets the mode
+        apply_patch(self.patch, cwd=self.top, level=1)
+        fname = os.path.join(self.top, 'run.sh')
+        self.assertEqual(read_file(fname), '#!/bin/sh\nexit 0\n')
+        self.failUnless(os.stat(fname).st_mode & stat.S_IXUSR)
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os, sys, time, unittest
+from stdeb import process
+
+# a command which keeps running after its output pipe is closed
+STUBBORN = """\
+import signal, sys, time
+signal.signal(signal.SIGTERM, signal.SIG_IGN)
+print 'started'
+sys.stdout.flush()
+time.sleep(60)
+"""
+
+class PopenTest(unittest.TestCase):
+    def test_preexec_fn_with_timeout(self):
+        # the process group is made, and the caller's preexec_fn run
+        code = 'import os; print os.getpgrp() == os.getpid(), os.umask(0)'
+        returncode, stdout = process.get_output(
+            [sys.executable, '-c', code], timeout=60,
+            preexec_fn=lambda: os.umask(077))
+        self.assertEqual(returncode, 0)
+        self.assertEqual(stdout, 'True 63\n')
+
+class IterOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.grace = process.KILL_GRACE_TIME
+        process.KILL_GRACE_TIME = 0.2
+
+    def tearDown(self):
+        process.KILL_GRACE_TIME = self.grace
+
+    def stop_early(self, timeout):
+        chunks = process.iter_output([sys.executable, '-c', STUBBORN],
+                                     timeout=timeout)
+        chunks.next() # the command has started
+        start = time.time()
+        chunks.close()
+        self.failUnless(time.time()-start < 10)
+
+    def test_stop_early(self):
+        self.stop_early(None)
+
+    def test_stop_early_with_timeout(self):
+        self.stop_early(60)
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os, shutil, tarfile, tempfile, unittest
+from StringIO import StringIO
+from stdeb.util import get_diff_paths, get_source_dir_differences
+
+DIFF = """\
+--- pkg-1.0.orig/debian/rules
++++ pkg-1.0/debian/rules
+@@ -0,0 +1,2 @@
++#!/usr/bin/make -f
++# rules
+--- pkg-1.0.orig/pkg/mod.py
++++ pkg-1.0/pkg/mod.py
+@@ -1 +1 @@
+-x = 1
++x = 2
+"""
+
+def write_file(fname, data, mode=0644):
+    dirname = os.path.dirname(fname)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    fd = open(fname, mode='wb')
+    try:
+        fd.write(data)
+    finally:
+        fd.close()
+    os.chmod(fname, mode)
+
+class SourceDirDifferencesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp_dir, 'pkg-1.0')
+        write_file(os.path.join(self.source_dir, 'setup.py'), 'pass\n')
+        write_file(os.path.join(self.source_dir, 'doc', 'README'), 'read\n')
+        write_file(os.path.join(self.source_dir, 'pkg', 'mod.py'), 'x = 2\n')
+        write_file(os.path.join(self.source_dir, 'debian', 'rules'),
+                   '#!/usr/bin/make -f\n# rules\n', 0755)
+        self.diff_file = os.path.join(self.tmp_dir, 'pkg_1.0-1.diff')
+        write_file(self.diff_file, DIFF)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_orig_tarball(self, with_dirs):
+        """the orig tarball, with or without entries for directories"""
+        fname = os.path.join(self.tmp_dir, 'pkg_1.0.orig.tar.gz')
+        tar = tarfile.open(fname, 'w:gz')
+        try:
+            if with_dirs:
+                for name in ['pkg-1.0', 'pkg-1.0/doc', 'pkg-1.0/pkg']:
+                    info = tarfile.TarInfo(name)
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0755
+                    tar.addfile(info)
+            for name, data in [('pkg-1.0/setup.py', 'pass\n'),
+                               ('pkg-1.0/doc/README', 'read\n'),
+                               ('pkg-1.0/pkg/mod.py', 'x = 1\n')]:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = 0644
+                tar.addfile(info, StringIO(data))
+        finally:
+            tar.close()
+        return fname
+
+    def test_diff_paths(self):
+        self.assertEqual(get_diff_paths(self.diff_file),
+                         ['debian/rules', 'pkg/mod.py'])
+
+    def test_with_directory_entries(self):
+        orig = self.make_orig_tarball(with_dirs=True)
+        self.assertEqual(get_source_dir_differences(
+            self.source_dir, orig, self.diff_file), [])
+
+    def test_without_directory_entries(self):
+        # as in tarballs repacked from zip sdists: tar makes doc/ for
+        # doc/README, which the diff does not name
+        orig = self.make_orig_tarball(with_dirs=False)
+        self.assertEqual(get_source_dir_differences(
+            self.source_dir, orig, self.diff_file), [])
+
+    def test_extra_file(self):
+        orig = self.make_orig_tarball(with_dirs=False)
+        write_file(os.path.join(self.source_dir, 'pkg', 'extra.py'), '')
+        self.assertEqual(get_source_dir_differences(
+            self.source_dir, orig, self.diff_file),
+                         ['pkg/extra.py would not be extracted'])
+
+if __name__=='__main__':
+    unittest.main()